@@ -0,0 +1,1005 @@
+""" Benchmarks for the server internals.
+
+    Usage: python benchmark.py BENCHMARK [ARGS...]
+    e.g.   python benchmark.py store 1000 100000 1000000
+
+    Every benchmark works in a temporary directory, so it never touches tasks.db """
+
+import cPickle as pickle
+import json
+import os
+import resource
+import select
+import shelve
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from server import ENGINES, Request, SelectServer
+from socketclient import Client
+from taskstore import LogBackend, ShelveBackend, TaskStore
+from viewport import StoreRows, Viewport
+import bulk
+import wire
+
+def make_tasks(n, completers=0):
+    """ Build a task table with n tasks, sorted by priority.
+        With some completers, every other task is accepted by one of them """
+
+    tasks = [["Task %d" % i, completers and i % 2 and "Completer %d" % (i % completers) or '',
+              str(i % 10), str(i % 101)] for i in xrange(n)]
+    tasks.sort(key=lambda t: int(t[2]))
+    return tasks
+
+def seed_log(basename, n):
+    """ Write a write-ahead log snapshot holding n tasks """
+
+    f = open(basename + ".snapshot", "wb")
+    try:
+        pickle.dump({'seq': 0, 'tasks': make_tasks(n)}, f, pickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+
+def start_server(directory, engine=SelectServer, sync_every=256, **kwargs):
+    """ Start a server on a free local port in a background thread """
+
+    # group commit by default, so the disk doesn't dominate
+    request = Request(TaskStore(LogBackend(os.path.join(directory, "tasks"), sync_every=sync_every, legacy=None)))
+    server = engine("localhost", 0, request, **kwargs)
+    server.port = server.server.getsockname()[1]
+    server.thread = threading.Thread(target=server.run)
+    server.thread.start()
+    return server
+
+def stop_server(server):
+    """ Stop a server started by start_server() """
+
+    server.stop()
+    server.thread.join()
+    server.shutdown()
+
+def spawn_server(directory, *args):
+    """ Run server.py in its own process on a free local port, returns (process, port) """
+
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    devnull = open(os.devnull, "w")
+    process = subprocess.Popen([sys.executable, server, "localhost", str(port)] + list(args),
+                               cwd=directory, stdout=devnull, stderr=devnull)
+    # wait until it's listening
+    for i in xrange(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process, port
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server.py didn't start")
+
+def raise_fd_limit():
+    """ Allow as many open sockets as the system lets us """
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+class Listeners(object):
+    """ A lot of client sockets, and a way to wait until each has received some number of lines.
+        With a board they connect to that board, otherwise they listen to the default one.
+        With resume, a (version, epoch) the table is at, they connect to the default board as
+        delta clients that already have the table, so they get the changes without it """
+
+    def __init__(self, port, n, board=None, resume=None):
+        self.socks = {}
+        self.order = []
+        for i in xrange(n):
+            sock = socket.create_connection(("localhost", port))
+            if resume is not None:
+                request = {'command': 'connect listener%d' % i, 'client_id': 'listener%d' % i, 'protocol': 'delta',
+                           'version': resume[0], 'epoch': resume[1]}
+            elif board is None:
+                # a private request, so we get broadcasts without everybody hearing about us
+                request = {'command': 'resync', 'client_id': 'listener%d' % i}
+            else:
+                request = {'command': 'connect listener%d' % i, 'client_id': 'listener%d' % i, 'board': board}
+            sock.sendall(json.dumps(request) + "\n")
+            self.socks[sock.fileno()] = sock
+            self.order.append(sock)
+        self.poll = hasattr(select, 'epoll') and select.epoll() or select.poll()
+        for fd in self.socks:
+            self.poll.register(fd, select.POLLIN)
+        self.bytes = 0
+        self.wait(1)
+        if board is not None or resume is not None:
+            # everybody on the board hears about everybody after them connecting
+            self.settle()
+
+    def settle(self, quiet=0.5):
+        """ Read whatever arrives until nothing has for 'quiet' seconds """
+
+        while True:
+            events = self.poll.poll(quiet)
+            if not events:
+                return
+            for fd, event in events:
+                self.bytes += len(self.socks[fd].recv(65536))
+
+    def wait(self, lines, timeout=60):
+        """ Wait until every socket has received 'lines' more lines, returns False on timeout """
+
+        remaining = dict((fd, lines) for fd in self.socks)
+        deadline = time.time() + timeout
+        while remaining:
+            if time.time() > deadline:
+                return False
+            for fd, event in self.poll.poll(1):
+                data = self.socks[fd].recv(65536)
+                if not data:
+                    return False
+                self.bytes += len(data)
+                if fd in remaining:
+                    remaining[fd] -= data.count("\n")
+                    if remaining[fd] <= 0:
+                        del remaining[fd]
+        return True
+
+    def close(self):
+        for sock in self.socks.values():
+            sock.close()
+        self.poll.close()
+
+def deep_size(obj):
+    """ Add up the size of an object and everything it refers to, counting shared objects once """
+
+    total, seen, stack = 0, set(), [obj]
+    while stack:
+        o = stack.pop()
+        if id(o) in seen:
+            continue
+        seen.add(id(o))
+        total += sys.getsizeof(o)
+        if isinstance(o, dict):
+            stack.extend(o.keys())
+            stack.extend(o.values())
+        elif isinstance(o, (list, tuple)):
+            stack.extend(o)
+        elif hasattr(o, '__slots__'):
+            stack.extend(getattr(o, slot) for slot in o.__slots__ if hasattr(o, slot))
+    return total
+
+def timeit(func, repeat):
+    """ Call func 'repeat' times and return the median latency in milliseconds """
+
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        func(i)
+        times.append(time.time() - start)
+    times.sort()
+    return times[len(times) // 2] * 1000
+
+def legacy_complete(filename, task_name, completion):
+    """ The per-command path the server used before the resident task store:
+        open the shelve, scan for the task, change it and write everything back """
+
+    s = shelve.open(filename, writeback=True)
+    try:
+        data = s['data']
+        sublist = next((l for l in data if l[0] == task_name), None)
+        sublist[3] = completion
+        s['data'] = data
+    finally:
+        s.close()
+
+class AsyncWriter(object):
+    """ The store's backend before the write-ahead log (see bench_store): this wraps
+        another backend and moves the saving off the caller's thread.
+
+        write() only remembers that the store is dirty. A background thread wakes
+        up every 'interval' seconds and, if anything changed, copies the task list
+        (while holding the store lock) and hands the copy to the real backend.
+        Several writes between two flushes therefore cost one save. """
+
+    def __init__(self, backend, interval=1.0):
+        self.backend = backend
+        self.interval = interval
+        self.store = None
+        self.dirty = False
+        self.wakeup = threading.Event()
+        self.running = True
+
+        self.thread = threading.Thread(target=self._run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def load(self):
+        return self.backend.load()
+
+    def write(self, store, record):
+        self.store = store
+        self.dirty = True
+
+    def flush(self):
+        """ Write the pending tasks (if any) to the real backend right now """
+
+        if not self.dirty:
+            return
+        self.dirty = False
+        self.store.lock.acquire()
+        try:
+            snapshot = self.store.rows()
+        finally:
+            self.store.lock.release()
+        self.backend.save(snapshot)
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.interval)
+            self.flush()
+
+    def close(self):
+        """ Stop the flushing thread and write anything still pending """
+
+        self.running = False
+        self.wakeup.set()
+        self.thread.join()
+        self.flush()
+        self.backend.close()
+
+def bench_store(*sizes):
+    """ Per-command latency of 'complete' with the shelve path and the resident store """
+
+    sizes = [int(n) for n in sizes] or [1000, 100000, 1000000]
+    directory = tempfile.mkdtemp()
+    try:
+        print "%10s %14s %14s" % ("tasks", "shelve (ms)", "store (ms)")
+        for n in sizes:
+            filename = os.path.join(directory, "tasks-%d.db" % n)
+            ShelveBackend(filename).save(make_tasks(n))
+            # the shelve path rewrites everything, so keep the repeat count sane
+            repeat = max(3, min(100, 1000000 // n))
+            middle = "Task %d" % (n // 2)
+
+            legacy = timeit(lambda i: legacy_complete(filename, middle, str(i % 100)), repeat)
+
+            request = Request(TaskStore(AsyncWriter(ShelveBackend(filename))))
+            try:
+                resident = timeit(lambda i: request.complete("%s %d" % (middle, i % 100), "bench"), 1000)
+            finally:
+                request._close()
+
+            print "%10d %14.3f %14.3f" % (n, legacy, resident)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_wal(*sizes):
+    """ Per-command latency of 'complete' with the write-ahead log, for a few group commit sizes """
+
+    sizes = [int(n) for n in sizes] or [1000, 100000, 1000000]
+    batches = [1, 16, 256]
+    directory = tempfile.mkdtemp()
+    try:
+        print "%10s" % "tasks" + "".join("%16s" % ("sync/%d (ms)" % b) for b in batches)
+        for n in sizes:
+            row = "%10d" % n
+            middle = "Task %d" % (n // 2)
+            for batch in batches:
+                basename = os.path.join(directory, "tasks-%d-%d" % (n, batch))
+                seed_log(basename, n)
+                request = Request(TaskStore(LogBackend(basename, sync_every=batch, legacy=None)))
+                try:
+                    latency = timeit(lambda i: request.complete("%s %d" % (middle, i % 100), "bench"), 2000)
+                finally:
+                    request._close()
+                row += "%16.3f" % latency
+            print row
+    finally:
+        shutil.rmtree(directory)
+
+def bench_pipeline(connections=10, commands=5000):
+    """ Every connection sends all of its commands in one go and waits until it has seen every change """
+
+    connections, commands = int(connections), int(commands)
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_server(directory)
+        socks = []
+        for c in xrange(connections):
+            sock = socket.create_connection(("localhost", server.port))
+            sock.sendall(json.dumps({'command': 'connect bench%d' % c, 'client_id': '', 'protocol': 'delta'}) + "\n")
+            socks.append(sock)
+
+        total = connections * commands
+        results = []
+
+        def drain(sock):
+            # wait for the broadcast of the last change
+            received = 0
+            for line in sock.makefile():
+                received += 1
+                if json.loads(line)['version'] == total:
+                    break
+            results.append(received)
+
+        readers = [threading.Thread(target=drain, args=(sock,)) for sock in socks]
+        for reader in readers:
+            reader.start()
+
+        start = time.time()
+        for c, sock in enumerate(socks):
+            lines = [json.dumps({'command': 'addTask task %d-%d' % (c, i), 'client_id': 'bench%d' % c})
+                     for i in xrange(commands)]
+            sock.sendall("\n".join(lines) + "\n")
+        for reader in readers:
+            reader.join()
+        elapsed = time.time() - start
+
+        print "%d connections x %d pipelined commands" % (connections, commands)
+        print "%d commands in %.3f s (%.0f commands/s)" % (total, elapsed, total / elapsed)
+        print "every connection saw every change: %s" % (len(server.request.store) == total and
+                                                         all(r >= total for r in results))
+        for sock in socks:
+            sock.close()
+        stop_server(server)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_requests(commands=5000, *depths):
+    """ One socketclient.Client sending commands and waiting for every response, with up to
+        1/10/100/1000 of them on their way at once (1 is a round trip per command) """
+
+    commands = int(commands)
+    depths = [int(n) for n in depths] or [1, 10, 100, 1000]
+    print "%d prioritize commands from one client" % commands
+    print "%10s %14s %14s" % ("in flight", "commands/s", "latency (ms)")
+    for depth in depths:
+        directory = tempfile.mkdtemp()
+        process, port = spawn_server(directory)
+        try:
+            client = Client("localhost", port)
+            client.connect()
+            client.start()
+            tasks = ["task %d" % i for i in xrange(100)]
+            client.call({'command': 'batch', 'commands': ["addTask %s" % t for t in tasks],
+                         'client_id': 'sender'})
+
+            in_flight = threading.Semaphore(depth)
+            latencies = []
+            def request(i):
+                in_flight.acquire()
+                sent = time.time()
+                def done(future):
+                    latencies.append(time.time() - sent)
+                    in_flight.release()
+                client.request({'command': "prioritize %s %d" % (tasks[i % len(tasks)], i % 10),
+                                'client_id': 'sender'}).add_done_callback(done)
+
+            start = time.time()
+            for i in xrange(commands):
+                request(i)
+            for i in xrange(depth):
+                in_flight.acquire()
+            elapsed = time.time() - start
+
+            print "%10d %14.0f %14.3f" % (depth, commands / elapsed, sum(latencies) / len(latencies) * 1000)
+            client.close()
+        finally:
+            process.kill()
+            process.wait()
+            shutil.rmtree(directory)
+
+def bench_fanout(engine="select", *sizes):
+    """ How long a broadcast takes to reach every client, with idle and active connections.
+        Idle: one client sends a change. Active: up to 100 clients send a change at the same time """
+
+    sizes = [int(n) for n in sizes] or [100, 1000, 10000]
+    raise_fd_limit()
+    print "engine: %s" % engine
+    print "%10s %14s %14s" % ("clients", "idle (ms)", "active (ms)")
+    for n in sizes:
+        directory = tempfile.mkdtemp()
+        process, port = spawn_server(directory, "--engine", engine)
+        try:
+            listeners = Listeners(port, n)
+            senders = listeners.order[:min(n, 100)]
+            senders[0].sendall(json.dumps({'command': 'addTask probe', 'client_id': 'sender0'}) + "\n")
+            listeners.wait(1)
+
+            def idle(i):
+                senders[0].sendall(json.dumps({'command': 'complete probe %d' % (i % 100),
+                                               'client_id': 'sender0'}) + "\n")
+                if not listeners.wait(1):
+                    raise RuntimeError("lost the server")
+
+            def active(i):
+                for sock in senders:
+                    sock.sendall(json.dumps({'command': 'complete probe %d' % (i % 100),
+                                             'client_id': 'sender'}) + "\n")
+                if not listeners.wait(len(senders)):
+                    raise RuntimeError("lost the server")
+
+            print "%10d %14.3f %14.3f" % (n, timeit(idle, 20), timeit(active, 5))
+            listeners.close()
+        except (RuntimeError, socket.error):
+            # e.g. select() can't watch this many sockets
+            print "%10d %14s %14s" % (n, "failed", "failed")
+        finally:
+            process.kill()
+            process.wait()
+            shutil.rmtree(directory)
+
+def bench_boards(clients=1000, *boards):
+    """ How long a change takes to reach the clients on its board, with the same number of
+        connections spread over 1/10/100 boards """
+
+    clients = int(clients)
+    boards = [int(n) for n in boards] or [1, 10, 100]
+    raise_fd_limit()
+    engine = 'epoll' in ENGINES and 'epoll' or 'select'
+    print "%d clients, engine: %s" % (clients, engine)
+    print "%10s %16s %14s" % ("boards", "clients/board", "change (ms)")
+    for n in boards:
+        directory = tempfile.mkdtemp()
+        process, port = spawn_server(directory, "--engine", engine, "--max-boards", str(n + 1))
+        try:
+            listeners = [Listeners(port, clients // n, "board%d" % i) for i in xrange(n)]
+            sender = listeners[0].order[0]
+            sender.sendall(json.dumps({'command': 'addTask probe', 'client_id': 'sender'}) + "\n")
+            listeners[0].wait(1)
+
+            def change(i):
+                sender.sendall(json.dumps({'command': 'complete probe %d' % (i % 100), 'client_id': 'sender'}) + "\n")
+                if not listeners[0].wait(1):
+                    raise RuntimeError("lost the server")
+
+            print "%10d %16d %14.3f" % (n, clients // n, timeit(change, 20))
+            for l in listeners:
+                l.close()
+        finally:
+            process.kill()
+            process.wait()
+            shutil.rmtree(directory)
+
+def bench_workers(clients=1000, commands=1000, tasks=100000, *workers):
+    """ Broadcast throughput and update latency with the server in one process and with worker
+        processes, with 'tasks' tasks in the table and every client a delta client """
+
+    clients, commands, tasks = int(clients), int(commands), int(tasks)
+    workers = [int(w) for w in workers] or [0, 2, 4]
+    engine = 'epoll' in ENGINES and 'epoll' or 'select'
+    raise_fd_limit()
+    print "%d clients, %d pipelined commands, %d tasks, engine: %s" % (clients, commands, tasks, engine)
+    print "%10s %14s %20s" % ("workers", "latency (ms)", "broadcasts/s")
+    for w in workers:
+        directory = tempfile.mkdtemp()
+        seed_log(os.path.join(directory, "tasks"), tasks)
+        process, port = spawn_server(directory, "--engine", engine, "--workers", str(w))
+        try:
+            # the clients start off with the table, rather than each being sent it
+            client = Client("localhost", port)
+            client.connect()
+            client.send({'command': 'resync', 'client_id': 'sender'})
+            table = client.receive()
+            client.close()
+            listeners = Listeners(port, clients, resume=(table['version'], table['epoch']))
+            sender = listeners.order[0]
+
+            def update(i):
+                sender.sendall(json.dumps({'command': 'complete Task %d %d' % (i % tasks, (i + 1) % 101),
+                                           'client_id': 'sender'}) + "\n")
+                if not listeners.wait(1):
+                    raise RuntimeError("lost the server")
+            latency = timeit(update, 50)
+
+            lines = [json.dumps({'command': 'complete Task %d %d' % (i % tasks, (i + 1) % 101), 'client_id': 'sender'})
+                     for i in xrange(commands)]
+            start = time.time()
+            sender.sendall("\n".join(lines) + "\n")
+            if not listeners.wait(commands):
+                raise RuntimeError("lost the server")
+            elapsed = time.time() - start
+
+            print "%10d %14.3f %20.0f" % (w, latency, commands * clients / elapsed)
+            listeners.close()
+        finally:
+            process.kill()
+            process.wait()
+            shutil.rmtree(directory)
+
+def bench_replicas(clients=1000, commands=1000, *replicas):
+    """ Broadcast throughput and update latency with every client on the server, and with the
+        clients spread over replica processes (the changes are all sent to the primary) """
+
+    clients, commands = int(clients), int(commands)
+    replicas = [int(r) for r in replicas] or [0, 2, 4]
+    engine = 'epoll' in ENGINES and 'epoll' or 'select'
+    raise_fd_limit()
+    print "%d clients, %d pipelined commands, engine: %s" % (clients, commands, engine)
+    print "%10s %14s %20s %22s" % ("replicas", "latency (ms)", "broadcasts/s", "primary bcast (ms)")
+    for r in replicas:
+        directory = tempfile.mkdtemp()
+        processes = []
+        try:
+            process, port = spawn_server(directory, "--engine", engine)
+            processes.append(process)
+            ports = []
+            for i in xrange(r):
+                process, replica = spawn_server(directory, "--engine", engine, "--replica-of", "localhost:%d" % port)
+                processes.append(process)
+                ports.append(replica)
+            groups = [Listeners(p, clients // len(ports)) for p in ports] or [Listeners(port, clients)]
+            sender = socket.create_connection(("localhost", port))
+            sender.sendall(json.dumps({'command': 'addTask probe', 'client_id': 'sender'}) + "\n")
+            for listeners in groups:
+                # (replicas that were still starting up send everyone the table)
+                listeners.settle()
+
+            def wait(lines):
+                for listeners in groups:
+                    if not listeners.wait(lines):
+                        raise RuntimeError("lost the server")
+
+            def update(i):
+                sender.sendall(json.dumps({'command': 'complete probe %d' % (i % 100), 'client_id': 'sender'}) + "\n")
+                wait(1)
+            latency = timeit(update, 50)
+
+            lines = [json.dumps({'command': 'complete probe %d' % (i % 100), 'client_id': 'sender'})
+                     for i in xrange(commands)]
+            start = time.time()
+            sender.sendall("\n".join(lines) + "\n")
+            wait(commands)
+            elapsed = time.time() - start
+
+            # what a broadcast costs the primary, which only sends to the replicas when there are some
+            sender.sendall(json.dumps({'command': 'stats', 'client_id': 'sender'}) + "\n")
+            stats = next(m for m in (json.loads(line) for line in sender.makefile()) if m['type'] == 'stats')
+            print "%10d %14.3f %20.0f %22.3f" % (r, latency, commands * sum(len(l.socks) for l in groups) / elapsed,
+                                                 stats['stats']['timers']['broadcast']['mean_ms'])
+            for listeners in groups:
+                listeners.close()
+            sender.close()
+        finally:
+            for process in processes:
+                process.kill()
+                process.wait()
+            shutil.rmtree(directory)
+
+def bench_memory(*sizes):
+    """ Bytes per task in memory and in a snapshot, for lists of strings and for Task records """
+
+    sizes = [int(n) for n in sizes] or [1000, 100000, 1000000]
+    directory = tempfile.mkdtemp()
+    try:
+        print "%10s %14s %14s %14s %14s %14s" % ("tasks", "lists (B)", "records (B)", "store (B)",
+                                                 "pickled lists", "pickled recs")
+        for n in sizes:
+            # the way the table used to be held: every field a separate string, as decoded
+            lists = json.loads(json.dumps(make_tasks(n, completers=50)))
+
+            basename = os.path.join(directory, "tasks-%d" % n)
+            f = open(basename + ".snapshot", "wb")
+            try:
+                pickle.dump({'seq': 0, 'tasks': lists}, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            store = TaskStore(LogBackend(basename, legacy=None))
+            try:
+                records = deep_size(store.index.values())
+                # the records plus the name index and the ordered indexes
+                indexes = [store.order, store.by_completion] + store.by_completer.values()
+                whole = deep_size([store.index] + [[i.buckets, i.maxes, i.tree] for i in indexes])
+                print "%10d %14.1f %14.1f %14.1f %14.1f %14.1f" % (
+                    n, float(deep_size(lists)) / n, float(records) / n, float(whole) / n,
+                    float(len(pickle.dumps(lists, pickle.HIGHEST_PROTOCOL))) / n,
+                    float(len(pickle.dumps(store.records(), pickle.HIGHEST_PROTOCOL))) / n)
+            finally:
+                store.close()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_batch(commands=5000, clients=10, *sizes):
+    """ Command throughput when commands are sent in batches, with every record fsync'd """
+
+    commands, clients = int(commands), int(clients)
+    sizes = [int(n) for n in sizes] or [1, 10, 100, 1000]
+    print "%d prioritize commands, %d clients" % (commands, clients)
+    print "%10s %14s %14s" % ("batch size", "commands/s", "broadcasts")
+    for size in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            server = start_server(directory, sync_every=1)
+            listeners = Listeners(server.port, clients)
+            sender = listeners.order[0]
+            tasks = ["task %d" % i for i in xrange(100)]
+            sender.sendall(json.dumps({'command': 'batch', 'commands': ["addTask %s" % t for t in tasks],
+                                       'client_id': 'sender'}) + "\n")
+            listeners.wait(1)
+
+            batches = []
+            for start in xrange(0, commands, size):
+                batches.append(json.dumps({'command': 'batch', 'client_id': 'sender', 'commands': [
+                    "prioritize %s %d" % (tasks[i % len(tasks)], i % 10)
+                    for i in xrange(start, min(start + size, commands))]}))
+            start = time.time()
+            sender.sendall("\n".join(batches) + "\n")
+            listeners.wait(len(batches))
+            elapsed = time.time() - start
+
+            print "%10d %14.0f %14d" % (size, commands / elapsed, len(batches))
+            listeners.close()
+            stop_server(server)
+        finally:
+            shutil.rmtree(directory)
+
+def bench_formats(*sizes):
+    """ Encode/decode time and size of a whole-table message and a delta message, JSON vs binary """
+
+    sizes = [int(n) for n in sizes] or [1000, 10000, 100000]
+    print "binary format done by %s" % (wire.msgpack and "the msgpack module" or "wire.py in Python")
+    print "%10s %8s %12s %12s %12s %12s %12s %12s" % ("tasks", "message", "json (B)", "binary (B)",
+        "json enc ms", "bin enc ms", "json dec ms", "bin dec ms")
+    delta = {'client_id': u"Nick", 'update': u"Nick changed the completion of 'Task 5': 0 -> 50",
+             'type': u"complete", 'version': 12, 'delta': [{'op': u"set", 'index': 5, 'field': 3, 'value': u"50"}]}
+    for n in sizes:
+        table = json.loads(json.dumps(make_tasks(n, completers=50)))
+        snapshot = {'client_id': u"Nick", 'update': u"Client Nick connected", 'type': u"connect",
+                    'version': 12, 'data': table}
+        repeat = max(3, min(1000, 1000000 // n))
+        for name, msg in (("table", snapshot), ("delta", delta)):
+            encoded = json.dumps(msg)
+            packed = wire.packb(msg)
+            print "%10d %8s %12d %12d %12.3f %12.3f %12.3f %12.3f" % (
+                n, name, len(encoded) + 1, len(packed) + wire.HEADER.size,
+                timeit(lambda i: json.dumps(msg), repeat), timeit(lambda i: wire.frame(msg), repeat),
+                timeit(lambda i: json.loads(encoded), repeat), timeit(lambda i: wire.unpackb(packed), repeat))
+
+def bench_resume(clients=500, tasks=10000, changes=100):
+    """ A reconnect storm: every client reconnects at once after missing some changes.
+        How long until all of them have their connect response, and how much they receive,
+        when they get the whole table vs only the changes they missed """
+
+    clients, tasks, changes = int(clients), int(tasks), int(changes)
+    raise_fd_limit()
+    print "%d clients reconnecting to %d tasks after missing %d changes" % (clients, tasks, changes)
+    print "%10s %14s %14s" % ("connect", "time (ms)", "received (MB)")
+    directory = tempfile.mkdtemp()
+    try:
+        server = start_server(directory, engine=ENGINES.get('epoll', SelectServer))
+        sender = socket.create_connection(("localhost", server.port))
+        responses = sender.makefile()
+
+        def run(requests):
+            """ Send requests as the sender and wait for the responses to them """
+
+            sender.sendall("".join(json.dumps(dict(r, client_id='sender')) + "\n" for r in requests))
+            remaining = len(requests)
+            while remaining:
+                if json.loads(responses.readline())['client_id'] == 'sender':
+                    remaining -= 1
+
+        # (a delta client, so it doesn't get the whole table back every time)
+        run([{'command': "connect sender", 'protocol': 'delta'}])
+        run([{'command': 'batch', 'commands': ["addTask Task %d" % i for i in xrange(start, min(start + 1000, tasks))]}
+             for start in xrange(0, tasks, 1000)])
+
+        for mode in ("snapshot", "resume"):
+            # what the clients saw before they were cut off
+            version, epoch = server.request.version, server.request.epoch
+            run([{'command': "complete Task %d %d" % (i % tasks, i % 101)} for i in xrange(changes)])
+
+            start = time.time()
+            socks, names, buffers = {}, {}, {}
+            poll = hasattr(select, 'epoll') and select.epoll() or select.poll()
+            for i in xrange(clients):
+                sock = socket.create_connection(("localhost", server.port))
+                request = {'command': "connect client%d" % i, 'client_id': "client%d" % i, 'protocol': 'delta'}
+                if mode == "resume":
+                    request.update(version=version, epoch=epoch)
+                sock.sendall(json.dumps(request) + "\n")
+                socks[sock.fileno()] = sock
+                names[sock.fileno()] = "client%d" % i
+                buffers[sock.fileno()] = ""
+                poll.register(sock.fileno(), select.POLLIN)
+
+            # a client is done once its own response has arrived
+            # (everybody also hears about everybody else connecting, which counts too)
+            waiting = set(socks)
+            received = 0
+            while waiting:
+                for fd, event in poll.poll(1):
+                    data = socks[fd].recv(1 << 20)
+                    received += len(data)
+                    lines = (buffers[fd] + data).split("\n")
+                    buffers[fd] = lines.pop()
+                    if fd in waiting and any(json.loads(line)['client_id'] == names[fd] for line in lines):
+                        waiting.remove(fd)
+            elapsed = time.time() - start
+            print "%10s %14.1f %14.1f" % (mode, elapsed * 1000, received / float(1 << 20))
+
+            for sock in socks.values():
+                sock.close()
+            poll.close()
+
+        sender.close()
+        stop_server(server)
+    finally:
+        shutil.rmtree(directory)
+
+def bench_viewport(*sizes):
+    """ What a client that gets the whole table costs vs one that subscribes to a window of 50 rows,
+        and what 100 subscribed clients cost on every change """
+
+    sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+    directory = tempfile.mkdtemp()
+    try:
+        print "%10s %12s %12s %12s %12s %14s %14s" % ("tasks", "table (ms)", "table (KB)", "window (ms)",
+            "window (KB)", "filtered (ms)", "100 subs (ms)")
+        for n in sizes:
+            basename = os.path.join(directory, "tasks-%d" % n)
+            f = open(basename + ".snapshot", "wb")
+            try:
+                pickle.dump({'seq': 0, 'tasks': make_tasks(n, completers=50)}, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            request = Request(TaskStore(LogBackend(basename, sync_every=256, legacy=None)))
+            try:
+                rows = StoreRows(request.store)
+                table = json.dumps(request.store.rows())
+
+                def whole(i):
+                    # (a change to the table means building all the rows again)
+                    request.store.table = None
+                    json.dumps(request.store.rows())
+
+                def window(i, **kwargs):
+                    viewport = Viewport(**kwargs)
+                    viewport.count(rows)
+                    viewport.fetch(rows)
+                    return json.dumps(viewport.window())
+
+                # subscribers scattered over the table, a fifth of them only looking at one completer
+                viewports = []
+                for i in xrange(100):
+                    viewport = Viewport(offset=i * n // 100, completer=i % 5 == 0 and "Completer 7" or None)
+                    viewport.count(rows)
+                    viewport.fetch(rows)
+                    viewports.append(viewport)
+
+                def change(i):
+                    data = request.complete("Task %d %d" % (i * 7919 % n, i % 101), "bench")
+                    for viewport in viewports:
+                        viewport.change(rows, data['delta'], data['touched'])
+
+                print "%10d %12.3f %12.1f %12.3f %12.1f %14.3f %14.3f" % (
+                    n, timeit(whole, 5), len(table) / 1024.0, timeit(lambda i: window(i, offset=n // 2), 100),
+                    len(window(0, offset=n // 2)) / 1024.0,
+                    timeit(lambda i: window(i, completer="Completer 7"), 5), timeit(change, 200))
+            finally:
+                request._close()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_query(*sizes):
+    """ Query latency using the store's indexes vs scanning the whole table """
+
+    sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+    queries = [
+        ("accepted by one completer", dict(completer="Completer 7", limit=50)),
+        ("under 50% complete", dict(completion=(None, 49), limit=50)),
+        ("top 10 unassigned", dict(completer='', limit=10)),
+        ("priority 3, most complete", dict(priority=(3, 3), sort='-completion', limit=10)),
+        ("one completer, 90%+", dict(completer="Completer 7", completion=(90, None), limit=10)),
+    ]
+    directory = tempfile.mkdtemp()
+    try:
+        print "%10s %28s %12s %12s" % ("tasks", "query", "scan (ms)", "index (ms)")
+        for n in sizes:
+            basename = os.path.join(directory, "tasks-%d" % n)
+            f = open(basename + ".snapshot", "wb")
+            try:
+                pickle.dump({'seq': 0, 'tasks': make_tasks(n, completers=50)}, f, pickle.HIGHEST_PROTOCOL)
+            finally:
+                f.close()
+            store = TaskStore(LogBackend(basename, sync_every=256, legacy=None))
+            try:
+                for name, query in queries:
+                    def scan(i):
+                        # what answering it takes without the indexes
+                        tasks = [t for t in store.order if store._passes(t, query.get('completer'),
+                                 query.get('priority'), query.get('completion'))]
+                        if query.get('sort') == '-completion':
+                            tasks.sort(key=lambda t: (t.completion, t.priority, t.seq), reverse=True)
+                        return tasks[:query['limit']]
+
+                    indexed = lambda i: store.query(**query)[0]
+                    assert scan(0) == indexed(0)
+                    print "%10d %28s %12.3f %12.3f" % (n, name, timeit(scan, 5), timeit(indexed, 100))
+            finally:
+                store.close()
+    finally:
+        shutil.rmtree(directory)
+
+def bench_model(*sizes):
+    """ Applying updates to the client's task table: rebuilding a QTableWidget (what the
+        client used to do with every message) vs the TaskModel, with a table view on it.
+        Without a display this runs on Qt's offscreen platform, if the Qt has one """
+
+    if not os.environ.get('DISPLAY'):
+        os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    try:
+        from PyQt4 import QtCore, QtGui
+    except ImportError:
+        print >> sys.stderr, "This needs PyQt4"
+        return
+    from taskmodel import TaskModel
+
+    app = QtGui.QApplication.instance() or QtGui.QApplication(sys.argv[:1])
+    sizes = [int(n) for n in sizes] or [1000, 10000]
+    print "%10s %14s %14s %14s %14s" % ("tasks", "rebuild (ms)", "reset (ms)", "new table (ms)", "delta (ms)")
+    for n in sizes:
+        table = make_tasks(n, completers=50)
+
+        widget = QtGui.QTableWidget(0, 4)
+        widget.show()
+
+        def rebuild(i):
+            widget.setRowCount(len(table))
+            for y, row in enumerate(table):
+                for x, cell in enumerate(row):
+                    item = QtGui.QTableWidgetItem(cell)
+                    item.setTextAlignment(QtCore.Qt.AlignCenter)
+                    item.setFlags(QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled)
+                    widget.setItem(y, x, item)
+            app.processEvents()
+
+        model = TaskModel()
+        view = QtGui.QTableView()
+        view.setModel(model)
+        view.show()
+        model.setTable([list(row) for row in table])
+        app.processEvents()
+
+        def reset(i):
+            model._reset([list(row) for row in table])
+            app.processEvents()
+
+        # whole tables (what 'full' clients get) that differ by a move and a completion
+        tables = []
+        for i in xrange(20):
+            changed = [list(row) for row in (tables and tables[-1] or table)]
+            changed.insert(i * 7 % n, changed.pop(i * 7919 % n))
+            changed[i * 31 % n][3] = str(i)
+            tables.append(changed)
+
+        def new_table(i):
+            model.setTable(tables[i])
+            app.processEvents()
+
+        def delta(i):
+            model.applyDelta([{'op': 'set', 'index': i * 7919 % n, 'field': 2, 'value': str(i % 10)},
+                              {'op': 'move', 'from': i * 7919 % n, 'to': i * 7 % n}])
+            app.processEvents()
+
+        print "%10d %14.3f %14.3f %14.3f %14.3f" % (n, timeit(rebuild, 5), timeit(reset, 5),
+                                                    timeit(new_table, 20), timeit(delta, 100))
+        view.close()
+        widget.close()
+
+def bench_startup(*sizes):
+    """ How long server.py takes to accept a connection and to answer its first request,
+        starting from a snapshot of n tasks """
+
+    sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+    print "%10s %14s %16s" % ("tasks", "accept (ms)", "response (ms)")
+    for n in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            store = TaskStore(LogBackend(os.path.join(directory, "tasks"), legacy=None))
+            store.add_many(bulk.task(t) for t in make_tasks(n, completers=50))
+            store.backend.compact(store)
+            store.close()
+
+            sock = socket.socket()
+            sock.bind(("localhost", 0))
+            port = sock.getsockname()[1]
+            sock.close()
+            devnull = open(os.devnull, "w")
+            server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+            start = time.time()
+            process = subprocess.Popen([sys.executable, server, "localhost", str(port)], cwd=directory,
+                                       stdout=devnull, stderr=devnull)
+            try:
+                while True:
+                    try:
+                        client = socket.create_connection(("localhost", port))
+                        break
+                    except socket.error:
+                        time.sleep(0.001)
+                accepted = time.time()
+                # (a window of one row, since clients that get the whole table get it with everything)
+                client.sendall(json.dumps({'command': 'subscribe', 'client_id': 'bench', 'limit': 1}) + "\n")
+                client.makefile().readline()
+                print "%10d %14.1f %16.1f" % (n, (accepted - start) * 1000, (time.time() - start) * 1000)
+                client.close()
+            finally:
+                process.kill()
+                process.wait()
+        finally:
+            shutil.rmtree(directory)
+
+def bench_import(*sizes):
+    """ Tasks per second loaded with addTask one at a time, and imported from CSV and JSON lines files """
+
+    sizes = [int(n) for n in sizes] or [10000, 100000, 1000000]
+    print "%10s %14s %14s %14s" % ("tasks", "addTask/s", "csv/s", "jsonl/s")
+    for n in sizes:
+        directory = tempfile.mkdtemp()
+        try:
+            tasks = make_tasks(n, completers=50)
+            row = "%10d" % n
+
+            # saved the way the server saves them, each one synced to disk
+            # (that's slow, so a sample of them gives the rate)
+            request = Request(TaskStore(LogBackend(os.path.join(directory, "added"), legacy=None)))
+            try:
+                sample = min(n, 5000)
+                start = time.time()
+                for name, completer, priority, completion in tasks[:sample]:
+                    request.addTask(name, "bench")
+                row += "%14.0f" % (sample / (time.time() - start))
+            finally:
+                request._close()
+
+            for format in bulk.FORMATS:
+                filename = os.path.join(directory, "tasks." + format)
+                f = open(filename, "wb")
+                try:
+                    bulk.write_tasks(f, tasks, format)
+                finally:
+                    f.close()
+                start = time.time()
+                store = TaskStore(LogBackend(os.path.join(directory, format), legacy=None))
+                try:
+                    bulk.import_file(store, filename)
+                finally:
+                    # (including writing the snapshot)
+                    store.close()
+                row += "%14.0f" % (n / (time.time() - start))
+            print row
+        finally:
+            shutil.rmtree(directory)
+
+BENCHMARKS = {
+    'batch': bench_batch,
+    'boards': bench_boards,
+    'fanout': bench_fanout,
+    'formats': bench_formats,
+    'import': bench_import,
+    'memory': bench_memory,
+    'model': bench_model,
+    'pipeline': bench_pipeline,
+    'query': bench_query,
+    'replicas': bench_replicas,
+    'requests': bench_requests,
+    'resume': bench_resume,
+    'startup': bench_startup,
+    'store': bench_store,
+    'viewport': bench_viewport,
+    'wal': bench_wal,
+    'workers': bench_workers,
+}
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print >> sys.stderr, "You need to supply one of: %s" % ", ".join(sorted(BENCHMARKS))
+        sys.exit(-1)
+
+    BENCHMARKS[sys.argv[1]](*sys.argv[2:])
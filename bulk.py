@@ -0,0 +1,119 @@
+""" Reading and writing task lists in bulk, for importing and exporting boards.
+
+    Two formats are understood:
+
+    csv   - one task per row: name,completer,priority,completion
+            (a header row with those names is skipped, and missing fields get the
+            same defaults addTask gives them)
+    jsonl - one task per line, either ["Item 1", "Nick", 5, 12] (which is how they are
+            written) or {"name": "Item 1", "completer": "Nick", "priority": 5, "completion": 12}
+
+    Both are read and written a task at a time, so a file never has to fit in memory
+    as text. Tasks come out as (name, completer, priority, completion) tuples, the
+    same records the task store saves """
+
+import csv
+import json
+import os
+
+from taskstore import LogBackend, Task
+
+# The format names, and the file extensions they are guessed from
+FORMATS = ('csv', 'jsonl')
+EXTENSIONS = {'.csv': 'csv', '.jsonl': 'jsonl', '.json': 'jsonl', '.ndjson': 'jsonl'}
+
+FIELDS = ('name', 'completer', 'priority', 'completion')
+DEFAULTS = (None, u'', 5, 0)
+
+def format_of(filename):
+    """ Guess the format of a file from its extension, raises ValueError if we can't """
+
+    format = EXTENSIONS.get(os.path.splitext(filename)[1].lower())
+    if format is None:
+        raise ValueError("Can't tell the format of %s, it should end in %s" % (filename,
+                         " or ".join(sorted(EXTENSIONS))))
+    return format
+
+def task(fields):
+    """ Turn a task as it was given (a list of up to four fields, or a dict of them)
+        into a record, raises ValueError if it isn't one """
+
+    if isinstance(fields, dict):
+        fields = [fields.get(name, default) for name, default in zip(FIELDS, DEFAULTS)]
+    if not isinstance(fields, (list, tuple)) or not 1 <= len(fields) <= len(FIELDS):
+        raise ValueError("a task is [name, completer, priority, completion]")
+    name, completer, priority, completion = list(fields) + list(DEFAULTS[len(fields):])
+    if not isinstance(name, basestring) or not name.strip():
+        raise ValueError("tasks need a name")
+    if not isinstance(completer, basestring):
+        raise ValueError("the completer of '%s' isn't a name" % name)
+    try:
+        priority, completion = int(priority), int(completion)
+    except (TypeError, ValueError, OverflowError):
+        # (OverflowError is int() of an infinite number)
+        raise ValueError("the priority and completion of '%s' must be numbers" % name)
+    low, high = Task.RANGE
+    if not (low <= priority <= high and low <= completion <= high):
+        raise ValueError("the priority and completion of '%s' must be between %d and %d" % (name, low, high))
+    return (name, completer, priority, completion)
+
+def read_tasks(f, format):
+    """ Yield the tasks in an open file, raises ValueError (saying which line) on a bad one """
+
+    rows = format == 'csv' and csv.reader(f) or (line.strip() for line in f)
+    for number, row in enumerate(rows):
+        if not row or (format == 'csv' and number == 0 and tuple(row) == FIELDS):
+            continue
+        # (bad JSON and bad UTF-8 are ValueErrors too)
+        try:
+            if format == 'csv':
+                record = task([field.decode('utf-8') for field in row])
+            else:
+                record = task(json.loads(row))
+        except ValueError, e:
+            raise ValueError("line %d: %s" % (number + 1, e))
+        yield record
+
+def _utf8(text):
+    # the csv module only writes bytes
+    return isinstance(text, unicode) and text.encode('utf-8') or text
+
+def write_tasks(f, tasks, format):
+    """ Write tasks (records) to an open file, returns how many there were """
+
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(FIELDS)
+        for name, completer, priority, completion in tasks:
+            writer.writerow([_utf8(name), _utf8(completer), priority, completion])
+            count += 1
+    else:
+        for record in tasks:
+            f.write(json.dumps(record) + "\n")
+            count += 1
+    return count
+
+def import_file(store, filename, format=None):
+    """ Add the tasks in a file to a store (whose server isn't running), returns how many were added.
+        Nothing is added if there's a bad task anywhere in the file """
+
+    f = open(filename, 'rb')
+    try:
+        added = store.add_many(read_tasks(f, format or format_of(filename)))
+    finally:
+        f.close()
+    # the next start loads them from a snapshot rather than from one huge log record
+    if isinstance(store.backend, LogBackend) and store.backend.logged:
+        store.backend.compact(store)
+    return added
+
+def export_file(store, filename, format=None):
+    """ Write all the tasks of a store to a file, in display order, returns how many there were """
+
+    format = format or format_of(filename)
+    f = open(filename, 'wb')
+    try:
+        return write_tasks(f, (task.record() for task in store.order), format)
+    finally:
+        f.close()
@@ -3,20 +3,23 @@ from PyQt4 import QtGui, QtCore, uic
 import select
 import socket
 import sys
+import time
 
 from socketclient import Client
+from taskmodel import TaskModel
 
 class Tasker(QtGui.QMainWindow):
     """ This is my main application class.
         It creates all the windows and connects all the signals/slots """
 
-    def __init__(self, host, port):
+    def __init__(self, host, port, board=''):
         QtGui.QMainWindow.__init__(self)
 
         # load the design from the .ui file
         self.ui = uic.loadUi("./resources/mainwindow.ui")
         self.ui.show()
 
+        self.host, self.port = host, port
         self.CLIENT = Client(host, port)
 
         # connect all the signals -> slots, event filters
@@ -26,35 +29,66 @@ class Tasker(QtGui.QMainWindow):
         self.connect(self.ui.actionQuit, QtCore.SIGNAL('triggered()'), QtGui.qApp, QtCore.SLOT('quit()'))
         self.connect(self.ui.actionAbout, QtCore.SIGNAL("activated()"), self.about)
 
+        # (it starts listening when we connect)
         self.thread = Worker()
-        self.connect(self.thread, QtCore.SIGNAL("data"), self.update)
-        self.thread.listen(self.CLIENT.socket)
+        self.connect(self.thread, QtCore.SIGNAL("messages"), self.update)
+        self.connect(self.thread, QtCore.SIGNAL("disconnected"), self.lostServer)
 
         # set up instance vars
         self.connected = False
         self.client_id = ""
+        # the board we're on ('' is the server's default board)
+        self.board = board
+        # our copy of the task table, and the version of it we have
+        # (and which run of the server that version is from, so we can resume after reconnecting)
+        self.model = TaskModel(self)
+        self.ui.tableView.setModel(self.model)
+        self.version = 0
+        self.epoch = None
+        self.resyncing = False
 
         # And any settings
         # No vertical headers for the table
-        self.ui.tableWidget.verticalHeader().setVisible(False)
+        self.ui.tableView.verticalHeader().setVisible(False)
         # No sorting allowed, must always be sorted by increasing priority
-        self.ui.tableWidget.setSortingEnabled(False)
+        self.ui.tableView.setSortingEnabled(False)
         # Give focus to the line edit
         self.ui.lineEdit.setFocus()
 
-    def update(self, data):
-        obj = json.loads(data)
+    def update(self, batch):
+        """ Show everything the server sent since the last update (see Batch):
+            the update messages, in order, then the table as it is now """
 
-        # there will always be an update message
-        # and always have the data to update
-        try:
-            if obj['type'] == 'error':
-                self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: %s</span>" % obj['update'])
+        for error, update in batch.updates:
+            if error:
+                self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: %s</span>" % update)
             else:
-                self.ui.plainTextEdit.appendPlainText(obj['update'])
-            self.updateTaskTable(obj['data'])
-        except KeyError:
-            pass
+                self.ui.plainTextEdit.appendPlainText(update)
+        if batch.epoch:
+            self.epoch = batch.epoch
+        if batch.table is not None:
+            self.version, table = batch.table
+            self.resyncing = False
+            self.model.setTable(table)
+        for base, version, delta in batch.deltas:
+            self.applyDelta(version, delta, base)
+
+    def applyDelta(self, version, delta, base=None):
+        """ Apply the changes that take the table from version 'base' (the one before,
+            unless the changes are everything we missed while disconnected) to the given version.
+            If we missed a version, ask the server for the whole table again """
+
+        if self.resyncing:
+            return
+        if base is None:
+            base = version - 1
+        if base != self.version:
+            self.resyncing = True
+            self.send({'command': 'resync', 'client_id': self.client_id})
+            return
+
+        self.model.applyDelta(delta)
+        self.version = version
 
     def doAction(self):
         """ This method (slot) is responsible for sending the data to the server
@@ -77,6 +111,8 @@ class Tasker(QtGui.QMainWindow):
                 self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: You're already connected!</span>")
                 return
             self.connectToServer(text)
+        elif command == 'board':
+            self.switchBoard(text)
         elif command == 'addTask':
             self.addTask(text)
         elif command == "prioritize":
@@ -90,12 +126,65 @@ class Tasker(QtGui.QMainWindow):
             return
 
     def connectToServer(self, text):
-        """ Responsible for connecting to the server, setting the client name """
+        """ Responsible for connecting to the server, setting the client name.
+            After losing the server this connects again, and picks up where we left off """
+
+        # a socket can't connect again once it has been closed, so every connection gets a new one
+        # (shutting the old one down wakes up the worker if it is still reading from it)
+        try:
+            self.CLIENT.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.CLIENT.close()
+        self.CLIENT = Client(self.host, self.port)
+        try:
+            self.CLIENT.connect()
+        except socket.error, e:
+            self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: Can't connect to the "
+                                             "server: %s</span>" % e)
+            return
+        # the worker is done with the last connection (it stops when the server goes away)
+        self.thread.wait()
+        self.thread.listen(self.CLIENT.socket)
 
-        self.CLIENT.connect()
-        self.CLIENT.send({'command': text, 'client_id': self.client_id})
-        self.connected = True
         self.client_id = ' '.join(text.split()[1:])
+        # we only want the whole table once, then just the changes
+        request = {'command': text, 'client_id': self.client_id, 'protocol': 'delta', 'board': self.board}
+        if self.epoch:
+            # we've had the table before, so we only need what changed since then
+            request.update(version=self.version, epoch=self.epoch)
+        self.resyncing = False
+        self.connected = True
+        self.send(request)
+
+    def lostServer(self, sock=None):
+        """ The server went away (or the connection to it broke): keep the table we have,
+            so connecting again only needs what changed while we were gone """
+
+        if not self.connected or (sock is not None and sock is not self.CLIENT.socket):
+            # we already know, or it's about a connection we've replaced
+            return
+        self.connected = False
+        self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: Lost the server, connect "
+                                         "again to carry on where you left off</span>")
+
+    def send(self, request):
+        """ Send a request to the server, noticing if it has gone away """
+
+        try:
+            self.CLIENT.send(request)
+        except socket.error:
+            self.lostServer()
+
+    def switchBoard(self, text):
+        """ Move to another board (connecting again, on that board) """
+
+        self.board = ' '.join(text.split()[1:])
+        # the versions we have are the other board's
+        self.epoch = None
+        self.resyncing = False
+        self.send({'command': 'connect %s' % self.client_id, 'client_id': self.client_id,
+                   'protocol': 'delta', 'board': self.board})
 
     def addTask(self, text):
         """ Add a task to the table """
@@ -104,7 +193,7 @@ class Tasker(QtGui.QMainWindow):
             self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: You must provide a task name</span>")
             return
 
-        self.CLIENT.send({'command': text, 'client_id': self.client_id})
+        self.send({'command': text, 'client_id': self.client_id})
 
     def setPriority(self, text):
         """ Responsible for sending along the priority and task name """
@@ -113,7 +202,7 @@ class Tasker(QtGui.QMainWindow):
             self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: You must provide a task name and priority</span>")
             return
 
-        self.CLIENT.send({'command': text, 'client_id': self.client_id})
+        self.send({'command': text, 'client_id': self.client_id})
 
     def accept(self, text):
         """ Responsible for sending along the completer name """
@@ -122,7 +211,7 @@ class Tasker(QtGui.QMainWindow):
             self.ui.plainTextEdit.appendHtml("<span style='background-color: red'>ERROR: You must provide a task name</span>")
             return
 
-        self.CLIENT.send({'command': text, 'client_id': self.client_id})
+        self.send({'command': text, 'client_id': self.client_id})
 
     def complete(self, text):
         """ Responsible for sending the task name and completion percentage """
@@ -137,22 +226,7 @@ class Tasker(QtGui.QMainWindow):
                                              "between 0 and 100 inclusive (0 - 100)</span>")
             return
 
-        self.CLIENT.send({'command': text, 'client_id': self.client_id})
-
-
-    def updateTaskTable(self, table):
-        """ This method updates the task table with the data sent to it.
-
-            The data is in the form of:
-
-            [["Item 1", "Completer", "5", "12"], ["Item 2", "", "2", "0"]]"""
-        self.ui.tableWidget.setRowCount(len(table))
-        for y, row in enumerate(table):
-            for x, cell in enumerate(row):
-                item = QtGui.QTableWidgetItem(cell)
-                item.setTextAlignment(QtCore.Qt.AlignCenter)
-                item.setFlags(QtCore.Qt.ItemIsSelectable|QtCore.Qt.ItemIsEnabled)
-                self.ui.tableWidget.setItem(y, x, item)
+        self.send({'command': text, 'client_id': self.client_id})
 
     def about(self):
         """ Show our about dialog """
@@ -170,36 +244,105 @@ class Tasker(QtGui.QMainWindow):
         msgbox.setWindowIcon(QtGui.QIcon("./resources/icon.png"))
         msgbox.exec_()
 
+class Batch(object):
+    """ The messages the server sent in one frame interval, boiled down to what the
+        window needs: every update message in order, the last whole table, and the
+        deltas since then, merged into one where each follows on from the last """
+
+    def __init__(self):
+        # (whether it is an error, the message)
+        self.updates = []
+        self.epoch = None
+        # (version, table), if there was a whole table
+        self.table = None
+        # [base version, version, changes]
+        self.deltas = []
+
+    def __len__(self):
+        return len(self.updates) + len(self.deltas) + (self.table is not None)
+
+    def add(self, obj):
+        """ Add a decoded message """
+
+        if 'update' in obj:
+            self.updates.append((obj.get('type') == 'error', obj['update']))
+        if 'epoch' in obj:
+            self.epoch = obj['epoch']
+        if 'data' in obj:
+            # a whole table makes any changes before it moot
+            self.table = (obj['version'], obj['data'])
+            self.deltas = []
+        elif 'delta' in obj:
+            version, base = obj['version'], obj.get('base')
+            if base is None:
+                base = version - 1
+            if self.deltas and self.deltas[-1][1] == base:
+                self.deltas[-1][1] = version
+                self.deltas[-1][2].extend(obj['delta'])
+            else:
+                self.deltas.append([base, version, list(obj['delta'])])
+
 class Worker(QtCore.QThread):
-    """ Our worker thread """
+    """ Our worker thread. It reads and decodes what the server sends, so the GUI
+        thread doesn't have to, and hands it over as a Batch at most once every
+        INTERVAL seconds, so a burst of messages is one update of the window """
+
+    # seconds between updates of the window (one frame at 60 frames a second)
+    INTERVAL = 1 / 60.0
 
     def __init__(self, parent=None):
         QtCore.QThread.__init__(self, parent)
-        self.data = {}
         self.socket = None
 
     def __del__(self):
         self.wait()
 
     def listen(self, socket):
+        """ Start reading from a connected socket, until the connection ends """
+
         self.socket = socket
         self.start()
 
     def run(self):
-        """ This method waits for IO from select() and then gets the data
-            from the socket and sends it back via a SIGNAL """
-
+        """ This method waits for IO from select(), reads as much as the socket has,
+            decodes every whole line of it and sends the batch back via a SIGNAL
+            once the interval since the last one is up. When the connection ends
+            it says so with the "disconnected" SIGNAL (with the socket) and stops """
+
+        sock = self.socket
+        buffered = ""
+        batch = Batch()
+        last = 0
         while True:
-            response, _, _ = select.select([self.socket], [],[])
-            for t in response:
-                if t == self.socket:
+            # with something waiting to go, only wait until it's time to send it
+            timeout = None
+            if batch:
+                timeout = max(0, last + self.INTERVAL - time.time())
+            try:
+                response, _, _ = select.select([sock], [], [], timeout)
+                chunk = response and sock.recv(65536)
+            except (socket.error, select.error, ValueError):
+                # the connection broke (ValueError is the socket being closed under us)
+                response, chunk = True, ""
+            if response:
+                if not chunk:
+                    # the server has gone away
+                    if batch:
+                        self.emit(QtCore.SIGNAL("messages"), batch)
+                    self.emit(QtCore.SIGNAL("disconnected"), sock)
+                    return
+                lines = (buffered + chunk).split("\n")
+                buffered = lines.pop()
+                for line in lines:
                     try:
-                        self.data = self.socket.makefile().readline()
-                    except socket.error:
-                        # we aren't connected yet
+                        batch.add(json.loads(line))
+                    except (ValueError, KeyError, TypeError):
                         continue
-                    if self.data:
-                        self.emit(QtCore.SIGNAL("data"), self.data.rstrip())
+
+            if batch and time.time() >= last + self.INTERVAL:
+                self.emit(QtCore.SIGNAL("messages"), batch)
+                batch = Batch()
+                last = time.time()
 
 class LineEditEventHandler(QtCore.QObject):
     """ This event handler is responsible for the up/down history action in my line edit """
@@ -245,8 +388,8 @@ class LineEditEventHandler(QtCore.QObject):
 
 if __name__ == '__main__':
     app = QtGui.QApplication(sys.argv)
-    if len(sys.argv) != 3:
-        print >> sys.stderr, "You need to supply the hostname and port"
+    if len(sys.argv) not in (3, 4):
+        print >> sys.stderr, "You need to supply the hostname and port (and optionally a board)"
         sys.exit(-1)
-    tasker = Tasker(sys.argv[1], sys.argv[2])
+    tasker = Tasker(*sys.argv[1:])
     sys.exit(app.exec_())
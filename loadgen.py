@@ -0,0 +1,259 @@
+""" A headless load generator for the server.
+
+    It starts server.py in a temporary directory, fills the task table, then runs
+    a number of simulated clients (each one a socketclient.Client in its own thread)
+    that send a mix of commands with some think time in between. Every client waits
+    for the response to its command before thinking about the next one, or with
+    --pipeline N, keeps up to N commands on their way (matched to their responses
+    by request id, see socketclient.Client.request).
+
+    Usage: python loadgen.py [options]
+    e.g.   python loadgen.py --clients 50 --tasks 10000 --duration 30 --mix addTask=1,complete=5
+
+    The results (throughput, command-to-broadcast latency percentiles and bytes on the
+    wire) are printed and saved as JSON, so runs can be compared over time.
+    Command-to-broadcast latency is from a client sending a change until each of the
+    other clients hears about it (changes are matched up by the version the server
+    gave them); how long clients wait for the responses to their own commands is
+    reported too. """
+
+import json
+import optparse
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from socketclient import Client
+
+# The commands a simulated client can send, and how often by default
+DEFAULT_MIX = "addTask=1,prioritize=2,accept=2,complete=5"
+COMMANDS = ('addTask', 'prioritize', 'accept', 'complete')
+
+class SimulatedClient(threading.Thread):
+    """ One simulated user, sending commands until the deadline """
+
+    def __init__(self, number, host, port, options):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.client_id = "load%d" % number
+        self.options = options
+        self.random = random.Random(number)
+        self.client = Client(host, port)
+
+        # how long the responses to our commands took
+        self.latencies = []
+        # version -> when we sent the change that got it
+        self.changes = {}
+        # version -> when we heard about another client's change
+        self.heard_at = {}
+        self.errors = 0
+        self.sent = 0
+        self.received = 0
+        self.added = 0
+        # how many more commands can be on their way
+        self.in_flight = threading.Semaphore(options.pipeline)
+
+        # the weighted list of commands to pick from
+        self.mix = []
+        for command, weight in options.mix:
+            self.mix.extend([command] * weight)
+
+    def run(self):
+        self.client.connect()
+        self.client.start(self.heard)
+        self.request("connect %s" % self.client_id)
+
+        while time.time() < self.options.deadline and not self.client.closed:
+            self.request(self.command())
+            if self.options.think:
+                time.sleep(self.random.expovariate(1.0 / self.options.think))
+
+        # wait for the responses still on their way
+        for i in xrange(self.options.pipeline):
+            self.in_flight.acquire()
+        self.received = self.client.reader.count
+        self.client.close()
+
+    def heard(self, msg):
+        """ Note when we hear about another client's change """
+
+        if msg['type'] in COMMANDS:
+            self.heard_at[msg['version']] = time.time()
+
+    def command(self):
+        """ Make up the next command """
+
+        command = self.random.choice(self.mix)
+        if command == 'addTask':
+            self.added += 1
+            return "addTask %s-%d" % (self.client_id, self.added)
+        task = "task %d" % self.random.randrange(self.options.tasks)
+        if command == 'prioritize':
+            return "prioritize %s %d" % (task, self.random.randrange(10))
+        if command == 'accept':
+            return "accept %s" % task
+        return "complete %s %d" % (task, self.random.randrange(101))
+
+    def request(self, command):
+        """ Send a command once there is room for it, and time it until its response arrives """
+
+        msg = {'command': command, 'client_id': self.client_id}
+        if command.startswith("connect"):
+            msg['protocol'] = self.options.protocol
+
+        self.in_flight.acquire()
+        start = time.time()
+        future = self.client.request(msg)
+        # (with the id the request ends up with)
+        self.sent += len(json.dumps(dict(msg, id=0))) + 1
+
+        def done(future):
+            self.in_flight.release()
+            if future.exception is not None:
+                return
+            self.latencies.append(time.time() - start)
+            if future.response['type'] == 'error':
+                self.errors += 1
+            elif future.response['type'] in COMMANDS:
+                self.changes[future.response['version']] = start
+        future.add_done_callback(done)
+
+def percentile(values, p):
+    """ Return the p-th percentile of a sorted list """
+
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(p / 100.0 * len(values)))]
+
+def parse_mix(mix):
+    """ Parse "addTask=1,complete=5" into [('addTask', 1), ('complete', 5)] """
+
+    pairs = []
+    for part in mix.split(","):
+        command, weight = part.split("=")
+        if command not in COMMANDS:
+            raise ValueError("unknown command %s" % command)
+        pairs.append((command, int(weight)))
+    return pairs
+
+def start_server(directory, options):
+    """ Run server.py in the given directory on a free local port, returns (process, port) """
+
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "server.py")
+    args = [sys.executable, server, "localhost", str(port), "--engine", options.engine]
+    if options.workers:
+        args += ["--workers", str(options.workers)]
+    devnull = open(os.devnull, "w")
+    process = subprocess.Popen(args, cwd=directory, stdout=devnull)
+    # wait until it's listening
+    for i in xrange(100):
+        try:
+            socket.create_connection(("localhost", port)).close()
+            return process, port
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("server.py didn't start")
+
+def fill(port, tasks):
+    """ Add 'tasks' tasks named "task 0", "task 1", ... in batches """
+
+    client = Client("localhost", port)
+    client.connect()
+    client.start()
+    futures = client.pipeline([{'command': 'batch', 'client_id': 'loadgen',
+                                'commands': ["addTask task %d" % i for i in xrange(start, min(start + 1000, tasks))]}
+                               for start in xrange(0, tasks, 1000)])
+    for future in futures:
+        future.result()
+    client.close()
+
+def run(options):
+    """ Run the load and return the results """
+
+    directory = tempfile.mkdtemp()
+    process, port = start_server(directory, options)
+    try:
+        fill(port, options.tasks)
+
+        options.deadline = time.time() + options.duration
+        clients = [SimulatedClient(i, "localhost", port, options) for i in xrange(options.clients)]
+        start = time.time()
+        for client in clients:
+            client.start()
+        for client in clients:
+            client.join()
+        elapsed = time.time() - start
+    finally:
+        process.kill()
+        process.wait()
+        shutil.rmtree(directory)
+
+    latencies = sorted(l for c in clients for l in c.latencies)
+    sent = {}
+    for c in clients:
+        sent.update(c.changes)
+    broadcasts = sorted(at - sent[version] for c in clients for version, at in c.heard_at.iteritems()
+                        if version in sent)
+    return {
+        'commands': len(latencies),
+        'errors': sum(c.errors for c in clients),
+        'seconds': elapsed,
+        'throughput': len(latencies) / elapsed,
+        'broadcasts': len(broadcasts),
+        'latency_ms': dict(('p%s' % p, percentile(broadcasts, p) * 1000) for p in (50, 99, 99.9)),
+        'response_ms': dict(('p%s' % p, percentile(latencies, p) * 1000) for p in (50, 99, 99.9)),
+        'bytes_sent': sum(c.sent for c in clients),
+        'bytes_received': sum(c.received for c in clients),
+    }
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--clients", type="int", default=10, help="simulated clients (default: 10)")
+    parser.add_option("--tasks", type="int", default=1000, help="tasks in the table to start with (default: 1000)")
+    parser.add_option("--duration", type="float", default=10, help="seconds to run for (default: 10)")
+    parser.add_option("--think", type="float", default=0.0,
+                      help="mean think time between a client's commands, in seconds (default: 0)")
+    parser.add_option("--pipeline", type="int", default=1,
+                      help="commands a client can have on their way at once (default: 1)")
+    parser.add_option("--mix", default=DEFAULT_MIX, help="command weights (default: %s)" % DEFAULT_MIX)
+    parser.add_option("--protocol", choices=["full", "delta"], default="delta",
+                      help="what the clients ask for at connect: full or delta (default: delta)")
+    parser.add_option("--engine", default="select", help="server engine (default: select)")
+    parser.add_option("--workers", type="int", default=0, help="server worker processes (default: none)")
+    parser.add_option("--output", help="where to save the results (default: loadgen-DATE-TIME.json)")
+    options, args = parser.parse_args()
+    try:
+        options.mix = parse_mix(options.mix)
+    except ValueError:
+        print >> sys.stderr, "The mix should look like %s" % DEFAULT_MIX
+        sys.exit(-1)
+
+    results = run(options)
+    print "%d commands in %.1f s: %.0f commands/s, %d errors" % (
+        results['commands'], results['seconds'], results['throughput'], results['errors'])
+    print "command-to-broadcast latency (ms) over %d broadcasts: p50 %.3f, p99 %.3f, p99.9 %.3f" % (
+        results['broadcasts'], results['latency_ms']['p50'], results['latency_ms']['p99'],
+        results['latency_ms']['p99.9'])
+    print "response latency (ms): p50 %(p50).3f, p99 %(p99).3f, p99.9 %(p99.9).3f" % results['response_ms']
+    print "bytes sent: %d, received: %d" % (results['bytes_sent'], results['bytes_received'])
+
+    output = options.output or time.strftime("loadgen-%Y%m%d-%H%M%S.json")
+    config = dict((k, v) for k, v in vars(options).items() if k not in ('output', 'deadline'))
+    f = open(output, "w")
+    try:
+        json.dump({'time': time.time(), 'config': config, 'results': results}, f, indent=4, sort_keys=True)
+    finally:
+        f.close()
+    print "results saved to %s" % output
@@ -0,0 +1,104 @@
+import json
+import math
+import os
+import time
+
+class Histogram(object):
+    """ Counts of durations in power-of-two buckets of microseconds.
+
+        Adding a duration is a couple of arithmetic operations, so it is cheap
+        enough to do for every request. Percentiles are the upper bound of the
+        bucket they fall in, so they are accurate to within a factor of two """
+
+    __slots__ = ('counts', 'count', 'total', 'max')
+
+    def __init__(self):
+        # bucket i counts durations of less than 2**i microseconds (and at least 2**(i-1))
+        self.counts = [0] * 40
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        microseconds = seconds * 1000000
+        bucket = 0
+        if microseconds >= 1:
+            bucket = min(math.frexp(microseconds)[1], 39)
+        self.counts[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """ Return the p-th percentile, in milliseconds """
+
+        wanted = p / 100.0 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted and count:
+                return min((1 << bucket) / 1000.0, self.max * 1000)
+        return 0.0
+
+    def summary(self):
+        return {'count': self.count,
+                'total_ms': self.total * 1000,
+                'mean_ms': self.count and self.total * 1000 / self.count,
+                'p50_ms': self.percentile(50),
+                'p99_ms': self.percentile(99),
+                'p999_ms': self.percentile(99.9),
+                'max_ms': self.max * 1000}
+
+class Metrics(object):
+    """ Numbers about what the server is doing.
+
+        Timers are histograms of how long things took ('command.addTask', 'json.encode', ...),
+        counters only go up ('bytes.in', ...) and gauges are functions that are called
+        when a report is made (the number of connections, ...).
+
+        report() returns all of them as a dict that can be sent to a client or saved as JSON:
+
+        {'uptime': 12.5, 'timers': {'loop': {'count': 3, 'p50_ms': 0.004, ...}, ...},
+         'counters': {'bytes.in': 1234, ...}, 'gauges': {'connections': 2, ...}} """
+
+    def __init__(self):
+        self.started = time.time()
+        self.timers = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def observe(self, name, seconds):
+        """ Add a duration to a timer """
+
+        timer = self.timers.get(name)
+        if timer is None:
+            timer = self.timers[name] = Histogram()
+        timer.add(seconds)
+
+    def count(self, name, n=1):
+        """ Add to a counter """
+
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def gauge(self, name, function):
+        """ Report what function() returns under name """
+
+        self.gauges[name] = function
+
+    def report(self):
+        return {'uptime': time.time() - self.started,
+                'timers': dict((name, timer.summary()) for name, timer in self.timers.iteritems()),
+                'counters': dict(self.counters),
+                'gauges': dict((name, function()) for name, function in self.gauges.iteritems())}
+
+    def dump(self, filename):
+        """ Save a report to a file, replacing it in one go so readers never see half of one """
+
+        tmp = filename + ".tmp"
+        f = open(tmp, "w")
+        try:
+            json.dump(self.report(), f, indent=4, sort_keys=True)
+        finally:
+            f.close()
+        os.rename(tmp, filename)
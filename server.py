@@ -1,9 +1,39 @@
+from collections import deque
+from itertools import islice
+import errno
 import json
-from operator import itemgetter
+import optparse
+import os
+import re
 import select
-import shelve
+import signal
 import socket
 import sys
+import time
+
+from metrics import Metrics
+import bulk
+from taskstore import LogBackend, MemoryBackend, Task, TaskStore
+from viewport import StoreRows, Viewport
+import wire
+
+# Responses of these types only go back to the client that made the request
+PRIVATE_TYPES = ('error', 'export', 'query', 'replicate', 'resync', 'stats', 'subscribe')
+# Responses of these types have the whole table, for every kind of client
+TABLE_TYPES = ('import', 'resync')
+# Responses of these types answer a question, and never carry the whole table (even for full clients)
+ANSWER_TYPES = ('export', 'query', 'replicate', 'stats')
+
+# How much we try to read from a client at once
+RECV_SIZE = 65536
+# The longest request line we accept before dropping the client
+MAX_FRAME = 1 << 20
+# How many bytes may be waiting to go out to one client before it is considered too slow
+HIGH_WATER = 16 << 20
+# How many recent changes are kept for clients that reconnect
+HISTORY = 10000
+# Board names end up in file names
+BOARD_NAME = re.compile(r"[A-Za-z0-9_-]{1,64}\Z")
 
 class Request(object):
     """ This class is a collection of methods responsible for dealing with
@@ -17,37 +47,256 @@ class Request(object):
         r._call(s)
 
         This will look up the internals of the class and call the right
-        method with the appropriate args """
+        method with the appropriate args.
 
-    def __init__(self):
-        # We use the shelve module to keep persistent data between requests for new clients
-        s = shelve.open("tasks.db", writeback=True)
-        try:
-            if not s.has_key("data"):
-                s['data'] = []
-        finally:
-            s.close()
+        Every response carries the table 'version'. Responses to connect and resync
+        carry the whole table in 'data' (the server adds it to everything it sends
+        to clients that want the whole table every time, but the answers to query,
+        stats and export). Responses to commands that
+        change the table carry a 'delta', a list of the changes that take the previous
+        version to this one:
 
-    def _call(self, command):
-        """ This builds a dynamic list of callable methods and calls them """
+        {'op': 'insert', 'index': 3, 'task': ["Item 1", "", "5", "0"]}
+        {'op': 'set', 'index': 3, 'field': 2, 'value': "1"}
+        {'op': 'move', 'from': 3, 'to': 0}
+
+        A batch request carries a list of commands instead of one:
+
+        {'command': 'batch', 'commands': ["prioritize Item 1 1", "accept Item 2"], 'client_id': "Nick"}
+
+        They are saved in one go and answered with one response (and so one broadcast),
+        whose delta has the changes of all of them. Commands that fail don't stop the
+        others; their errors are listed in 'errors', which only go back to the sender.
+
+        An import request adds a list of tasks in one go (see bulk.task for what they
+        can look like), skipping the names that are already taken:
+
+        {'command': 'import', 'tasks': [["Item 1", "", 5, 0], ["Item 2", "Nick", 2, 50]], 'client_id': "Nick"}
+
+        Its response has the whole table instead of a delta, and clears the history.
+
+        How long each command takes is recorded in 'metrics' as 'command.NAME',
+        and the stats command sends back everything recorded there.
+
+        The deltas of the last 'history' versions are kept, so a delta client that
+        reconnects can send the 'version' and 'epoch' it last saw along with connect:
+
+        {'command': "connect Nick", 'client_id': "Nick", 'protocol': 'delta', 'version': 12, 'epoch': "5f3e..."}
+
+        and get only what it missed: the connect response then has a 'delta' that
+        takes version 'base' (the one it sent) to 'version', rather than the whole
+        table. The epoch changes every time the server starts, since versions start
+        from 0 again. If it doesn't match, or the changes aren't in the history any
+        more, the client gets the whole table as usual.
 
-        # This is kinda magic
-        # It searches this class for all method which don't start with _ and creates a list of callables
-        callables = [c for c in dir(self) if not c.startswith("_")]
+        A Request looks after one board (see Boards), and every response says which one.
+        A request with an 'id' gets exactly one response with the id in it, and only
+        the sender sees it (so clients can match responses to the requests they have
+        on their way, and replicas can tell whose request a response is to). A batch
+        with some bad commands then has their errors in the response's 'errors'. """
+
+    # the commands a batch can be made of
+    BATCHABLE = ('addTask', 'prioritize', 'accept', 'complete')
+    # the responses that change the table (and so go in the history)
+    CHANGES = BATCHABLE + ('batch',)
+    # the commands that change the table
+    WRITES = CHANGES + ('import',)
+    # the commands that are methods of their own (the rest of our attributes aren't commands)
+    COMMANDS = BATCHABLE + ('connect', 'resync', 'replicate', 'export', 'stats')
+
+    def __init__(self, store=None, metrics=None, history=HISTORY, board=''):
+        # All requests are served from the resident task store, which persists itself
+        if store is None:
+            store = TaskStore()
+        self.store = store
+        self.board = board
+        # bumped once for every response that has a delta
+        self.version = 0
+        # the server shares these, so they cover everything it does
+        if metrics is None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.store.metrics = metrics
+        # (version, delta) of recent changes, and which run of the server the versions belong to
+        self.history = deque(maxlen=history)
+        self.epoch = os.urandom(8).encode('hex')
+
+    def _call(self, command):
+        """ This runs a request by calling the method its command is named after
+            (only the ones in COMMANDS, plus batch, query and import).
+            The command is a JSON string, or the already decoded request """
 
         # separate the command and get the args/client id
-        obj = json.loads(command)
+        obj = command
+        if isinstance(obj, basestring):
+            obj = json.loads(command)
         _ = obj['command'].split()
         command, args = _[0], " ".join(_[1:])
+        start = time.time()
+        data = None
+        if command == 'batch':
+            data = self._batch(obj.get('commands', []), obj['client_id'])
+        elif command == 'query':
+            data = self._query(obj)
+        elif command == 'import':
+            data = self._import(obj.get('tasks'), obj['client_id'])
+        elif command == 'connect' and obj.get('protocol') == 'delta' and obj.get('epoch') == self.epoch:
+            data = self._resume(args, obj.get('version'))
 
         # try to call the command the return the result, otherwise, not implemented/ignore
+        if data is None:
+            if command in self.COMMANDS:
+                # call self.METHOD with the args
+                data = getattr(self, command)(args, obj['client_id'])
+            else:
+                # not available to be called
+                data = self._error(obj['client_id'], "%s not implemented yet..." % command)
+                # (don't let clients make up timer names)
+                command = 'unknown'
+        self.metrics.observe('command.' + command, time.time() - start)
+        if data['type'] in self.CHANGES:
+            self.history.append((data['version'], data['delta']))
+        data['board'] = self.board
+        return data
+
+    def _missed(self, version):
+        """ Return the changes since the given version, or None if they aren't all in the history """
+
+        if not isinstance(version, (int, long)) or version > self.version:
+            return None
+        if version == self.version:
+            return []
+        # the history has every version from the oldest one in it up to now
+        if not self.history or version < self.history[0][0] - 1:
+            return None
+        delta = []
+        for v, changes in islice(self.history, version - self.history[0][0] + 1, None):
+            delta.extend(changes)
+        return delta
+
+    def _resume(self, args, version):
+        """ Connect a client that already has the table up to the given version.
+            Returns None if we can't bring it up to date with deltas """
+
+        delta = self._missed(version)
+        if delta is None:
+            return None
+        return {'update': "Client %s reconnected" % args, 'client_id': args, 'type': 'connect',
+                'base': version, 'delta': delta, 'version': self.version, 'epoch': self.epoch}
+
+    def _batch(self, commands, client_id):
+        """ Run a list of commands as one transaction, with one combined response """
+
+        if not isinstance(commands, list) or not all(isinstance(c, basestring) for c in commands):
+            return self._error(client_id, "A batch's commands must be a list of strings")
+        updates, delta, errors = [], [], []
+        # the first old row and the last new row of every task the batch changed
+        touched, seen = [], {}
+        version = self.version
+        self.store.begin()
         try:
-            # search the list for the string name of the method
-            # call it by looking for self.METHOD with the args
-            return getattr(self, callables[callables.index(command)])(args, obj['client_id'])
-        except ValueError:
-            # not available to be called
-            return {'update': "%s not implemented yet..." % command, 'error': True}
+            for command in commands:
+                _ = command.split()
+                if not _ or _[0] not in self.BATCHABLE:
+                    errors.append("%s can't be part of a batch" % command)
+                    continue
+                try:
+                    data = getattr(self, _[0])(" ".join(_[1:]), client_id)
+                except Exception, e:
+                    # the rest of the batch still goes out, so nobody misses what it changed
+                    errors.append("%s failed: %s" % (command, e))
+                    continue
+                if data['type'] == 'error':
+                    errors.append(data['update'])
+                else:
+                    updates.append(data['update'])
+                    delta.extend(data['delta'])
+                    for old, new in data['touched']:
+                        if new[0] in seen:
+                            touched[seen[new[0]]] = (touched[seen[new[0]]][0], new)
+                        else:
+                            seen[new[0]] = len(touched)
+                            touched.append((old, new))
+        finally:
+            self.store.commit()
+            # the whole batch is one version
+            self.version = version
+
+        if not delta:
+            return self._error(client_id, "\n".join(errors) or "The batch was empty")
+        data = self._changed(client_id, "\n".join(updates), 'batch', delta, touched)
+        data['errors'] = errors
+        return data
+
+    def _query(self, obj):
+        """ Find tasks by completer, priority and completion, with the filters, 'sort',
+            'offset' and 'limit' in the request. Only the matching rows are sent back """
+
+        client_id = obj['client_id']
+        try:
+            ranges = []
+            for field in ('priority', 'completion'):
+                bounds = obj.get(field)
+                if bounds is not None:
+                    bounds = tuple(None if v is None else int(v) for v in bounds)
+                    if len(bounds) != 2:
+                        raise ValueError("%s must be [low, high]" % field)
+                ranges.append(bounds)
+            offset, limit = int(obj.get('offset', 0)), obj.get('limit')
+            if limit is not None:
+                limit = int(limit)
+            if offset < 0 or (limit is not None and limit < 0):
+                raise ValueError("offset and limit can't be negative")
+            if obj.get('completer') is not None and not isinstance(obj['completer'], basestring):
+                raise ValueError("completer must be a name")
+            tasks, more = self.store.query(obj.get('completer'), ranges[0], ranges[1],
+                                           obj.get('sort', 'priority'), offset, limit)
+        except (TypeError, ValueError, OverflowError), e:
+            # (OverflowError is int() of an infinite number)
+            return self._error(client_id, "Bad query: %s" % e)
+
+        return {'client_id': client_id, 'update': "Found %d tasks" % len(tasks), 'type': 'query',
+                'rows': [task.row() for task in tasks], 'more': more, 'version': self.version}
+
+    def _import(self, tasks, client_id):
+        """ Add a list of tasks in one go. Everybody gets the whole table afterwards,
+            rather than a delta with an insert for every task """
+
+        try:
+            if not isinstance(tasks, list):
+                raise ValueError("tasks must be a list")
+            tasks = [bulk.task(task) for task in tasks]
+        except ValueError, e:
+            return self._error(client_id, "Bad import: %s" % e)
+        added = self.store.add_many(tasks)
+        if not added:
+            return self._error(client_id, "There were no new tasks to import")
+
+        self.version += 1
+        # nobody can catch up across an import with deltas
+        self.history.clear()
+        return {'client_id': client_id, 'type': 'import', 'data': self.store.rows(), 'version': self.version,
+                'epoch': self.epoch,
+                'update': "%s imported %d tasks (%d were already there)" % (client_id, added, len(tasks) - added)}
+
+    def _close(self):
+        """ Flush the task store """
+
+        self.store.close()
+
+    def _error(self, client_id, update):
+        """ Build an error response """
+
+        return {'client_id': client_id, 'update': update, 'type': 'error', 'version': self.version}
+
+    def _changed(self, client_id, update, type, delta, touched):
+        """ Build the response for a command that changed the table.
+            'touched' has (old row, new row) for every task that changed, which the
+            server uses to work out what subscribed clients need to hear """
+
+        self.version += 1
+        return {'client_id': client_id, 'update': update, 'type': type,
+                'version': self.version, 'delta': delta, 'touched': touched}
 
     def connect(self, args, client_id):
         """ This method is responsible for connecting a client """
@@ -55,13 +304,35 @@ class Request(object):
         # parse the args
         client_id = args
         update = "Client %s connected" % client_id
-        s = shelve.open("tasks.db", flag='r')
-        try:
-            data = s['data']
-        finally:
-            s.close()
 
-        return {'update': update, 'client_id': client_id, 'type': 'connect', 'data': data}
+        return {'update': update, 'client_id': client_id, 'type': 'connect',
+                'data': self.store.rows(), 'version': self.version, 'epoch': self.epoch}
+
+    def resync(self, args, client_id):
+        """ This sends the whole table to a client that lost track of the deltas """
+
+        return {'update': "Resynchronized at version %d" % self.version, 'client_id': client_id,
+                'type': 'resync', 'data': self.store.rows(), 'version': self.version, 'epoch': self.epoch}
+
+    def replicate(self, args, client_id):
+        """ This sends the whole table to a replica (see Replica), with the seq of every task,
+            so the replica's copy sorts tasks of the same priority the way we do """
+
+        return {'update': "Replicating at version %d" % self.version, 'client_id': client_id,
+                'type': 'replicate', 'tasks': self.store.records(seq=True),
+                'version': self.version, 'epoch': self.epoch}
+
+    def export(self, args, client_id):
+        """ This sends the whole table as saved records (with numbers for numbers) to the client that asked """
+
+        return {'update': "Exported %d tasks" % len(self.store), 'client_id': client_id, 'type': 'export',
+                'tasks': self.store.records(), 'version': self.version}
+
+    def stats(self, args, client_id):
+        """ This sends the server's metrics to the client that asked for them """
+
+        return {'update': "Server statistics", 'client_id': client_id, 'type': 'stats',
+                'stats': self.metrics.report(), 'version': self.version}
 
     def addTask(self, args, client_id):
         """ This is responsible for adding a new task """
@@ -69,28 +340,15 @@ class Request(object):
         # parse the args
         task_name = args
 
-        # This will load the data and append any new data and write it to the file
-        s = shelve.open("tasks.db", writeback=True)
-        sublist = next((l for l in s['data'] if l[0] == task_name), None)
-        if sublist:
-            try:
-                data = s['data']
-            finally:
-                s.close()
-            return {'client_id': client_id, 'update': "There already exists a task with the name '%s'." % task_name,
-                    'type': 'error', 'data': data}
+        if task_name in self.store:
+            return self._error(client_id, "There already exists a task with the name '%s'." % task_name)
 
-        try:
-            s['data'].append([task_name, '', "5", "0"])
-            # sort the list by priority
-            s['data'].sort(cmp=lambda x,y: cmp(int(x), int(y)), key=itemgetter(2))
-            data = s['data']
-        finally:
-            s.close()
+        # the store keeps the list sorted by priority
+        self.store.add(task_name)
 
-        return {'client_id': client_id,
-            'update': "%s added a task: %s" % (client_id, task_name),
-            'data': data, 'type': 'addTask'}
+        row = self.store.get(task_name).row()
+        return self._changed(client_id, "%s added a task: %s" % (client_id, task_name), 'addTask',
+            [{'op': 'insert', 'index': self.store.position(task_name), 'task': row}], [(None, row)])
 
     def prioritize(self, args, client_id):
         """ This sets the priority for a task given a specific name """
@@ -99,30 +357,31 @@ class Request(object):
         parts = args.split()
         # task name is anything in the middle
         task_name = " ".join(parts[0:-1])
+        if len(parts) < 2:
+            return self._error(client_id, "Usage: prioritize {TaskName} {Priority}")
         # priority is last
         priority = parts[-1]
 
-        s = shelve.open("tasks.db", writeback=True)
+        if task_name not in self.store:
+            return self._error(client_id, 'Cannot find task named "%s"' % task_name)
         try:
-            data = s['data']
-            # find the sublist with the task name
-            sublist = next((l for l in data if l[0] == task_name), None)
-            if not sublist:
-                return {'client_id': client_id, 'update': 'Cannot find task named "%s"' % task_name,
-                    'type': 'error', 'data': data}
-            # change the priorty
-            old = sublist[2]
-            sublist[2] = priority
-            # resort the whole list
-            data.sort(cmp=lambda x,y: cmp(int(x), int(y)), key=itemgetter(2))
-            # update
-            s['data'] = data
-        finally:
-            s.close()
+            priority = int(priority)
+        except ValueError:
+            return self._error(client_id, 'Priority must be a number, not "%s"' % priority)
+        if not Task.RANGE[0] <= priority <= Task.RANGE[1]:
+            return self._error(client_id, "Priority must be between %d and %d" % Task.RANGE)
+        # change the priority, the store resorts the list
+        index = self.store.position(task_name)
+        row = self.store.get(task_name).row()
+        old = self.store.update(task_name, 'priority', priority)
+        delta = [{'op': 'set', 'index': index, 'field': 2, 'value': str(priority)}]
+        new_index = self.store.position(task_name)
+        if new_index != index:
+            delta.append({'op': 'move', 'from': index, 'to': new_index})
 
-        return {'client_id': client_id,
-            'update': "%s changed the priority of '%s': %s -> %s" % (client_id, task_name, old, priority),
-            'data': data, 'type': 'prioritize'}
+        return self._changed(client_id,
+            "%s changed the priority of '%s': %d -> %d" % (client_id, task_name, old, priority),
+            'prioritize', delta, [(row, self.store.get(task_name).row())])
 
     def accept(self, args, client_id):
         """ This accepts a given task (adds to the "completer" field) """
@@ -130,150 +389,1314 @@ class Request(object):
         # parse the args
         task_name = args
 
-        s = shelve.open("tasks.db", writeback=True)
-        try:
-            data = s['data']
-            # find the sublist with the task name
-            sublist = next((l for l in data if l[0] == task_name), None)
-            if not sublist:
-                return {'client_id': client_id, 'update': 'Cannot find task named "%s"' % task_name,
-                    'type': 'error', 'data': data}
-            # change the completer
-            old = sublist[1] or "<NO ONE>"
-            sublist[1] = client_id
-            # no resort needed
-            s['data'] = data
-        finally:
-            s.close()
+        if task_name not in self.store:
+            return self._error(client_id, 'Cannot find task named "%s"' % task_name)
+        # change the completer, no resort needed
+        row = self.store.get(task_name).row()
+        old = self.store.update(task_name, 'completer', client_id) or "<NO ONE>"
 
-        return {'client_id': client_id,
-                'update': "%s accepted the task '%s': %s -> %s" % (client_id, task_name, old, client_id),
-                'data': data, 'type': 'accept'}
+        return self._changed(client_id,
+            "%s accepted the task '%s': %s -> %s" % (client_id, task_name, old, client_id), 'accept',
+            [{'op': 'set', 'index': self.store.position(task_name), 'field': 1, 'value': client_id}],
+            [(row, self.store.get(task_name).row())])
 
     def complete(self, args, client_id):
-        """ This sets the completion column. It does not do any bounds checking (left to the caller) """
+        """ This sets the completion column. It only checks that the value can be kept (Task.RANGE),
+            keeping it a percentage is left to the caller """
 
         # parse the args
         parts = args.split()
         # task name is anything in the middle
         task_name = " ".join(parts[0:-1])
+        if len(parts) < 2:
+            return self._error(client_id, "Usage: complete {TaskName} {CompletionPercent}")
         # completion is last
         completion = parts[-1]
 
-        s = shelve.open("tasks.db", writeback=True)
+        if task_name not in self.store:
+            return self._error(client_id, 'Cannot find task named "%s"' % task_name)
         try:
-            data = s['data']
-            # find the sublist with the task name
-            sublist = next((l for l in data if l[0] == task_name), None)
-            if not sublist:
-                return {'client_id': client_id, 'update': 'Cannot find task named "%s"' % task_name,
-                    'type': 'error', 'data': data}
-            # change the priorty
-            old = sublist[3]
-            sublist[3] = completion
-            # update
-            s['data'] = data
-        finally:
-            s.close()
+            completion = int(completion)
+        except ValueError:
+            return self._error(client_id, 'Completion must be a number, not "%s"' % completion)
+        if not Task.RANGE[0] <= completion <= Task.RANGE[1]:
+            return self._error(client_id, "Completion must be between %d and %d" % Task.RANGE)
+        # change the completion
+        row = self.store.get(task_name).row()
+        old = self.store.update(task_name, 'completion', completion)
+
+        return self._changed(client_id,
+            "%s changed the completion of '%s': %d -> %d" % (client_id, task_name, old, completion), 'complete',
+            [{'op': 'set', 'index': self.store.position(task_name), 'field': 3, 'value': str(completion)}],
+            [(row, self.store.get(task_name).row())])
+
+def check_request(obj):
+    """ Return what is wrong with a decoded request, or None if it is one we can run """
+
+    if not isinstance(obj, dict):
+        return "Requests must be objects"
+    if not isinstance(obj.get('command'), basestring) or not obj['command'].split():
+        return "Requests need a command"
+    if not isinstance(obj.get('client_id'), basestring):
+        return "Requests need a client_id"
+    if obj.get('protocol', 'full') not in ('full', 'delta'):
+        return "The protocol is full or delta"
+    return None
+
+def valid_board(name):
+    """ Return whether a board name is one we can keep files for ('' is the default board) """
+
+    return isinstance(name, basestring) and (name == '' or BOARD_NAME.match(name) is not None)
+
+class Boards(object):
+    """ The boards the server has. Each board has its own tasks, with its own versions
+        and history, so it is a Request of its own. The default board, '', is the one
+        the server always had (saved as tasks.snapshot and tasks.log); the others are saved
+        in 'directory' as NAME.snapshot and NAME.log, so every board writes to its own
+        log and compacts its own snapshot. Boards are opened the first time they are used """
+
+    def __init__(self, default=None, directory="boards", max_boards=100, history=HISTORY):
+        if default is None:
+            default = Request(history=history)
+        self.requests = {default.board: default}
+        self.metrics = default.metrics
+        self.directory = directory
+        self.max_boards = max_boards
+        self.history = history
+        # the other boards save their tasks as often as the default one
+        backend = default.store.backend
+        self.sync_every = getattr(backend, 'sync_every', 1)
+        self.sync_interval = getattr(backend, 'sync_interval', None)
+
+    def __len__(self):
+        return len(self.requests)
+
+    def get(self, name):
+        """ Return the Request of a board, opening the board if it isn't open yet.
+            Raises ValueError if the name isn't valid or there are too many boards """
+
+        request = self.requests.get(name)
+        if request is not None:
+            return request
+        if not valid_board(name):
+            raise ValueError("Board names are 1 to 64 letters, digits, - and _")
+        if len(self.requests) >= self.max_boards:
+            raise ValueError("There can't be more than %d boards" % self.max_boards)
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        store = TaskStore(LogBackend(os.path.join(self.directory, name), sync_every=self.sync_every,
+                                     sync_interval=self.sync_interval, legacy=None))
+        request = self.requests[name] = Request(store, self.metrics, self.history, name)
+        return request
+
+    def close(self):
+        """ Flush every board's task store """
+
+        for request in self.requests.itervalues():
+            request._close()
+
+def listen(host, port):
+    """ Make a non-blocking socket listening on host:port """
 
-        return {'client_id': client_id,
-            'update': "%s changed the completion of '%s': %s -> %s" % (client_id, task_name, old, completion),
-            'data': data, 'type': 'complete'}
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # reuse addr
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # bind
+    server.bind((host, port))
+    # don't block and listen with space for lots of clients connecting at once in the queue
+    server.setblocking(0)
+    server.listen(socket.SOMAXCONN)
+    return server
 
 class SelectServer(object):
-    """ This is a simple socket servert that uses select() to monitor the socket connections """
+    """ This is a simple socket servert that uses select() to monitor the socket connections.
 
-    request = Request()
+        Everything that depends on how sockets are monitored goes through
+        watch/forget/want_read/want_write/wait, so other engines only need to override those.
 
-    def __init__(self, host, port):
+        What the server spends its time on goes into 'metrics' (shared with the request
+        handler): 'loop' is how long each pass of the event loop took after waking up,
+        'json.decode'/'json.encode' are per message and 'broadcast' is per fan-out.
+        With stats_file they are saved every stats_interval seconds. With profile, one
+        in every profile_every passes of the loop runs under cProfile, and the profile
+        is saved to that file along with the stats (and at shutdown).
+
+        Clients choose a board with 'board' in their connect request (the default board
+        is ''), and can connect again with another one to switch. Requests go to the
+        client's board, and broadcasts only go to the clients on the same board.
+        'request' is the default board; the others are opened in board_dir when someone
+        first connects to them, up to max_boards boards """
+
+    def __init__(self, host, port, request=None, max_frame=MAX_FRAME, high_water=HIGH_WATER,
+                 slow='disconnect', listener=None, stats_file=None, stats_interval=10.0,
+                 profile=None, profile_every=100, board_dir="boards", max_boards=100):
         self.host = host
         self.port = port
+        self.max_frame = max_frame
+        # what happens to clients that don't keep up with what we send them:
+        # 'disconnect' drops them, 'throttle' stops reading their requests until they catch up
+        # (and still drops them if they get four times as far behind)
+        # no high water mark means clients can fall behind as far as they like
+        self.high_water = high_water
+        self.slow = slow
+        # the request handler owns the task store
+        # (workers don't have one, they forward requests to the process that does)
+        if request is None:
+            request = Request()
+        self.request = request
+        # (the other boards keep as much history as the default one)
+        self.boards = request and Boards(request, board_dir, max_boards, request.history.maxlen)
+
+        # workers share a listening socket made by their parent, False means don't listen at all
+        if listener is None:
+            listener = listen(self.host, self.port)
+        self.server = listener
+
+        # the sockets we select for reading and writing
+        self.read = []
+        self.write = []
+        # clients that sent at least one request (the ones that get broadcasts)
+        self.clients = set()
+        # the board each client's requests go to, the board it gets broadcasts from,
+        # and the clients that get each board's broadcasts
+        self.board_of = {}
+        self.joined = {}
+        self.members = {}
+        # 'full' clients get the whole table with every message, 'delta' clients only get what changed
+        self.protocols = {}
+        # clients that asked for the binary format at connect (see wire.py), everybody else speaks JSON
+        self.formats = {}
+        # what subscribed clients are looking at ('window' clients, see subscribe())
+        self.viewports = {}
+        # bytes received from each client that don't make a whole line yet
+        self.buffers = {}
+        # messages waiting to be sent to each client, and how many bytes that is
+        # (only clients with something queued are watched for writing)
+        self.outgoing = {}
+        self.queued = {}
+        # clients we stopped reading from because they are too far behind
+        self.throttled = set()
+        # sockets that aren't clients, and what to call when they are readable
+        self.handlers = {}
+        self.running = True
+
+        self.metrics = request and request.metrics or Metrics()
+        self.metrics.gauge('connections', lambda: len(self.buffers))
+        self.metrics.gauge('clients', lambda: len(self.clients))
+        if self.boards:
+            self.metrics.gauge('boards', lambda: len(self.boards))
+        self.metrics.gauge('throttled', lambda: len(self.throttled))
+        # how far behind clients are with what we send them
+        self.metrics.gauge('queued.bytes', lambda: sum(self.queued.itervalues()))
+        self.metrics.gauge('queued.max', lambda: max(self.queued.itervalues() or [0]))
+        self.metrics.gauge('queued.clients', lambda: len([q for q in self.queued.itervalues() if q]))
+        self.stats_file = stats_file
+        self.stats_interval = stats_interval
+        self.next_dump = time.time() + stats_interval
+        self.profile = profile
+        self.profile_every = profile_every
+        self.profiler = None
+        if profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+        self.passes = 0
+
+        if self.server:
+            self.handlers[self.server] = self.accept
+            self.watch(self.server)
+
+    def watch(self, sock):
+        """ Start watching a socket for reading """
+
+        self.read.append(sock)
 
-        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        # reuse addr
-        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        # bind
-        self.server.bind((self.host, self.port))
-        # don't block and listen with space for 5 in the queue
-        self.server.setblocking(0)
-        self.server.listen(5)
+    def forget(self, sock):
+        """ Stop watching a socket altogether """
 
-        self.read = [self.server]
-        self.clients = []
+        for l in (self.read, self.write):
+            if sock in l:
+                l.remove(sock)
+
+    def want_read(self, sock, wanted):
+        """ Start or stop watching a socket for reading """
+
+        if wanted:
+            self.read.append(sock)
+        else:
+            self.read.remove(sock)
+
+    def want_write(self, sock, wanted):
+        """ Start or stop watching a socket for writing """
+
+        if wanted:
+            self.write.append(sock)
+        else:
+            self.write.remove(sock)
+
+    def wait(self, timeout):
+        """ Wait for sockets to become readable/writable, returns (readable, writable, error) """
+
+        return select.select(self.read, self.write, self.read, timeout)
 
     def run(self):
+        while self.running:
+            # wake up now and then so stop() is noticed
+            readable, writable, error = self.wait(1.0)
+            start = time.time()
+
+            self.passes += 1
+            if self.profiler and self.passes % self.profile_every == 0:
+                self.profiler.enable()
+                self.dispatch(readable, writable, error)
+                self.profiler.disable()
+            else:
+                self.dispatch(readable, writable, error)
+
+            now = time.time()
+            self.metrics.observe('loop', now - start)
+            if (self.stats_file or self.profiler) and now >= self.next_dump:
+                self.dump_stats()
+
+    def dispatch(self, readable, writable, error):
+        """ Deal with the sockets that are ready """
+
+        for sock in readable:
+            # A new client has connected (or some other socket we look after)
+            if sock in self.handlers:
+                self.handlers[sock]()
+            elif sock in self.buffers:
+                # a client has sent some data, read it and broadcast
+                self.receive(sock)
+
+        for sock in writable:
+            # send as much of what's queued for the socket as it will take
+            if sock in self.outgoing:
+                self.flush(sock)
+
+        for sock in error:
+            # If a socket appears closed, remove it from out list and close it on our end
+            self.drop(sock)
+
+    def accept(self):
+        """ Accept every client that is waiting to connect """
+
         while True:
-            readable, writable, error = select.select(self.read, self.clients, self.read)
-
-            for sock in readable:
-                # A new client has connected
-                if sock == self.server:
-                    connection, client_address = sock.accept()
-                    connection.setblocking(0)
-                    self.read.append(connection)
-                else:
-                    # a client has sent some data, read it and broadcast
-                    data = sock.makefile().readline().rstrip()
-                    if data:
-                        # if we aren't already tracking this client, add them here
-                        if sock not in self.clients:
-                            self.clients.append(sock)
-                        data = SelectServer.request._call(data)
-                        # If the call generated an error, return only to the sender
-                        if data['type'] == 'error':
-                            self.broadcast_to_clients(json.dumps(data) + "\n", to=sock)
-                        else:
-                            self.broadcast_to_clients(json.dumps(data) + "\n")
-                    else:
-                        # there was no data sent from the client, remove them and close the socket
-                        if sock in self.clients:
-                            self.clients.remove(sock)
-                        self.read.remove(sock)
-                        sock.close()
-
-            for sock in writable:
-                # we write to our clients when a new connection comes in and does something
-                # We don't wait to broadcast at a later time, we just fire a message off right away
-                pass
+            try:
+                connection, client_address = self.server.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                raise
+            self.track(connection)
+
+    def track(self, sock):
+        """ Start looking after a client's socket """
+
+        sock.setblocking(0)
+        self.buffers[sock] = ""
+        self.outgoing[sock] = []
+        self.queued[sock] = 0
+        self.watch(sock)
+
+    def receive(self, sock):
+        """ Read whatever a client has sent and handle every complete request in it:
+            lines of JSON, or frames once the client has asked for the binary format.
+            A partial request stays buffered until the rest of it arrives """
+
+        try:
+            chunk = sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            chunk = ""
+        if not chunk:
+            # there was no data sent from the client, remove them and close the socket
+            self.drop(sock)
+            return
+        self.metrics.count('bytes.in', len(chunk))
+
+        data = self.buffers[sock] + chunk
+        pos = 0
+        # the client may have gone away while we were handling an earlier request
+        while sock in self.buffers:
+            format = self.formats.get(sock, 'json')
+            if format == 'binary':
+                if len(data) - pos < wire.HEADER.size:
+                    break
+                length = wire.HEADER.unpack_from(data, pos)[0]
+                if length > self.max_frame:
+                    self.too_long(sock)
+                    return
+                start = pos + wire.HEADER.size
+                if len(data) - start < length:
+                    break
+                request, pos = data[start:start + length], start + length
+                decode = wire.unpackb
+            else:
+                end = data.find("\n", pos)
+                if end < 0:
+                    break
+                request, pos = data[pos:end].rstrip(), end + 1
+                if len(request) > self.max_frame:
+                    self.too_long(sock)
+                    return
+                if not request:
+                    continue
+                decode = json.loads
 
-            for sock in error:
-                # If a socket appears closed, remove it from out list and close it on our end
-                self.read.remove(sock)
-                if sock in self.clients:
-                    self.clients.remove(sock)
-                sock.close()
+            start = time.time()
+            try:
+                obj = decode(request)
+                self.metrics.observe(format + '.decode', time.time() - start)
+            except ValueError:
+                self.broadcast_to_clients({'update': "Requests must be %s" % (format == 'json' and "JSON" or
+                                           "msgpack frames"), 'type': 'error', 'client_id': ''}, to=sock)
+                continue
+            problem = self.check(obj)
+            if problem:
+                error = {'update': problem, 'type': 'error', 'client_id': ''}
+                if isinstance(obj, dict) and 'id' in obj:
+                    error['id'] = obj['id']
+                self.broadcast_to_clients(error, to=sock)
+                continue
+            # a client switches to the binary format with its connect request, so
+            # everything after this one is framed (even what was sent along with it)
+            if obj.get('format') in wire.FORMATS and obj.get('command', '').startswith('connect'):
+                self.formats[sock] = obj['format']
+            # connecting chooses the board everything after it goes to
+            if obj.get('command', '').startswith('connect'):
+                if not valid_board(obj.get('board', '')):
+                    error = {'update': "Board names are 1 to 64 letters, digits, - and _", 'type': 'error',
+                             'client_id': obj.get('client_id', '')}
+                    if 'id' in obj:
+                        error['id'] = obj['id']
+                    self.broadcast_to_clients(error, to=sock)
+                    continue
+                self.board_of[sock] = obj.get('board', '')
+            # if we aren't already tracking this client, add them here
+            self.clients.add(sock)
+            if sock not in self.joined:
+                self.join(sock, self.board_of.get(sock, ''))
+            if obj.get('command', '').split()[:1] == ['subscribe']:
+                self.subscribe(sock, obj)
+            else:
+                self.handle(sock, obj)
+
+        if sock in self.buffers:
+            self.buffers[sock] = data[pos:]
+            if len(self.buffers[sock]) > self.max_frame + wire.HEADER.size:
+                self.too_long(sock)
+
+    def check(self, obj):
+        """ Return what is wrong with a decoded request, or None if we can run it """
+
+        return check_request(obj)
+
+    def too_long(self, sock):
+        """ Tell a client its request was too long and disconnect it """
+
+        self.broadcast_to_clients({'update': "Requests can't be longer than %d bytes" % self.max_frame,
+                                   'type': 'error', 'client_id': ''}, to=sock)
+        # one last try at getting the error out before we hang up
+        self.flush(sock)
+        self.drop(sock)
+
+    def handle(self, sock, obj):
+        """ Run a decoded request from a client and send the response where it belongs """
+
+        self.respond(sock, self.call(self.board_of.get(sock, ''), obj), obj.get('protocol', 'full'))
+
+    def call(self, board, obj):
+        """ Run a request against a board, returns the response (with the request's 'id', if it had one) """
+
+        try:
+            data = self.boards.get(board)._call(obj)
+        except ValueError, e:
+            data = {'client_id': obj.get('client_id', ''), 'update': str(e), 'type': 'error',
+                    'version': 0, 'board': board}
+        if 'id' in obj:
+            data['id'] = obj['id']
+        return data
+
+    def join(self, sock, board):
+        """ Make a client get the broadcasts of a board, instead of the one it was on """
+
+        old = self.joined.get(sock)
+        if old == board:
+            return
+        if old is not None:
+            self.members[old].discard(sock)
+            if not self.members[old]:
+                del self.members[old]
+            # what it was looking at is on the other board
+            self.viewports.pop(sock, None)
+        self.joined[sock] = board
+        self.members.setdefault(board, set()).add(sock)
 
-    def broadcast_to_clients(self, msg, omit=None, to=None):
-        """ This will broadcast a message to all clients, except those that match omit.
-            Optionally, send a message to only 1 client using 'to' """
+    def leave(self, sock):
+        """ Stop a client getting the broadcasts of its board """
+
+        board = self.joined.pop(sock, None)
+        if board is not None:
+            self.members[board].discard(sock)
+            if not self.members[board]:
+                del self.members[board]
+
+    def subscribe(self, sock, obj):
+        """ Make a client a 'window' client, that only gets the rows it is looking at:
+
+            {'command': "subscribe", 'client_id': "Nick", 'offset': 0, 'limit': 50,
+             'completer': "Nick", 'completion': [0, 99]}
+
+            (completer and completion are optional filters). The response has the
+            viewport's 'rows', the 'offset' of the first one and the 'total' number of
+            rows that pass the filter. After that, the client gets every change with a
+            'delta' that only has the changes to the rows it has (indexes are into the
+            viewport), or the whole viewport again if rows moved in or out of it.
+            Scrolling is subscribing again with another offset """
+
+        try:
+            viewport = Viewport(obj.get('offset', 0), obj.get('limit', 50), obj.get('completer'),
+                                obj.get('completion'))
+        except (TypeError, ValueError, OverflowError):
+            # (OverflowError is int() of an infinite number)
+            error = {'client_id': obj.get('client_id', ''), 'type': 'error',
+                     'update': "offset and limit must be numbers, completer a name, completion [low, high]"}
+            if 'id' in obj:
+                error['id'] = obj['id']
+            self.broadcast_to_clients(error, to=sock)
+            return
+
+        board = self.joined.get(sock, '')
+        rows = self.rows(board)
+        old = self.viewports.get(sock)
+        if old and old.same_filter(viewport):
+            # scrolling doesn't change how many rows there are
+            viewport.total = old.total
+        else:
+            viewport.count(rows)
+        viewport.fetch(rows)
+        self.viewports[sock] = viewport
+        self.protocols[sock] = 'window'
+
+        data = {'client_id': obj.get('client_id', ''), 'type': 'subscribe', 'version': self.version(board),
+                'board': board,
+                'update': "Showing %d of %d rows from row %d" % (len(viewport.rows), viewport.total,
+                                                                 viewport.offset)}
+        if 'id' in obj:
+            data['id'] = obj['id']
+        data.update(viewport.window())
+        self.queue(sock, self.encode(data, 'window', format=self.formats.get(sock, 'json')))
+
+    def respond(self, sock, data, protocol='full'):
+        """ Send a response to the clients it belongs to.
+            sock is the client that made the request, or None if it isn't one of ours """
+
+        # what changed, for subscribed clients
+        touched = data.pop('touched', None)
+        # the request's id goes back with what only goes to the sender
+        mine = {}
+        if 'id' in data:
+            mine['id'] = data.pop('id')
+        # errors from a batch only go back to the sender, in its response if it has an id
+        errors = data.pop('errors', None)
+        if errors and sock:
+            if mine:
+                mine['errors'] = errors
+            else:
+                for error in errors:
+                    self.broadcast_to_clients({'client_id': data['client_id'], 'update': error, 'type': 'error',
+                                               'version': data['version']}, to=sock)
+
+        if data['type'] == 'connect':
+            # a delta client needs the whole table once (or what it missed, if it is reconnecting),
+            # everybody else just hears about it
+            omit = ()
+            if sock:
+                self.join(sock, data['board'])
+                self.protocols[sock] = protocol
+                if protocol == 'delta' or mine:
+                    self.broadcast_to_clients(dict(data, **mine), to=sock, snapshot='delta' not in data)
+                    omit = (sock,)
+            if 'delta' in data:
+                data = dict(data)
+                del data['delta'], data['base']
+            self.broadcast_to_clients(data, omit=omit)
+            return
+
+        # If the call generated an error, return only to the sender
+        if data['type'] in PRIVATE_TYPES:
+            if sock:
+                self.broadcast_to_clients(dict(data, **mine), to=sock)
+        elif mine and sock:
+            self.broadcast_to_clients(data, omit=(sock,), touched=touched)
+            self.broadcast_to_clients(dict(data, **mine), to=sock, touched=touched)
+        else:
+            self.broadcast_to_clients(data, touched=touched)
+
+    def drop(self, sock):
+        """ Stop tracking a client and close its socket """
+
+        if sock not in self.buffers:
+            return
+        self.forget(sock)
+        self.clients.discard(sock)
+        self.throttled.discard(sock)
+        self.leave(sock)
+        for d in (self.protocols, self.formats, self.viewports, self.board_of, self.buffers,
+                  self.outgoing, self.queued):
+            d.pop(sock, None)
+        sock.close()
+
+    def queue(self, sock, msg):
+        """ Queue a message for a client. It is sent once the socket is writable """
+
+        if sock not in self.outgoing:
+            return
+        if not self.queued[sock]:
+            self.want_write(sock, True)
+        self.outgoing[sock].append(msg)
+        self.queued[sock] += len(msg)
+
+        if sock in self.buffers and self.high_water and self.queued[sock] > self.high_water:
+            # even a throttled client only gets so much slack
+            if self.slow == 'throttle' and self.queued[sock] <= 4 * self.high_water:
+                # don't take any more requests from them until they catch up
+                if sock not in self.throttled:
+                    self.want_read(sock, False)
+                    self.throttled.add(sock)
+            else:
+                self.drop(sock)
+
+    def flush(self, sock):
+        """ Send what we can of a client's queue, keeping the rest for later """
+
+        data = "".join(self.outgoing[sock])
+        try:
+            sent = sock.send(data)
+        except socket.error, e:
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.drop(sock)
+                return
+            sent = 0
+        self.metrics.count('bytes.out', sent)
+
+        data = data[sent:]
+        self.outgoing[sock] = data and [data] or []
+        self.queued[sock] = len(data)
+        if not data:
+            self.want_write(sock, False)
+        # a throttled client that has caught up can send requests again
+        if sock in self.throttled and self.queued[sock] <= self.high_water // 2:
+            self.throttled.remove(sock)
+            self.want_read(sock, True)
+
+    def table(self, board=''):
+        """ Return a board's whole task table """
+
+        request = self.boards.requests.get(board)
+        return request and request.store.rows() or []
+
+    def rows(self, board=''):
+        """ Return a board's task table as a sequence of rows, for viewports """
+
+        request = self.boards.requests.get(board)
+        return request and StoreRows(request.store) or []
+
+    def version(self, board=''):
+        """ Return the version of a board's task table """
+
+        request = self.boards.requests.get(board)
+        return request and request.version or 0
+
+    def encode(self, data, protocol, snapshot=False, format='json'):
+        """ Encode a response for a client speaking the given protocol, in the given format.
+            Window clients get neither the whole table nor its delta: what they get
+            instead is already in the response (see window()) """
+
+        data = dict(data)
+        if protocol == 'window' or data['type'] in ANSWER_TYPES:
+            data.pop('data', None)
+        elif protocol == 'delta' and not snapshot and data['type'] not in TABLE_TYPES:
+            data.pop('data', None)
+        else:
+            data.pop('delta', None)
+            if 'data' not in data:
+                data['data'] = self.table(data.get('board', ''))
+        start = time.time()
+        if format == 'binary':
+            msg = wire.frame(data)
+        else:
+            msg = json.dumps(data) + "\n"
+        self.metrics.observe(format + '.encode', time.time() - start)
+        return msg
+
+    def window(self, sock, data, rows, touched=None):
+        """ Turn a response into what a window client needs to hear about it, given what
+            changed (if it changed the table). Returns the response, and just the part of
+            it that is about the client's viewport (None if it doesn't change it) """
+
+        viewport = self.viewports[sock]
+        change = None
+        if data['type'] in TABLE_TYPES:
+            # the whole table is new to them, so is the whole viewport
+            viewport.count(rows)
+            viewport.fetch(rows)
+            change = viewport.window()
+        elif touched is not None:
+            change = viewport.change(rows, data.get('delta', ()), touched)
+
+        data = dict(data)
+        data.pop('delta', None)
+        if touched is not None:
+            # even if nothing they can see changed, the version did
+            data['delta'] = []
+        if change:
+            data.update(change)
+        return data, change
+
+    def broadcast_to_clients(self, data, omit=None, to=None, snapshot=False, touched=None):
+        """ This will broadcast a response to all clients, except those that match omit.
+            Optionally, send a message to only 1 client using 'to'.
+            Broadcasts only go to the clients on the response's board.
+            The response is encoded once for each protocol and format in use
+            (and for window clients, once for each different change to their viewports).
+            touched is what changed, if the response is to a command that changed the table """
 
         if not omit:
             omit = ()
 
         # if we're only sending to one, do it here
         if to:
-            next(s for s in self.clients if s == to).send(msg)
+            if 'board' not in data:
+                data = dict(data, board=self.joined.get(to, ''))
+            protocol, format = self.protocols.get(to, 'full'), self.formats.get(to, 'json')
+            if protocol == 'window':
+                data = self.window(to, data, self.rows(data['board']), touched)[0]
+            self.queue(to, self.encode(data, protocol, snapshot, format))
             return
 
         # otherwise, loop through all clients, omitting those that are specified
-        for c in self.clients:
+        # (slow clients can get dropped along the way, so loop over a copy)
+        start = time.time()
+        messages = {}
+        sent = 0
+        rows = None
+        for c in list(self.members.get(data['board'], ())):
             if c in omit:
                 continue
-            c.send(msg)
+            protocol, format = self.protocols.get(c, 'full'), self.formats.get(c, 'json')
+            if protocol == 'window':
+                if rows is None:
+                    rows = self.rows(data['board'])
+                msg, change = self.window(c, data, rows, touched)
+                kind = (protocol, format, change and json.dumps(change, sort_keys=True))
+                if kind not in messages:
+                    messages[kind] = self.encode(msg, protocol, format=format)
+            else:
+                kind = (protocol, format)
+                if kind not in messages:
+                    messages[kind] = self.encode(data, protocol, snapshot, format)
+            self.queue(c, messages[kind])
+            sent += len(messages[kind])
+        self.metrics.observe('broadcast', time.time() - start)
+        self.metrics.count('bytes.broadcast', sent)
+
+    def dump_stats(self):
+        """ Save the metrics (and the profile, if there is one) """
+
+        self.next_dump = time.time() + self.stats_interval
+        if self.stats_file:
+            self.metrics.dump(self.stats_file)
+        if self.profiler:
+            self.profiler.dump_stats(self.profile)
+
+    def stop(self):
+        """ Make run() return (from another thread) """
+
+        self.running = False
 
     def shutdown(self):
         """ Close all socket connections """
 
-        for s in self.clients + self.read:
+        if self.stats_file or self.profiler:
+            self.dump_stats()
+        for s in self.buffers.keys() + self.handlers.keys():
             s.close()
+        if self.boards:
+            self.boards.close()
+
+class EpollServer(SelectServer):
+    """ This is the same server, but it monitors the sockets with epoll (Linux only).
+
+        Sockets stay registered between calls, so a wakeup costs as much as the
+        number of sockets that are ready rather than the number of connections,
+        and there is no FD_SETSIZE limit on the number of clients """
+
+    def __init__(self, *args, **kwargs):
+        self.epoll = select.epoll()
+        # fd -> socket, and fd -> the events we are watching it for
+        self.sockets = {}
+        self.events = {}
+        SelectServer.__init__(self, *args, **kwargs)
+
+    def watch(self, sock):
+        fd = sock.fileno()
+        self.sockets[fd] = sock
+        self.events[fd] = select.EPOLLIN
+        self.epoll.register(fd, select.EPOLLIN)
+
+    def forget(self, sock):
+        fd = sock.fileno()
+        if fd in self.sockets:
+            self.epoll.unregister(fd)
+            del self.sockets[fd]
+            del self.events[fd]
+
+    def _modify(self, sock, event, wanted):
+        fd = sock.fileno()
+        if wanted:
+            self.events[fd] |= event
+        else:
+            self.events[fd] &= ~event
+        self.epoll.modify(fd, self.events[fd])
+
+    def want_read(self, sock, wanted):
+        self._modify(sock, select.EPOLLIN, wanted)
+
+    def want_write(self, sock, wanted):
+        self._modify(sock, select.EPOLLOUT, wanted)
+
+    def wait(self, timeout):
+        readable, writable, error = [], [], []
+        try:
+            events = self.epoll.poll(timeout)
+        except IOError, e:
+            if e.args[0] != errno.EINTR:
+                raise
+            events = []
+        for fd, event in events:
+            sock = self.sockets[fd]
+            # a hang up reads as end of file, which drops the client
+            if event & (select.EPOLLIN | select.EPOLLHUP):
+                readable.append(sock)
+            elif event & select.EPOLLERR:
+                error.append(sock)
+            if event & select.EPOLLOUT:
+                writable.append(sock)
+        return readable, writable, error
+
+    def shutdown(self):
+        SelectServer.shutdown(self)
+        self.epoll.close()
+
+# The engines that can be chosen with --engine
+ENGINES = {'select': SelectServer}
+if hasattr(select, 'epoll'):
+    ENGINES['epoll'] = EpollServer
+
+class StoreOwner(SelectServer):
+    """ In multi-process mode this process owns the task store and runs every request,
+        one at a time. It doesn't listen for clients: its clients are the workers,
+        connected with a socketpair each, and they forward every request they get.
+
+        Requests arrive wrapped as {'worker': 0, 'conn': 12, 'protocol': 'delta', 'board': '', 'request': {...}}
+        and go back with 'response' instead of 'request'. Private responses only go back to the
+        worker that asked; everything else goes to every worker, encoded once.
+
+        Workers keep their own copy of the table of every board they have heard of, and
+        bring it up to date with the delta of every change (see Worker.apply), so the
+        whole table only goes with resync and import responses, and with the first
+        response about a board a worker gets. """
+
+    def __init__(self, links, request, **kwargs):
+        # workers are never too slow to keep, they're part of the server
+        SelectServer.__init__(self, None, None, request, high_water=None, listener=False, **kwargs)
+        # the boards each worker has a copy of
+        self.copies = {}
+        for link in links:
+            self.track(link)
+            self.copies[link] = set()
+
+    def check(self, envelope):
+        # the workers only forward requests that passed their check
+        return None
+
+    def handle(self, link, envelope):
+        data = self.call(envelope.pop('board', ''), envelope.pop('request'))
+        links = data['type'] in PRIVATE_TYPES and [link] or self.buffers.keys()
+        messages = {}
+        for l in links:
+            table = data['type'] != 'error' and (data['type'] in TABLE_TYPES or data['board'] not in self.copies[l])
+            if table not in messages:
+                envelope['response'] = table and dict(data, data=self.table(data['board'])) or data
+                messages[table] = json.dumps(envelope) + "\n"
+            if table:
+                self.copies[l].add(data['board'])
+            self.queue(l, messages[table])
+
+class Worker(object):
+    """ In multi-process mode each worker accepts clients on the listening socket it
+        shares with the other workers, and does all the reading, parsing, encoding and
+        sending for them. Requests are forwarded to the StoreOwner over 'link', and the
+        responses that come back are handed out to this worker's clients.
+
+        This is mixed into an engine with worker_engine() """
+
+    def __init__(self, number, link, *args, **kwargs):
+        self.number = number
+        self.link = link
+        self.link_buffer = ""
+        # connections get ids, so a response can't go to a new client that reused a closed fd
+        self.conn_ids = {}
+        self.conns = {}
+        self.next_conn = 0
+        # board -> our copy of its table and its version
+        self.latest = {}
+        super(Worker, self).__init__(*args, **kwargs)
+
+        link.setblocking(0)
+        self.outgoing[link] = []
+        self.queued[link] = 0
+        self.handlers[link] = self.receive_link
+        self.watch(link)
+        # the first response about a board has its table, but we need the default one before anything happens
+        self.queue(link, json.dumps({'worker': number, 'conn': 0, 'protocol': 'full', 'board': '',
+                                     'request': {'command': 'resync', 'client_id': ''}}) + "\n")
+
+    def table(self, board=''):
+        return self.latest.get(board, ([], 0))[0]
+
+    def rows(self, board=''):
+        return self.table(board)
+
+    def version(self, board=''):
+        return self.latest.get(board, ([], 0))[1]
+
+    def handle(self, sock, obj):
+        """ Forward a request to the store owner """
+
+        if sock not in self.conn_ids:
+            self.next_conn += 1
+            self.conn_ids[sock] = self.next_conn
+            self.conns[self.next_conn] = sock
+        if obj['command'].split()[0] == 'connect':
+            # the response has the table (or delta) as of when the store owner got the request, so
+            # the client doesn't need the changes before it, and they would go to it as a full client
+            self.leave(sock)
+        self.queue(self.link, json.dumps({'worker': self.number, 'conn': self.conn_ids[sock],
+                                          'protocol': obj.get('protocol', 'full'),
+                                          'board': self.board_of.get(sock, ''), 'request': obj}) + "\n")
+
+    def receive_link(self):
+        """ Hand out the responses the store owner sent us """
+
+        try:
+            chunk = self.link.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            chunk = ""
+        if not chunk:
+            # the store owner has gone away, there's nothing we can do without it
+            self.stop()
+            return
+
+        lines = (self.link_buffer + chunk).split("\n")
+        self.link_buffer = lines.pop()
+        for line in lines:
+            envelope = json.loads(line)
+            self.apply(envelope['response'])
+            sock = None
+            if envelope['worker'] == self.number:
+                sock = self.conns.get(envelope['conn'])
+            self.respond(sock, envelope['response'], envelope['protocol'])
+
+    def apply(self, response):
+        """ Bring our copy of a board's table up to date with a response from the store owner """
+
+        board = response['board']
+        if 'data' in response:
+            self.latest[board] = (response['data'], response['version'])
+        elif response['type'] in Request.CHANGES and board in self.latest:
+            rows = self.latest[board][0]
+            for change in response['delta']:
+                if change['op'] == 'insert':
+                    rows.insert(change['index'], list(change['task']))
+                elif change['op'] == 'set':
+                    rows[change['index']][change['field']] = change['value']
+                elif change['op'] == 'move':
+                    rows.insert(change['to'], rows.pop(change['from']))
+            self.latest[board] = (rows, response['version'])
+
+    def drop(self, sock):
+        conn = self.conn_ids.pop(sock, None)
+        if conn is not None:
+            del self.conns[conn]
+        super(Worker, self).drop(sock)
+
+def worker_engine(engine):
+    """ Return a worker server class that monitors its sockets like the given engine """
+
+    return type(engine.__name__.replace("Server", "Worker"), (Worker, engine), {})
+
+def serve_workers(engine, workers, host, port, stats_file=None, stats_interval=10.0, profile=None,
+                  profile_every=100, history=HISTORY, board_dir="boards", max_boards=100, sync_every=1,
+                  sync_interval=None, **kwargs):
+    """ Run the server as 'workers' worker processes sharing one listening socket,
+        with this process owning the task store (saved with the given group commit, see LogBackend).
+
+        Every process keeps its own metrics; workers save theirs (and their profiles)
+        to the given files with .workerN added to the name """
+
+    listener = listen(host, port)
+    links, pids = [], []
+    for number in xrange(workers):
+        ours, theirs = socket.socketpair()
+        pid = os.fork()
+        if pid == 0:
+            # the worker doesn't need the other workers' links
+            for link in links + [ours]:
+                link.close()
+            server = worker_engine(engine)(number, theirs, host, port, request=False, listener=listener,
+                                           stats_file=stats_file and "%s.worker%d" % (stats_file, number),
+                                           stats_interval=stats_interval,
+                                           profile=profile and "%s.worker%d" % (profile, number),
+                                           profile_every=profile_every, **kwargs)
+            try:
+                server.run()
+            except KeyboardInterrupt:
+                pass
+            server.shutdown()
+            os._exit(0)
+        theirs.close()
+        links.append(ours)
+        pids.append(pid)
+    # only the workers accept clients
+    listener.close()
+
+    # the store is only opened once the workers are gone off on their own
+    store = TaskStore(LogBackend(sync_every=sync_every, sync_interval=sync_interval))
+    owner = StoreOwner(links, Request(store, history=history), stats_file=stats_file, stats_interval=stats_interval,
+                       profile=profile, profile_every=profile_every, board_dir=board_dir, max_boards=max_boards)
+    try:
+        owner.run()
+    finally:
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+        owner.shutdown()
+
+class Replica(object):
+    """ A read-only copy of one board of another server (the primary), that serves its
+        own clients from it. It connects to the primary as a delta client of that board,
+        and gets the whole table once with the replicate command, then every change in
+        order. Changes are applied to an in-memory copy of the table and broadcast to
+        our clients the way the primary broadcasts them to its own, so connect, resync,
+        subscribe, query and stats never reach the primary.
+
+        Commands that change the table are forwarded to the primary with an 'id' that
+        says which of our clients sent them, and whatever the primary sends back with
+        that id goes to that client (with the id it sent, if any). A gap in the versions
+        means we missed something, and we ask for the whole table again.
+
+        Versions and the epoch are the primary's, so clients can reconnect to another
+        replica (or the primary) and only get what they missed.
+
+        This is mixed into an engine with replica_engine() """
+
+    def __init__(self, primary, board, host, port, history=HISTORY, **kwargs):
+        self.upstream_buffer = ""
+        # connections get ids, so a response can't go to a new client that reused a closed fd
+        self.conn_ids = {}
+        self.conns = {}
+        self.next_conn = 0
+        # changes are ignored until the table they follow on from arrives
+        self.resyncing = True
+        request = Request(TaskStore(MemoryBackend()), history=history, board=board)
+        super(Replica, self).__init__(host, port, request, **kwargs)
+
+        self.upstream = socket.create_connection(primary)
+        self.upstream.setblocking(0)
+        self.outgoing[self.upstream] = []
+        self.queued[self.upstream] = 0
+        self.handlers[self.upstream] = self.receive_upstream
+        self.watch(self.upstream)
+        name = "replica-%s-%s" % (socket.gethostname(), port)
+        self.send_upstream({'command': "connect " + name, 'client_id': name, 'protocol': 'delta',
+                            'board': board})
+        self.send_upstream({'command': "replicate", 'client_id': name})
+
+    def send_upstream(self, obj):
+        self.queue(self.upstream, json.dumps(obj) + "\n")
+
+    def call(self, board, obj):
+        if board != self.request.board:
+            data = {'client_id': obj.get('client_id', ''), 'type': 'error', 'version': 0, 'board': board,
+                    'update': "This replica only has the %s board" % (self.request.board and
+                                                                       "'%s'" % self.request.board or "default")}
+            if 'id' in obj:
+                data['id'] = obj['id']
+            return data
+        return super(Replica, self).call(board, obj)
+
+    def handle(self, sock, obj):
+        """ Forward the commands that change the table to the primary, and run the rest here """
+
+        command = obj.get('command', '').split()[:1]
+        if not command or command[0] not in Request.WRITES or self.board_of.get(sock, '') != self.request.board:
+            super(Replica, self).handle(sock, obj)
+            return
+
+        if sock not in self.conn_ids:
+            self.next_conn += 1
+            self.conn_ids[sock] = self.next_conn
+            self.conns[self.next_conn] = sock
+        obj = dict(obj, id=[self.conn_ids[sock]] + ('id' in obj and [obj['id']] or []))
+        self.send_upstream(obj)
+
+    def receive_upstream(self):
+        """ Apply what the primary sent us, and pass it on to our clients """
+
+        try:
+            chunk = self.upstream.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            chunk = ""
+        if not chunk:
+            # there's no table to serve without the primary
+            self.stop()
+            return
+
+        lines = (self.upstream_buffer + chunk).split("\n")
+        self.upstream_buffer = lines.pop()
+        for line in lines:
+            msg = json.loads(line)
+            # put back the id of the client the response is for
+            sock = None
+            if 'id' in msg:
+                ids = msg.pop('id')
+                sock = self.conns.get(ids[0])
+                if len(ids) > 1:
+                    msg['id'] = ids[1]
+
+            if msg['type'] == 'replicate':
+                self.bootstrap(msg)
+            elif msg['type'] in Request.CHANGES:
+                touched = None
+                if not self.resyncing:
+                    touched = self.apply(msg)
+                    if touched is None:
+                        # we missed something (or got it wrong), start again from the whole table
+                        self.resyncing = True
+                        self.send_upstream({'command': "replicate", 'client_id': ''})
+                if touched is None:
+                    if sock:
+                        self.catching_up(sock, msg)
+                    continue
+                self.respond(sock, dict(msg, touched=touched), self.protocols.get(sock, 'full'))
+            elif msg['type'] == 'import':
+                # the seq of every task is needed to keep up with what comes next
+                if not self.resyncing:
+                    self.resyncing = True
+                    self.send_upstream({'command': "replicate", 'client_id': ''})
+                if sock:
+                    self.broadcast_to_clients(msg, to=sock)
+            elif msg['type'] == 'error' and sock:
+                self.broadcast_to_clients(msg, to=sock)
+
+    def catching_up(self, sock, msg):
+        """ Answer one of our clients whose change the primary made while we're getting the whole
+            table again: we can't pass the change on, but the client still gets one response """
+
+        error = {'client_id': msg['client_id'], 'type': 'error', 'version': self.request.version,
+                 'board': self.request.board,
+                 'update': "%s, but this replica is catching up with the primary (everybody gets the "
+                           "whole table when it has)" % msg['update']}
+        if 'id' in msg:
+            error['id'] = msg['id']
+        self.broadcast_to_clients(error, to=sock)
+
+    def bootstrap(self, msg):
+        """ Start again from the whole table, and send it to our clients """
+
+        request = self.request
+        request.store.close()
+        request.store = TaskStore(MemoryBackend(msg['tasks']))
+        request.store.metrics = request.metrics
+        request.version, request.epoch = msg['version'], msg['epoch']
+        request.history.clear()
+        self.resyncing = False
+
+        rows = self.rows(request.board)
+        for sock in self.members.get(request.board, ()):
+            if sock in self.viewports:
+                self.viewports[sock].count(rows)
+        self.broadcast_to_clients({'client_id': '', 'type': 'resync', 'version': request.version,
+                                   'update': "Resynchronized at version %d" % request.version,
+                                   'epoch': request.epoch, 'board': request.board}, snapshot=True)
+
+    def apply(self, msg):
+        """ Apply the delta of a change to our copy of the table. Returns what it touched
+            (see Request._changed), or None if it doesn't follow on from our version """
+
+        request = self.request
+        store = request.store
+        if msg['version'] != request.version + 1:
+            return None
+        delta = msg['delta']
+        # the first old row of every task the change touched, in order
+        names, old, name, row = [], {}, None, None
+        try:
+            for i, change in enumerate(delta):
+                if change['op'] == 'insert':
+                    name, row = change['task'][0], None
+                    if name in store:
+                        return None
+                    store.add(*change['task'])
+                elif change['op'] == 'set':
+                    task = store.at(change['index'])
+                    name, row = task.name, task.row()
+                    store.update(name, Task.FIELDS[change['field']], change['value'])
+                # (a move is of the task whose priority just changed, which the store has already moved)
+                if name not in old:
+                    names.append(name)
+                    old[name] = row
+                # every task has to end up where the primary put it
+                if i + 1 < len(delta) and delta[i + 1]['op'] == 'move':
+                    continue
+                if store.position(name) != (change['to'] if change['op'] == 'move' else change['index']):
+                    return None
+        except (IndexError, KeyError, ValueError):
+            return None
+
+        request.version = msg['version']
+        request.history.append((msg['version'], msg['delta']))
+        return [(old[name], store.get(name).row()) for name in names]
+
+    def drop(self, sock):
+        conn = self.conn_ids.pop(sock, None)
+        if conn is not None:
+            del self.conns[conn]
+        super(Replica, self).drop(sock)
+
+def replica_engine(engine):
+    """ Return a replica server class that monitors its sockets like the given engine """
+
+    return type(engine.__name__.replace("Server", "Replica"), (Replica, engine), {})
 
 if __name__ == '__main__':
-    if len(sys.argv) != 3:
+    parser = optparse.OptionParser(usage="%prog HOSTNAME PORT [options]\n"
+                                         "       %prog --import FILE|--export FILE [--board NAME] [--format FORMAT]")
+    parser.add_option("--engine", choices=sorted(ENGINES), default="select",
+                      help="how sockets are monitored: %s (default: select)" % ", ".join(sorted(ENGINES)))
+    parser.add_option("--high-water", type="int", default=HIGH_WATER,
+                      help="bytes queued for a client before it is considered too slow")
+    parser.add_option("--slow", choices=["disconnect", "throttle"], default="disconnect",
+                      help="what to do with clients that are too slow: disconnect or throttle")
+    parser.add_option("--workers", type="int", default=0,
+                      help="run this many worker processes for the clients, with this one owning the tasks")
+    parser.add_option("--history", type="int", default=HISTORY,
+                      help="how many recent changes to keep for clients that reconnect (default: %d)" % HISTORY)
+    parser.add_option("--sync-every", type="int", default=1,
+                      help="fsync the task log after this many changes (default: 1, every change)")
+    parser.add_option("--sync-interval", type="float",
+                      help="also fsync the task log when a change has waited this many seconds for it")
+    parser.add_option("--board-dir", default="boards",
+                      help="where boards other than the default one are saved (default: boards)")
+    parser.add_option("--max-boards", type="int", default=100,
+                      help="how many boards there can be, including the default one (default: 100)")
+    parser.add_option("--replica-of", metavar="HOST:PORT",
+                      help="serve a read-only copy of a board of the server at HOST:PORT, forwarding changes to it")
+    parser.add_option("--replica-board", default="",
+                      help="the board to copy with --replica-of (default: the default board)")
+    parser.add_option("--import", dest="import_file", metavar="FILE",
+                      help="add the tasks in a CSV or JSON lines file to a board and exit (with the server stopped)")
+    parser.add_option("--export", dest="export_file", metavar="FILE",
+                      help="save the tasks of a board to a CSV or JSON lines file and exit")
+    parser.add_option("--format", choices=bulk.FORMATS,
+                      help="the format of the --import/--export file: csv or jsonl (default: from its name)")
+    parser.add_option("--board", default="",
+                      help="the board to --import to or --export from (default: the default board)")
+    parser.add_option("--stats-file", help="save the server's metrics to this file now and then")
+    parser.add_option("--stats-interval", type="float", default=10.0,
+                      help="seconds between saves of the metrics and profile (default: 10)")
+    parser.add_option("--profile", help="profile some passes of the event loop with cProfile, saving to this file")
+    parser.add_option("--profile-every", type="int", default=100,
+                      help="profile one in this many passes of the event loop (default: 100)")
+    options, args = parser.parse_args()
+    stats = dict(stats_file=options.stats_file, stats_interval=options.stats_interval,
+                 profile=options.profile, profile_every=options.profile_every)
+
+    if options.import_file or options.export_file:
+        if not valid_board(options.board):
+            print >> sys.stderr, "Board names are 1 to 64 letters, digits, - and _"
+            sys.exit(-1)
+        start = time.time()
+        if options.board:
+            backend = LogBackend(os.path.join(options.board_dir, options.board), legacy=None)
+            if options.export_file and not backend.exists():
+                print >> sys.stderr, "There is no board named %s in %s" % (options.board, options.board_dir)
+                sys.exit(-1)
+            if not os.path.isdir(options.board_dir):
+                os.makedirs(options.board_dir)
+            store = TaskStore(backend)
+        else:
+            store = TaskStore()
+        try:
+            try:
+                if options.import_file:
+                    count = bulk.import_file(store, options.import_file, options.format)
+                    print "Imported %d tasks in %.1f seconds" % (count, time.time() - start)
+                else:
+                    count = bulk.export_file(store, options.export_file, options.format)
+                    print "Exported %d tasks in %.1f seconds" % (count, time.time() - start)
+            except (IOError, ValueError), e:
+                print >> sys.stderr, e
+                sys.exit(-1)
+        finally:
+            store.close()
+        sys.exit(0)
+    if len(args) != 2:
         print >> sys.stderr, "You need to supply the hostname and port"
         sys.exit(-1)
+    if options.replica_of and options.workers:
+        print >> sys.stderr, "A replica can't have workers, run more replicas instead"
+        sys.exit(-1)
+    if not valid_board(options.replica_board):
+        print >> sys.stderr, "Board names are 1 to 64 letters, digits, - and _"
+        sys.exit(-1)
+    if options.sync_every < 1:
+        print >> sys.stderr, "--sync-every must be at least 1"
+        sys.exit(-1)
 
     print "Starting server..."
-    server = SelectServer(sys.argv[1], int(sys.argv[2]))
+    if options.workers:
+        try:
+            serve_workers(ENGINES[options.engine], options.workers, args[0], int(args[1]),
+                          high_water=options.high_water, slow=options.slow, history=options.history,
+                          board_dir=options.board_dir, max_boards=options.max_boards,
+                          sync_every=options.sync_every, sync_interval=options.sync_interval, **stats)
+        except KeyboardInterrupt:
+            print "Shutting down server..."
+        sys.exit(0)
+
+    if options.replica_of:
+        primary_host, _, primary_port = options.replica_of.rpartition(":")
+        server = replica_engine(ENGINES[options.engine])((primary_host, int(primary_port)), options.replica_board,
+                                                         args[0], int(args[1]), history=options.history,
+                                                         high_water=options.high_water, slow=options.slow, **stats)
+    else:
+        # listen before loading the tasks, so clients can connect while we do
+        listener = listen(args[0], int(args[1]))
+        store = TaskStore(LogBackend(sync_every=options.sync_every, sync_interval=options.sync_interval))
+        server = ENGINES[options.engine](args[0], int(args[1]), Request(store, history=options.history),
+                                         high_water=options.high_water, slow=options.slow, listener=listener,
+                                         board_dir=options.board_dir, max_boards=options.max_boards, **stats)
     try:
         server.run()
     except KeyboardInterrupt:
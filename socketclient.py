@@ -1,32 +1,233 @@
+import itertools
 import socket
 import json
+import threading
+import Queue
+
+import wire
+
+class Future(object):
+    """ The response to a request that has been sent, once it arrives (see Client.request) """
+
+    def __init__(self):
+        self.response = None
+        self.exception = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
+
+    def done(self):
+        """ Whether the response (or the end of the connection) has arrived """
+        return self.event.isSet()
+
+    def result(self, timeout=None):
+        """ Wait for the response and return it (errors from the server are responses too).
+            Raises socket.timeout if it doesn't come in time, and socket.error if the
+            connection ended before it came """
+
+        self.event.wait(timeout)
+        if not self.event.isSet():
+            raise socket.timeout("no response in %s seconds" % timeout)
+        if self.exception is not None:
+            raise self.exception
+        return self.response
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when the response arrives (in the client's reader thread),
+            or straight away if it already has """
+
+        self.lock.acquire()
+        try:
+            if not self.event.isSet():
+                self.callbacks.append(callback)
+                return
+        finally:
+            self.lock.release()
+        callback(self)
+
+    def resolve(self, response=None, exception=None):
+        self.lock.acquire()
+        try:
+            self.response, self.exception = response, exception
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        finally:
+            self.lock.release()
+        for callback in callbacks:
+            callback(self)
+
+class Reader(object):
+    """ The file we read from the socket through, counting the bytes read """
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, size):
+        data = self.f.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self):
+        line = self.f.readline()
+        self.count += len(line)
+        return line
 
 class Client(object):
-    """ This class is a client to send/receive to our server """
+    """ This class is a client to send/receive to our server.
+
+        With format='binary' the connect request asks for the binary format,
+        and everything after it is sent and received as frames (see wire.py)
+
+        Scripts that send a lot can start() a reader thread and then send with
+        request(), which gives every request an 'id' and returns a Future that gets
+        the response with that id (the server sends exactly one). Requests don't have
+        to wait for each other, so many can be on their way at once:
 
-    def __init__(self, host, port):
+        client.start()
+        futures = client.pipeline([{'command': "addTask Item %d" % i, 'client_id': "Nick"}
+                                   for i in xrange(1000)])
+        errors = [f.result() for f in futures if f.result()['type'] == 'error']
+
+        Everything else the server sends (other clients' changes) goes to on_message,
+        or if there isn't one, into the messages queue. With the binary format, send
+        the connect request and receive its response before starting the reader """
+
+    def __init__(self, host, port, format='json'):
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.host = host
         self.port = int(port)
+        self.format = format
+        # True once we've asked for the binary format
+        self.framed = False
+        # one file for all reads, so nothing read ahead is lost between messages
+        # (reader.count is how many bytes have been read)
+        self.reader = None
+
+        # id -> the Future of every request still waiting for its response
+        self.pending = {}
+        self.ids = itertools.count(1)
+        # so requests from several threads aren't sent in pieces of each other
+        self.lock = threading.Lock()
+        self.thread = None
+        self.closed = False
+        self.on_message = None
+        self.messages = Queue.Queue()
 
     def connect(self):
         """ Attempts to connect to the host, if not already connected """
         self.socket.connect((self.host, self.port))
+        self.reader = Reader(self.socket.makefile('rb'))
+
+    def encode(self, msg):
+        if self.framed:
+            return wire.frame(msg)
+        if self.format == 'binary' and msg.get('command', '').startswith('connect'):
+            msg = dict(msg, format='binary')
+            self.framed = True
+        return json.dumps(msg) + "\n"
 
     def send(self, msg):
         """ Send expects a JSON request to be sent to the server """
 
-        self.socket.send(json.dumps(msg) + "\n")
+        self.socket.sendall(self.encode(msg))
 
     def receive(self):
         """ Receive all data from the server and return a json object """
 
         try:
-            return json.loads(''.join(self.socket.makefile().readline()))
+            if self.framed:
+                return wire.read_frame(self.reader)
+            return json.loads(self.reader.readline())
         except ValueError:
             return None
 
+    def start(self, on_message=None):
+        """ Start reading from the server in a thread of our own, handing responses to the
+            requests they answer and everything else to on_message(msg) (in that thread)
+            or the messages queue. After this, don't call receive() """
+
+        self.on_message = on_message
+        self.thread = threading.Thread(target=self.read)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def request(self, msg):
+        """ Send a request with an id of its own, returns the Future of its response """
+        return self.pipeline([msg])[0]
+
+    def call(self, msg, timeout=None):
+        """ Send a request and wait for its response """
+        return self.request(msg).result(timeout)
+
+    def pipeline(self, msgs):
+        """ Send a list of requests in one go, without waiting for any of the responses.
+            Returns their Futures, in the same order """
+
+        futures = [Future() for msg in msgs]
+        self.lock.acquire()
+        try:
+            if self.closed:
+                for future in futures:
+                    future.resolve(exception=socket.error("the connection is closed"))
+                return futures
+            data = []
+            for msg, future in zip(msgs, futures):
+                id = self.ids.next()
+                self.pending[id] = future
+                data.append(self.encode(dict(msg, id=id)))
+            self.socket.sendall("".join(data))
+        finally:
+            self.lock.release()
+        return futures
+
+    def next_message(self, timeout=None):
+        """ Wait for the next message that isn't a response to one of our requests,
+            returns None if the connection has ended (raises Queue.Empty if none came in time) """
+        return self.messages.get(timeout=timeout)
+
+    def read(self):
+        """ The reader thread: hand out everything the server sends until it goes away """
+
+        try:
+            while True:
+                msg = self.receive()
+                if msg is None:
+                    break
+                future = None
+                if 'id' in msg:
+                    self.lock.acquire()
+                    try:
+                        future = self.pending.pop(msg['id'], None)
+                    finally:
+                        self.lock.release()
+                if future is not None:
+                    future.resolve(msg)
+                elif self.on_message is not None:
+                    self.on_message(msg)
+                else:
+                    self.messages.put(msg)
+        except socket.error:
+            pass
+
+        # nothing else is coming
+        self.lock.acquire()
+        try:
+            self.closed = True
+            pending, self.pending = self.pending, {}
+        finally:
+            self.lock.release()
+        for future in pending.values():
+            future.resolve(exception=socket.error("the server went away"))
+        self.messages.put(None)
+
     def close(self):
         """ Close the socket """
 
+        if self.thread is not None:
+            # wake the reader up, so it can finish
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
         self.socket.close()
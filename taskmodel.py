@@ -0,0 +1,181 @@
+from PyQt4 import QtCore
+
+class TaskModel(QtCore.QAbstractTableModel):
+    """ The task table as a Qt model, for the client's table view.
+
+        The rows are kept the way the server sends them:
+
+        [["Item 1", "Completer", "5", "12"], ["Item 2", "", "2", "0"]]
+
+        Deltas are applied one change at a time, and a whole new table is compared
+        with the one we have, so views only hear about the rows that came, went or
+        moved and the cells that changed, instead of everything being rebuilt on
+        every message (a table that changed too much just resets the model).
+
+        Views only get the first FETCH rows to start with, and FETCH more every
+        time they scroll to the end (canFetchMore/fetchMore), so a big table
+        costs nothing in the view until someone scrolls through it """
+
+    HEADERS = ("Name", "Completer", "Priority", "Completion")
+    # how many rows views get at a time
+    FETCH = 500
+    # a new table that needs more row inserts, removes and moves than this resets the model
+    MAX_CHANGES = 200
+
+    def __init__(self, parent=None):
+        QtCore.QAbstractTableModel.__init__(self, parent)
+        self.rows = []
+        # how many of the rows views know about (always the first ones)
+        self.fetched = 0
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return self.fetched
+
+    def columnCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self.HEADERS)
+
+    def data(self, index, role=QtCore.Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role == QtCore.Qt.DisplayRole:
+            return self.rows[index.row()][index.column()]
+        if role == QtCore.Qt.TextAlignmentRole:
+            return QtCore.Qt.AlignCenter
+        return None
+
+    def flags(self, index):
+        return QtCore.Qt.ItemIsSelectable | QtCore.Qt.ItemIsEnabled
+
+    def headerData(self, section, orientation, role=QtCore.Qt.DisplayRole):
+        if orientation == QtCore.Qt.Horizontal and role == QtCore.Qt.DisplayRole:
+            return self.HEADERS[section]
+        return None
+
+    def canFetchMore(self, parent):
+        return not parent.isValid() and self.fetched < len(self.rows)
+
+    def fetchMore(self, parent):
+        """ Give views the next FETCH rows """
+
+        more = min(len(self.rows) - self.fetched, self.FETCH)
+        if parent.isValid() or more <= 0:
+            return
+        self.beginInsertRows(QtCore.QModelIndex(), self.fetched, self.fetched + more - 1)
+        self.fetched += more
+        self.endInsertRows()
+
+    def applyDelta(self, delta):
+        """ Apply the changes the server sent, in order (see server.Request) """
+
+        for change in delta:
+            if change['op'] == 'insert':
+                self._insert(change['index'], change['task'])
+            elif change['op'] == 'set':
+                self._set(change['index'], change['field'], change['value'])
+            elif change['op'] == 'move':
+                self._move(change['from'], change['to'])
+
+    def setTable(self, table):
+        """ Replace the whole table. Rows are matched up by task name, so views only
+            hear about what is different: first the tasks that are gone are removed,
+            then going down the new table, new tasks are inserted and tasks that are
+            in the wrong place are moved to where they belong """
+
+        names = set(row[0] for row in table)
+        gone = [i for i, row in enumerate(self.rows) if row[0] not in names]
+        if not self.rows or len(gone) > self.MAX_CHANGES:
+            self._reset(table)
+            return
+        for i in reversed(gone):
+            self._remove(i)
+
+        have = set(row[0] for row in self.rows)
+        # where every task ends up
+        target = dict((row[0], i) for i, row in enumerate(table))
+        changes = len(gone)
+        i = 0
+        while i < len(table):
+            row = table[i]
+            if i < len(self.rows) and self.rows[i][0] == row[0]:
+                self._update(i, row)
+                i += 1
+                continue
+
+            changes += 1
+            if changes > self.MAX_CHANGES:
+                self._reset(table)
+                return
+            if row[0] not in have:
+                self._insert(i, row)
+                have.add(row[0])
+                i += 1
+            elif i + 1 < len(self.rows) and self.rows[i + 1][0] == row[0]:
+                # the task that's here moved down, rather than this one moving up
+                self._move(i, min(target[self.rows[i][0]], len(self.rows) - 1))
+            else:
+                j = i + 1
+                while self.rows[j][0] != row[0]:
+                    j += 1
+                self._move(j, i)
+
+    def _reset(self, table):
+        # start again with a new table, keeping as many rows fetched as we had
+        self.beginResetModel()
+        self.rows = table
+        self.fetched = min(len(table), max(self.fetched, self.FETCH))
+        self.endResetModel()
+
+    def _changed(self, y, first, last):
+        # tell views about changed cells, if they know about the row
+        if y < self.fetched:
+            self.emit(QtCore.SIGNAL("dataChanged(QModelIndex,QModelIndex)"), self.index(y, first),
+                      self.index(y, last))
+
+    def _set(self, y, x, value):
+        self.rows[y][x] = value
+        self._changed(y, x, x)
+
+    def _update(self, y, row):
+        # replace a row with a newer copy of the same task
+        changed = [x for x, (old, new) in enumerate(zip(self.rows[y], row)) if old != new]
+        self.rows[y] = row
+        if changed:
+            self._changed(y, changed[0], changed[-1])
+
+    def _insert(self, y, row):
+        # a row views know about, or the end of a table they have all of
+        visible = y < self.fetched or self.fetched == len(self.rows)
+        if visible:
+            self.beginInsertRows(QtCore.QModelIndex(), y, y)
+        self.rows.insert(y, row)
+        if visible:
+            self.fetched += 1
+            self.endInsertRows()
+
+    def _remove(self, y):
+        visible = y < self.fetched
+        if visible:
+            self.beginRemoveRows(QtCore.QModelIndex(), y, y)
+        del self.rows[y]
+        if visible:
+            self.fetched -= 1
+            self.endRemoveRows()
+
+    def _move(self, source, destination):
+        if source == destination:
+            return
+        if source < self.fetched and destination < self.fetched:
+            # (Qt wants the row it will be in front of, counting the row being moved)
+            self.beginMoveRows(QtCore.QModelIndex(), source, source, QtCore.QModelIndex(),
+                               destination > source and destination + 1 or destination)
+            self.rows.insert(destination, self.rows.pop(source))
+            self.endMoveRows()
+        else:
+            # a move in or out of the rows views know about is a remove and an insert to them
+            row = self.rows[source]
+            self._remove(source)
+            self._insert(destination, row)
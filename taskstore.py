@@ -0,0 +1,839 @@
+from bisect import bisect_left
+from itertools import islice
+from operator import attrgetter
+import cPickle as pickle
+import gc
+import json
+import os
+import shelve
+import threading
+import time
+import whichdb
+
+class ShelveBackend(object):
+    """ This backend keeps the whole task list in a shelve file, the same way
+        the server always has. Every write rewrites the whole list.
+
+        A backend provides:
+            load() -> (tasks, records), the saved table and any mutation records to replay on top
+            write(store, record), called after every mutation of the store
+            close() """
+
+    def __init__(self, filename="tasks.db"):
+        self.filename = filename
+
+    def load(self):
+        """ Return the saved task list (or an empty one) """
+
+        s = shelve.open(self.filename, writeback=True)
+        try:
+            if not s.has_key("data"):
+                s['data'] = []
+            return s['data'], []
+        finally:
+            s.close()
+
+    def save(self, tasks):
+        """ Rewrite the saved task list """
+
+        s = shelve.open(self.filename)
+        try:
+            s['data'] = tasks
+        finally:
+            s.close()
+
+    def write(self, store, record):
+        self.save(store.rows())
+
+    def close(self):
+        pass
+
+class LogBackend(object):
+    """ This backend appends every mutation to a write-ahead log instead of
+        rewriting the table, so a write costs the same no matter how many tasks there are.
+
+        Files (for basename "tasks"):
+            tasks.snapshot - a pickled {'seq': n, 'tasks': [("Item 1", "", 5, 0, 1), ...]}, the table as of record n
+                             (the last field of a task is its seq, older snapshots don't have it)
+            tasks.log      - one JSON record per line, e.g. {"seq": 7, "op": "set", "name": "a", "field": "completion", "value": 50}
+            tasks.log.old  - the log being folded into a new snapshot (only exists while compacting)
+
+        Records are fsync'd in groups: after 'sync_every' records, or when the oldest
+        unsynced record is 'sync_interval' seconds old (checked by a background thread).
+        After 'compact_every' records the log is rotated and a new snapshot is written
+        in the background. On startup the snapshot is loaded and the log is replayed
+        on top of it, skipping records the snapshot already contains and dropping a
+        torn record at the end of the log. """
+
+    def __init__(self, basename="tasks", sync_every=1, sync_interval=None, compact_every=100000,
+                 legacy="tasks.db"):
+        self.snapshot_file = basename + ".snapshot"
+        self.log_file = basename + ".log"
+        self.old_log_file = basename + ".log.old"
+        self.sync_every = sync_every
+        self.sync_interval = sync_interval
+        self.compact_every = compact_every
+        # an old shelve database to import when there's no log yet
+        self.legacy = legacy
+
+        self.seq = 0
+        self.logged = 0
+        self.unsynced = 0
+        self.log = None
+        self.compactor = None
+        # guards the log file between the server and the sync thread
+        self.lock = threading.Lock()
+
+        self.running = True
+        self.wakeup = threading.Event()
+        self.thread = None
+        if sync_interval:
+            self.thread = threading.Thread(target=self._run)
+            self.thread.setDaemon(True)
+            self.thread.start()
+
+    def exists(self):
+        """ Whether anything has been saved under this basename yet (loading creates the files) """
+
+        return any(os.path.exists(name) for name in (self.snapshot_file, self.log_file, self.old_log_file))
+
+    def load(self):
+        """ Load the snapshot and collect the log records that come after it """
+
+        tasks = []
+        if os.path.exists(self.snapshot_file):
+            f = open(self.snapshot_file, "rb")
+            try:
+                snapshot = pickle.load(f)
+            finally:
+                f.close()
+            self.seq, tasks = snapshot['seq'], snapshot['tasks']
+        elif not os.path.exists(self.log_file) and self.legacy and whichdb.whichdb(self.legacy):
+            tasks = ShelveBackend(self.legacy).load()[0]
+            self._write_snapshot({'seq': 0, 'tasks': tasks})
+
+        if os.path.exists(self.old_log_file):
+            # a compaction was interrupted, fold both logs back into one
+            old = open(self.old_log_file, "ab")
+            try:
+                if os.path.exists(self.log_file):
+                    f = open(self.log_file, "rb")
+                    try:
+                        old.write(f.read())
+                    finally:
+                        f.close()
+                old.flush()
+                os.fsync(old.fileno())
+            finally:
+                old.close()
+            os.rename(self.old_log_file, self.log_file)
+
+        records = []
+        for record in self._read_log(self.log_file):
+            if record['seq'] > self.seq:
+                records.append(record)
+                self.seq = record['seq']
+        self.logged = len(records)
+
+        self.log = open(self.log_file, "ab")
+        return tasks, records
+
+    def _read_log(self, filename):
+        """ Read all complete records from a log, truncating a torn tail """
+
+        if not os.path.exists(filename):
+            return []
+
+        records = []
+        f = open(filename, "r+b")
+        try:
+            good = 0
+            for line in f:
+                try:
+                    if not line.endswith("\n"):
+                        raise ValueError("torn record")
+                    records.append(json.loads(line))
+                except ValueError:
+                    # the process died in the middle of this write, nothing after it was acknowledged
+                    break
+                good += len(line)
+            f.truncate(good)
+        finally:
+            f.close()
+        return records
+
+    def write(self, store, record):
+        """ Append the record to the log, syncing and compacting when due """
+
+        self.seq += 1
+        record['seq'] = self.seq
+
+        if record['op'] == 'import' and len(record['tasks']) >= self.compact_every:
+            # it would be folded into a snapshot straight away, so skip logging it
+            # and write the snapshot (with it in) before saying it's saved
+            self.compact(store, wait=True)
+            return
+
+        self.lock.acquire()
+        try:
+            self.log.write(json.dumps(record) + "\n")
+            self.unsynced += 1
+            if self.unsynced >= self.sync_every:
+                self._sync()
+        finally:
+            self.lock.release()
+
+        # an import counts as every task in it, so a big one is folded into a snapshot soon
+        self.logged += len(record.get('tasks', ())) or 1
+        if self.logged >= self.compact_every:
+            self.compact(store)
+
+    def sync(self):
+        """ fsync any records that haven't been yet """
+
+        self.lock.acquire()
+        try:
+            self._sync()
+        finally:
+            self.lock.release()
+
+    def _sync(self):
+        if not self.unsynced:
+            return
+        self.log.flush()
+        os.fsync(self.log.fileno())
+        self.unsynced = 0
+
+    def _run(self):
+        while self.running:
+            self.wakeup.wait(self.sync_interval)
+            self.sync()
+
+    def compact(self, store, wait=False):
+        """ Rotate the log and write a snapshot of the store in the background
+            (or before returning, with wait) """
+
+        # only one compaction at a time, the log will just grow a bit longer meanwhile
+        if self.compactor and self.compactor.isAlive():
+            if not wait:
+                return
+            self.compactor.join()
+
+        self.lock.acquire()
+        try:
+            self._sync()
+            self.log.close()
+            os.rename(self.log_file, self.old_log_file)
+            self.log = open(self.log_file, "ab")
+        finally:
+            self.lock.release()
+        self.logged = 0
+
+        snapshot = {'seq': self.seq, 'tasks': _without_gc(store.records, True)}
+        if wait:
+            self._write_snapshot(snapshot)
+            return
+        self.compactor = threading.Thread(target=self._write_snapshot, args=(snapshot,))
+        self.compactor.start()
+
+    def _write_snapshot(self, snapshot):
+        tmp = self.snapshot_file + ".tmp"
+        f = open(tmp, "wb")
+        try:
+            pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+            # a snapshot has no cycles, and remembering every object pickled (to refer back to
+            # the ones seen again) makes pickling several times slower and the file bigger
+            pickler.fast = 1
+            pickler.dump(snapshot)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, self.snapshot_file)
+        # everything in the old log is in the snapshot now
+        if os.path.exists(self.old_log_file):
+            os.remove(self.old_log_file)
+
+    def close(self):
+        """ Stop the sync thread, wait for any compaction and sync the log """
+
+        self.running = False
+        self.wakeup.set()
+        if self.thread:
+            self.thread.join()
+        if self.compactor:
+            self.compactor.join()
+        if self.log:
+            self.sync()
+            self.log.close()
+            self.log = None
+
+class MemoryBackend(object):
+    """ This backend doesn't save anything. It is for stores whose tasks are kept
+        somewhere else, like a replica's copy of its primary's table.
+        The tasks it starts with may carry their seq as a fifth field, so they keep
+        the same order as the store they were copied from """
+
+    def __init__(self, tasks=()):
+        self.tasks = tasks
+
+    def load(self):
+        return self.tasks, []
+
+    def write(self, store, record):
+        pass
+
+    def close(self):
+        pass
+
+class OrderedIndex(object):
+    """ A sorted collection of keys, kept as a list of short sorted lists (buckets).
+
+        Finding a key is a bisect over the last key of every bucket and then one inside
+        a bucket, and inserting or removing a key only shifts one short bucket.
+        The number of keys in each bucket is kept in a Fenwick tree, so the rank of
+        a key and the key at a rank are found in O(log N) as well. """
+
+    # buckets are split when they get twice this long
+    LOAD = 512
+
+    def __init__(self, keys=(), sort=True):
+        # (keys that are already in order can skip the sort)
+        keys = sort and sorted(keys) or list(keys)
+        self.buckets = [keys[i:i + self.LOAD] for i in xrange(0, len(keys), self.LOAD)]
+        self.maxes = [self._key(b[-1]) for b in self.buckets]
+        self.size = len(keys)
+        self._rebuild()
+
+    def __len__(self):
+        return self.size
+
+    def __iter__(self):
+        for b in self.buckets:
+            for key in b:
+                yield key
+
+    def __getitem__(self, rank):
+        """ Return the key at the given rank """
+
+        if rank < 0:
+            rank += self.size
+        if not 0 <= rank < self.size:
+            raise IndexError("rank out of range")
+        i, j = self._locate(rank)
+        return self.buckets[i][j]
+
+    def islice(self, start=0, stop=None, reverse=False):
+        """ Yield the keys ranked from start up to (not including) stop, the last one first if reverse """
+
+        if stop is None or stop > self.size:
+            stop = self.size
+        n = stop - start
+        if n <= 0:
+            return
+        if reverse:
+            i, j = self._locate(stop - 1)
+            while True:
+                chunk = self.buckets[i][max(j + 1 - n, 0):j + 1]
+                for key in reversed(chunk):
+                    yield key
+                n -= len(chunk)
+                if not n:
+                    return
+                i -= 1
+                j = len(self.buckets[i]) - 1
+        else:
+            i, j = self._locate(start)
+            while True:
+                chunk = self.buckets[i][j:j + n]
+                for key in chunk:
+                    yield key
+                n -= len(chunk)
+                if not n:
+                    return
+                i, j = i + 1, 0
+
+    def rank(self, key):
+        """ Return how many keys come before the given key """
+
+        i = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        if i < 0:
+            return 0
+        # add up the bucket sizes before bucket i
+        rank, j = 0, i
+        while j:
+            rank += self.tree[j]
+            j -= j & -j
+        return rank + self._bisect(self.buckets[i], key)
+
+    def insert(self, key):
+        """ Add a key """
+
+        self.size += 1
+        if not self.buckets:
+            self.buckets, self.maxes = [[key]], [self._key(key)]
+            self._rebuild()
+            return
+
+        k = self._key(key)
+        i = min(bisect_left(self.maxes, k), len(self.buckets) - 1)
+        b = self.buckets[i]
+        b.insert(self._bisect(b, k), key)
+        self.maxes[i] = self._key(b[-1])
+        if len(b) > 2 * self.LOAD:
+            self.buckets[i:i + 1] = [b[:self.LOAD], b[self.LOAD:]]
+            self.maxes[i:i + 1] = [self._key(b[self.LOAD - 1]), self._key(b[-1])]
+            self._rebuild()
+        else:
+            self._resize(i, 1)
+
+    def remove(self, key):
+        """ Remove a key, which must be there """
+
+        k = self._key(key)
+        i = bisect_left(self.maxes, k)
+        b = self.buckets[i]
+        del b[self._bisect(b, k)]
+        self.size -= 1
+        if b:
+            self.maxes[i] = self._key(b[-1])
+            self._resize(i, -1)
+        else:
+            del self.buckets[i]
+            del self.maxes[i]
+            self._rebuild()
+
+    # what the keys are compared by, and where one would go in a bucket
+    # (KeyedIndex compares something worked out from each of them instead)
+    _key = staticmethod(lambda key: key)
+    _bisect = staticmethod(bisect_left)
+
+    def _locate(self, rank):
+        # walk down the Fenwick tree to the bucket holding the rank, returns (bucket, position in it)
+        i, step = 0, 1 << len(self.buckets).bit_length()
+        while step:
+            if i + step <= len(self.buckets) and self.tree[i + step] <= rank:
+                i += step
+                rank -= self.tree[i]
+            step >>= 1
+        return i, rank
+
+    def _resize(self, i, delta):
+        # bucket i changed size by delta
+        i += 1
+        while i <= len(self.buckets):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _rebuild(self):
+        # build the Fenwick tree of bucket sizes from scratch (after a split or merge)
+        tree = [0] * (len(self.buckets) + 1)
+        for i, b in enumerate(self.buckets):
+            i += 1
+            tree[i] += len(b)
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+class KeyedIndex(OrderedIndex):
+    """ An OrderedIndex of items in the order of key(item) rather than of the items themselves.
+
+        The keys aren't kept, only the key of the last item of every bucket: the rest are
+        worked out as they're compared. So an index of N items costs N list slots, where
+        one of (key, item) tuples would cost a tuple as well for every one of them.
+        rank() takes a key, everything else takes items. Every item must have a key of its own """
+
+    def __init__(self, key, items=(), sort=True):
+        self._key = key
+        OrderedIndex.__init__(self, sort and sorted(items, key=key) or list(items), sort=False)
+
+    def _bisect(self, bucket, key):
+        # bisect_left, comparing the keys of the items in the bucket
+        key_of = self._key
+        lo, hi = 0, len(bucket)
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if key_of(bucket[mid]) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+class Task(object):
+    """ One task. Priority and completion are small ints rather than strings, and
+        tasks accepted by the same completer share one copy of the completer's name.
+
+        Tasks sort by (priority, seq), where seq is the order they were added in """
+
+    __slots__ = ('name', 'completer', 'priority', 'completion', 'seq')
+
+    # the fields in the order they go over the wire
+    FIELDS = ('name', 'completer', 'priority', 'completion')
+    # the lowest and highest priority or completion (they have to fit the binary format's 64 bit ints)
+    RANGE = (-(1 << 63), (1 << 63) - 1)
+
+    def __init__(self, name, completer, priority, completion, seq=0):
+        self.name = name
+        self.completer = completer
+        self.priority = priority
+        self.completion = completion
+        self.seq = seq
+
+    def __lt__(self, other):
+        if self.priority != other.priority:
+            return self.priority < other.priority
+        return self.seq < other.seq
+
+    def row(self):
+        """ The task as clients see it: ["Item 1", "Completer", "5", "12"] """
+
+        return [self.name, self.completer, str(self.priority), str(self.completion)]
+
+    def record(self):
+        """ The task as it is saved: ("Item 1", "Completer", 5, 12) """
+
+        return (self.name, self.completer, self.priority, self.completion)
+
+# the order of the completion index: ties are in display order, and seq is unique
+_by_completion = attrgetter('completion', 'priority', 'seq')
+
+def _span(index, bounds, probe):
+    # the ranks of the keys of an index in a (low, high) range, inclusive, either end may be None
+    low, high = bounds or (None, None)
+    start = 0 if low is None else index.rank(probe(low))
+    stop = len(index) if high is None else index.rank(probe(high + 1))
+    return start, max(start, stop)
+
+def _within(value, bounds):
+    return bounds is None or ((bounds[0] is None or bounds[0] <= value) and
+                              (bounds[1] is None or value <= bounds[1]))
+
+def _without_gc(function, *args):
+    # run something that makes a lot of objects that all stay around, without the garbage
+    # collector going through every one of them again and again while it does
+    collecting = gc.isenabled()
+    gc.disable()
+    try:
+        return function(*args)
+    finally:
+        if collecting:
+            gc.enable()
+
+class TaskStore(object):
+    """ This is the resident copy of the task table.
+
+        Tasks are kept in memory as Task records in an OrderedIndex, sorted by
+        (priority, insertion sequence), which is the order clients display them in.
+        A dict indexes the same tasks by name so lookups don't have to scan the table,
+        and two more indexes keep every completer's tasks in priority order and all
+        the tasks in completion order, so query() doesn't have to either.
+
+        rows() hands out the table in the form clients expect:
+
+        [["Item 1", "Completer", "5", "12"], ["Item 2", "", "2", "0"]]
+
+        Every mutation is described by a record, which is what the backend persists:
+
+        {'op': 'add', 'task': ["Item 1", "", 5, 0]}
+        {'op': 'set', 'name': "Item 1", 'field': "completion", 'value': 12}
+        {'op': 'import', 'tasks': [["Item 1", "", 5, 0], ["Item 2", "Nick", 2, 50]]}
+
+        Mutations between begin() and commit() are applied straight away, but handed
+        to the backend together as one record, so they are saved (or lost) together:
+
+        {'op': 'batch', 'records': [...]} """
+
+    def __init__(self, backend=None):
+        if backend is None:
+            backend = LogBackend()
+        self.backend = backend
+        # background writers copy the tasks under this lock
+        self.lock = threading.Lock()
+
+        # name -> task
+        self.index = {}
+        # completer name -> the one copy of it all tasks share
+        self.completers = {'': ''}
+        self.seq = 0
+        _without_gc(self._load)
+        # the table as clients see it, built when someone asks for it
+        self.table = None
+        # records of the transaction in progress, if there is one
+        self.pending = None
+        # if set, the time spent handing records to the backend is recorded as 'store.write'
+        self.metrics = None
+
+    def _load(self):
+        tasks, records = self.backend.load()
+        # the saved table is in display order already, so number the tasks in that order
+        loaded = [self._insert(task) for task in tasks]
+        del tasks
+        for record in records:
+            self._apply(record, index=False)
+        if records:
+            # the tasks the log added come after the others, so the list is still almost in order
+            seq = loaded and max(task.seq for task in loaded) or 0
+            loaded.extend(sorted((task for task in self.index.itervalues() if task.seq > seq),
+                                 key=attrgetter('seq')))
+        self._build(loaded, sort=bool(records))
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.index
+
+    def get(self, name):
+        """ Return the task with the given name, or None """
+
+        return self.index.get(name)
+
+    def rows(self):
+        """ Return the whole table, in priority order """
+
+        if self.table is None:
+            self.table = [task.row() for task in self.order]
+        return self.table
+
+    def records(self, seq=False):
+        """ Return the whole table in its compact saved form, in priority order.
+            With seq, every record has the task's seq as well, so a store loaded from
+            them keeps tasks of the same priority in the same order after they change """
+
+        if seq:
+            return [task.record() + (task.seq,) for task in self.order]
+        return [task.record() for task in self.order]
+
+    def at(self, position):
+        """ Return the task displayed in the given row """
+
+        return self.order[position]
+
+    def position(self, name):
+        """ Return the row a task is displayed in """
+
+        return self.order.rank(self.index[name])
+
+    def query(self, completer=None, priority=None, completion=None, sort='priority', offset=0, limit=None):
+        """ Find the tasks accepted by a completer, with a priority and/or a completion in a
+            (low, high) range (inclusive, and either end may be None). Returns the tasks sorted
+            by 'priority' or 'completion' ('-priority' and '-completion' for the reverse),
+            from 'offset' on and at most 'limit' of them, and whether there are more after those.
+
+            The candidates come from one of two indexes, and only they are checked against the
+            rest of the filters. Going through the index that is in the order asked for can stop
+            as soon as it has enough tasks; the other one may have far fewer candidates, but they
+            all have to be checked and sorted. The one expected to look at fewer tasks is used """
+
+        if not isinstance(sort, basestring) or sort.lstrip('-') not in ('priority', 'completion'):
+            raise ValueError("can't sort by %r" % (sort,))
+        reverse, sort = sort.startswith('-'), sort.lstrip('-')
+        filters = (completer, priority, completion)
+        ordered, other = sorted(self._candidates(*filters), key=lambda c: c[1] != sort)
+        walk = ordered[0]
+        if limit is not None and not ordered[5]:
+            # (assuming the rest of the filters pass about as often in it as in the whole table)
+            walk = min(walk, (offset + limit + 1) * len(self) // max(other[0], 1))
+        size, order, index, start, stop, exact = ordered if ordered[5] or walk <= 2 * other[0] else other
+
+        if exact and order == sort:
+            # every candidate passes and they're in order, so the offset is a rank
+            if reverse:
+                stop = max(stop - offset, start)
+            else:
+                start = min(start + offset, stop)
+            offset = 0
+        tasks = index.islice(start, stop, reverse and order == sort)
+        if not exact:
+            tasks = (task for task in tasks if self._passes(task, *filters))
+        if order != sort:
+            tasks = sorted(tasks, key=_by_completion if sort == 'completion' else lambda t: (t.priority, t.seq),
+                           reverse=reverse)
+        found = list(islice(tasks, offset, None if limit is None else offset + limit + 1))
+        if limit is not None and len(found) > limit:
+            return found[:limit], True
+        return found, False
+
+    def count(self, completer=None, priority=None, completion=None):
+        """ Count the tasks that pass the same filters as query() """
+
+        candidates = self._candidates(completer, priority, completion)
+        for size, order, index, start, stop, exact in candidates:
+            if exact:
+                return size
+        size, order, index, start, stop, exact = min(candidates, key=lambda c: c[0])
+        return sum(1 for task in index.islice(start, stop)
+                   if self._passes(task, completer, priority, completion))
+
+    def _candidates(self, completer, priority, completion):
+        # the two ways to find tasks: the (completer's) tasks in the priority range, in priority order,
+        # and the tasks in the completion range, in completion order. Each is (how many there are, their
+        # order, the index, the start and stop ranks, and whether they all pass the filters)
+        by_priority = self.order
+        if completer is not None:
+            by_priority = self.by_completer.get(completer) or OrderedIndex()
+        start, stop = _span(by_priority, priority, lambda p: Task(None, None, p, None))
+        first = (stop - start, 'priority', by_priority, start, stop, completion is None)
+        start, stop = _span(self.by_completion, completion, lambda c: (c,))
+        second = (stop - start, 'completion', self.by_completion, start, stop,
+                  completer is None and priority is None)
+        return [first, second]
+
+    def _passes(self, task, completer, priority, completion):
+        return ((completer is None or task.completer == completer) and
+                _within(task.priority, priority) and _within(task.completion, completion))
+
+    def add(self, name, completer='', priority=5, completion=0):
+        """ Add a new task, in priority order """
+
+        self._write({'op': 'add', 'task': [name, completer, priority, completion]})
+
+    def add_many(self, tasks):
+        """ Add a lot of tasks in one go, from any iterable of (name, completer, priority, completion).
+            They are saved as one record, and if there are a lot of them compared to the table,
+            the indexes are built again in one pass instead of a task at a time. Tasks with a
+            name that is already taken are skipped. Returns how many were added """
+
+        return _without_gc(self._add_many, tasks)
+
+    def _add_many(self, tasks):
+        new, names = [], set()
+        for name, completer, priority, completion in tasks:
+            if name not in self.index and name not in names:
+                names.add(name)
+                new.append([name, completer, priority, completion])
+        if new:
+            self._write({'op': 'import', 'tasks': new})
+        return len(new)
+
+    def update(self, name, field, value):
+        """ Change one field ('completer', 'priority' or 'completion') of a task, returning the old value """
+
+        old = getattr(self.index[name], field)
+        self._write({'op': 'set', 'name': name, 'field': field, 'value': value})
+        return old
+
+    def begin(self):
+        """ Start a transaction """
+
+        self.pending = []
+
+    def commit(self):
+        """ Save all the mutations since begin() as one record """
+
+        records, self.pending = self.pending, None
+        if records:
+            self._save({'op': 'batch', 'records': records})
+
+    def _write(self, record):
+        self.lock.acquire()
+        try:
+            self._apply(record)
+        finally:
+            self.lock.release()
+        if self.pending is not None:
+            self.pending.append(record)
+        else:
+            self._save(record)
+
+    def _save(self, record):
+        if self.metrics is None:
+            self.backend.write(self, record)
+            return
+        start = time.time()
+        self.backend.write(self, record)
+        self.metrics.observe('store.write', time.time() - start)
+
+    def _insert(self, task):
+        # make a Task out of a saved task (older saves have every field as a string,
+        # copies of another store have the seq it gave the task)
+        name, completer, priority, completion = task[:4]
+        if len(task) < 5:
+            self.seq += 1
+            seq = self.seq
+        else:
+            seq = task[4]
+            if seq > self.seq:
+                self.seq = seq
+        task = Task(name, self.completers.setdefault(completer, completer), int(priority), int(completion),
+                    seq)
+        self.index[name] = task
+        return task
+
+    def _apply(self, record, index=True):
+        """ Apply a mutation record to the table (and the ordered index, unless it isn't built yet) """
+
+        self.table = None
+        if record['op'] == 'batch':
+            for r in record['records']:
+                self._apply(r, index)
+            return
+        if record['op'] == 'add':
+            task = self._insert(record['task'])
+            if index:
+                for idx, key in self._keys(task, Task.FIELDS):
+                    idx.insert(key)
+            return
+        if record['op'] == 'import':
+            tasks = [self._insert(task) for task in record['tasks']]
+            if index and len(tasks) > len(self.index) // 10:
+                self._build(list(self.order) + tasks)
+            elif index:
+                for task in tasks:
+                    for idx, key in self._keys(task, Task.FIELDS):
+                        idx.insert(key)
+            return
+
+        task = self.index[record['name']]
+        field, value = record['field'], record['value']
+        # older logs number the fields and keep every value as a string
+        if not isinstance(field, basestring):
+            field = Task.FIELDS[field]
+        if field == 'completer':
+            value = self.completers.setdefault(value, value)
+        else:
+            value = int(value)
+
+        # take the task out of the indexes the field is part of and put it back in its new place
+        # (it keeps its place in the sequence)
+        if index:
+            for idx, key in self._keys(task, (field,)):
+                idx.remove(key)
+        setattr(task, field, value)
+        if index:
+            for idx, key in self._keys(task, (field,)):
+                idx.insert(key)
+
+    def _build(self, tasks, sort=True):
+        # build the ordered indexes from scratch, from the tasks in display order (sort=False)
+        # or close to it. Sorting with a key compares in C, which is a lot faster than
+        # Task.__lt__ for a whole table
+        if sort:
+            tasks = sorted(tasks, key=attrgetter('priority', 'seq'))
+        self.order = OrderedIndex(tasks, sort=False)
+        # completer name -> their tasks in priority order
+        completers = {}
+        for task in tasks:
+            completers.setdefault(task.completer, []).append(task)
+        self.by_completer = dict((completer, OrderedIndex(t, sort=False)) for completer, t in completers.iteritems())
+        # the tasks in completion order (the sort is stable, so ties stay in priority order)
+        self.by_completion = KeyedIndex(_by_completion, sorted(tasks, key=attrgetter('completion')), sort=False)
+
+    def _keys(self, task, fields):
+        # (index, key) of every index the task is in that sorts by any of the fields
+        keys = []
+        if 'priority' in fields:
+            keys.append((self.order, task))
+        if 'priority' in fields or 'completer' in fields:
+            if task.completer not in self.by_completer:
+                self.by_completer[task.completer] = OrderedIndex()
+            keys.append((self.by_completer[task.completer], task))
+        if 'priority' in fields or 'completion' in fields:
+            keys.append((self.by_completion, task))
+        return keys
+
+    def close(self):
+        """ Make sure everything is written out """
+
+        self.backend.close()
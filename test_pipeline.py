@@ -0,0 +1,220 @@
+""" Stress tests for pipelined requests: connections that send thousands of requests
+    without waiting for any response, in pieces that cut requests in half, and
+    requests too long to accept.
+
+    Every request must get exactly one response (with its id), every connection must
+    hear about every change exactly once, in order, and a request that is too long must
+    only cost the connection that sent it.
+
+    Usage: python -m unittest test_pipeline """
+
+import json
+import os
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+
+from server import Request, SelectServer
+from socketclient import Client
+from taskstore import LogBackend, TaskStore
+import wire
+
+# seconds to wait for anything
+TIMEOUT = 30
+# the longest request the test server accepts
+MAX_FRAME = 4096
+
+class Connection(object):
+    """ A delta client on a raw socket, that collects everything the server sends in a thread of its own """
+
+    def __init__(self, port, name):
+        self.name = name
+        self.sock = socket.create_connection(("localhost", port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.messages = []
+        self.closed = threading.Event()
+        self.sock.sendall(json.dumps({'command': "connect " + name, 'client_id': name, 'protocol': 'delta'}) + "\n")
+        self.thread = threading.Thread(target=self.read)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def read(self):
+        try:
+            for line in self.sock.makefile('rb'):
+                self.messages.append(json.loads(line))
+        except socket.error:
+            pass
+        self.closed.set()
+
+    def requests(self, commands):
+        """ The lines of a pipeline of commands, with ids 1, 2, 3... """
+
+        return "".join(json.dumps({'command': command, 'client_id': self.name, 'id': i + 1}) + "\n"
+                       for i, command in enumerate(commands))
+
+    def send_in_pieces(self, data, largest=100):
+        """ Send data in pieces of random sizes, so requests arrive cut in two
+            (until the server hangs up, if it does) """
+
+        pos = 0
+        while pos < len(data):
+            size = random.randint(1, largest)
+            try:
+                self.sock.sendall(data[pos:pos + size])
+            except socket.error:
+                return
+            pos += size
+            if random.random() < 0.05:
+                # give the server a chance to read what there is so far
+                time.sleep(0.001)
+
+    def responses(self):
+        return [m for m in self.messages if 'id' in m]
+
+    def changes(self):
+        """ The versions of all the changes this connection heard about (its own included) """
+        return [m['version'] for m in self.messages if m['type'] in Request.CHANGES]
+
+    def wait(self, condition):
+        deadline = time.time() + TIMEOUT
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def close(self):
+        self.sock.close()
+
+class PipelineTest(unittest.TestCase):
+
+    def setUp(self):
+        random.seed(self.id())
+        self.directory = tempfile.mkdtemp()
+        # group commit, so the disk doesn't dominate
+        request = Request(TaskStore(LogBackend(os.path.join(self.directory, "tasks"), sync_every=256, legacy=None)))
+        self.server = SelectServer("localhost", 0, request, max_frame=MAX_FRAME)
+        self.port = self.server.server.getsockname()[1]
+        self.thread = threading.Thread(target=self.server.run)
+        self.thread.start()
+        self.connections = []
+
+    def tearDown(self):
+        for connection in self.connections:
+            connection.close()
+        self.server.stop()
+        self.thread.join()
+        self.server.shutdown()
+        shutil.rmtree(self.directory)
+
+    def connect(self, name):
+        connection = Connection(self.port, name)
+        self.connections.append(connection)
+        self.assertTrue(connection.wait(lambda: connection.messages))
+        self.assertEqual(connection.messages[0]['type'], 'connect')
+        return connection
+
+    def store(self):
+        return self.server.request.store
+
+    def assertAllResponses(self, connection, n, type='addTask'):
+        """ One response for every one of n requests, in order """
+
+        responses = connection.responses()
+        self.assertEqual([m['id'] for m in responses], range(1, n + 1))
+        self.assertEqual(set(m['type'] for m in responses), set([type]))
+
+    def test_pipelined_commands(self):
+        connections = [self.connect("c%d" % c) for c in xrange(4)]
+        commands = 2500
+        total = len(connections) * commands
+        senders = [threading.Thread(target=connection.send_in_pieces, args=(connection.requests(
+                   ["addTask %s-%d" % (connection.name, i) for i in xrange(commands)]), 4096))
+                   for connection in connections]
+        for sender in senders:
+            sender.start()
+        for sender in senders:
+            sender.join()
+
+        for connection in connections:
+            self.assertTrue(connection.wait(lambda: len(connection.changes()) >= total))
+        # nothing is lost, and nobody hears about anything twice or out of order
+        for connection in connections:
+            self.assertAllResponses(connection, commands)
+            changes = connection.changes()
+            self.assertEqual(changes, range(changes[0], changes[0] + total))
+            self.assertFalse([m for m in connection.messages if m['type'] == 'error'])
+        self.assertEqual(len(self.store()), total)
+        for connection in connections:
+            for i in xrange(commands):
+                self.assertTrue("%s-%d" % (connection.name, i) in self.store())
+
+    def test_partial_lines(self):
+        connection, other = self.connect("slow"), self.connect("other")
+        commands = ["addTask Task %d" % i for i in xrange(300)] + ["complete Task %d %d" % (i, i % 101)
+                                                                   for i in xrange(300)]
+        # a byte at a time at most, and never more than a few
+        connection.send_in_pieces(connection.requests(commands), 3)
+
+        self.assertTrue(connection.wait(lambda: len(connection.responses()) >= len(commands)))
+        responses = connection.responses()
+        self.assertEqual([m['id'] for m in responses], range(1, len(commands) + 1))
+        self.assertEqual([m['type'] for m in responses], ['addTask'] * 300 + ['complete'] * 300)
+        self.assertTrue(other.wait(lambda: len(other.changes()) >= len(commands)))
+        self.assertEqual(len(other.changes()), len(commands))
+        self.assertEqual([self.store().get("Task %d" % i).completion for i in xrange(300)],
+                         [i % 101 for i in xrange(300)])
+
+    def test_oversized_line(self):
+        sender, other = self.connect("sender"), self.connect("other")
+        before = ["addTask Before %d" % i for i in xrange(500)]
+        after = ["addTask After %d" % i for i in xrange(100)]
+        too_long = json.dumps({'command': "addTask " + "x" * MAX_FRAME, 'client_id': "sender"}) + "\n"
+        sending = threading.Thread(target=sender.send_in_pieces, args=(
+            sender.requests(before) + too_long + sender.requests(after), 4096))
+        sending.start()
+        other.send_in_pieces(other.requests(["addTask Other %d" % i for i in xrange(500)]), 4096)
+        sending.join()
+
+        # everything before it is answered, then the sender hears why it is being dropped
+        self.assertTrue(sender.closed.wait(TIMEOUT))
+        self.assertAllResponses(sender, len(before))
+        self.assertTrue("Requests can't be longer" in sender.messages[-1]['update'])
+        self.assertFalse([name for name in self.store().index if name.startswith("After") or len(name) > 100])
+
+        # and nobody else loses anything
+        self.assertTrue(other.wait(lambda: len(other.responses()) >= 500 and len(other.changes()) >= 1000))
+        self.assertAllResponses(other, 500)
+        changes = other.changes()
+        self.assertEqual(changes, range(changes[0], changes[0] + 1000))
+        self.assertFalse(other.closed.isSet())
+
+    def test_oversized_partial_line(self):
+        sender, other = self.connect("sender"), self.connect("other")
+        sender.send_in_pieces(sender.requests(["addTask Before"]) + '{"command": "addTask ' + "x" * 2 * MAX_FRAME)
+
+        self.assertTrue(sender.closed.wait(TIMEOUT))
+        self.assertAllResponses(sender, 1)
+        self.assertTrue("Requests can't be longer" in sender.messages[-1]['update'])
+        self.assertEqual(list(self.store().index), ["Before"])
+        self.assertFalse(other.closed.isSet())
+
+    def test_oversized_frame(self):
+        client = Client("localhost", self.port, format='binary')
+        client.connect()
+        client.send({'command': "connect binary", 'client_id': "binary", 'protocol': 'delta'})
+        self.assertEqual(client.receive()['type'], 'connect')
+        client.socket.sendall(client.encode({'command': "addTask Before", 'client_id': "binary", 'id': 1}) +
+                              wire.HEADER.pack(MAX_FRAME + 1) + "x" * 100)
+        try:
+            self.assertEqual(client.receive()['id'], 1)
+            self.assertTrue("Requests can't be longer" in client.receive()['update'])
+            self.assertEqual(client.receive(), None)
+        finally:
+            client.close()
+        self.assertEqual(list(self.store().index), ["Before"])
+
+if __name__ == '__main__':
+    unittest.main()
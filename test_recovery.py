@@ -0,0 +1,195 @@
+""" Crash recovery tests for the write-ahead log (taskstore.LogBackend).
+
+    A writer process adds tasks (one at a time, or in batches) and says which ones
+    were saved; it is SIGKILLed partway through, and the store it leaves behind must
+    load with every saved task in it. The other tests leave the files the way a
+    crash would: a torn last record, a compaction that didn't finish, a batch that
+    was only partly written.
+
+    Usage: python -m unittest test_recovery """
+
+import json
+import os
+import random
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+from taskstore import LogBackend, TaskStore
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Adds tasks forever, printing the name of every task (or batch) once the store has saved it
+WRITER = """
+import sys
+sys.path.insert(0, %(here)r)
+from taskstore import LogBackend, TaskStore
+store = TaskStore(LogBackend(%(basename)r, compact_every=%(compact_every)d, legacy=None))
+i = len(store)
+while True:
+    if %(batch)d:
+        store.begin()
+        for j in xrange(%(batch)d):
+            store.add("task %%d-%%d" %% (i, j))
+        store.commit()
+    else:
+        store.add("task %%d" %% i)
+    sys.stdout.write("%%d\\n" %% i)
+    sys.stdout.flush()
+    i += 1
+"""
+
+class RecoveryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.basename = os.path.join(self.directory, "tasks")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        return TaskStore(LogBackend(self.basename, legacy=None, **kwargs))
+
+    def kill_writer(self, seconds, compact_every=100000, batch=0):
+        """ Run a writer for a while and SIGKILL it, returns the numbers it said were saved """
+
+        writer = subprocess.Popen([sys.executable, "-c", WRITER % {
+            'here': HERE, 'basename': self.basename, 'compact_every': compact_every, 'batch': batch}],
+            stdout=subprocess.PIPE)
+        time.sleep(seconds)
+        writer.send_signal(signal.SIGKILL)
+        saved = [int(line) for line in writer.stdout.read().split("\n")[:-1]]
+        writer.wait()
+        return saved
+
+    def test_kill_while_adding(self):
+        random.seed(1)
+        saved = []
+        for round in xrange(5):
+            saved.extend(self.kill_writer(random.uniform(0.3, 0.6)))
+            store = self.open()
+            try:
+                for i in saved:
+                    self.assertTrue("task %d" % i in store)
+                # at most the one being written when it was killed is there without being acknowledged
+                self.assertTrue(len(saved) <= len(store) <= len(saved) + 1)
+                self.assertEqual([task.name for task in store.order], sorted(store.index, key=lambda name:
+                                                                              store.index[name].seq))
+            finally:
+                store.close()
+            # start the next round from what this one loaded
+            saved = range(len(store))
+
+    def test_kill_while_compacting(self):
+        random.seed(2)
+        for round in xrange(5):
+            saved = self.kill_writer(random.uniform(0.3, 0.6), compact_every=50)
+            store = self.open()
+            try:
+                for i in saved:
+                    self.assertTrue("task %d" % i in store)
+                self.assertFalse(os.path.exists(self.basename + ".log.old"))
+            finally:
+                store.close()
+
+    def test_kill_while_batching(self):
+        random.seed(3)
+        for round in xrange(5):
+            saved = self.kill_writer(random.uniform(0.3, 0.6), batch=10)
+            store = self.open()
+            try:
+                for i in saved:
+                    self.assertTrue("task %d-9" % i in store)
+                # every batch is all there or not there at all
+                batches = {}
+                for name in store.index:
+                    number = name.split()[1].split("-")[0]
+                    batches[number] = batches.get(number, 0) + 1
+                self.assertEqual(set(batches.values()), set([10]))
+            finally:
+                store.close()
+
+    def test_torn_last_record(self):
+        store = self.open()
+        store.add("a")
+        store.add("b")
+        store.close()
+        f = open(self.basename + ".log", "ab")
+        f.write(json.dumps({'seq': 3, 'op': 'add', 'task': ["c", "", 5, 0]})[:20])
+        f.close()
+
+        store = self.open()
+        self.assertEqual(sorted(store.index), ["a", "b"])
+        # the torn record is cut off, so the next one starts on a line of its own
+        store.add("d")
+        store.close()
+        store = self.open()
+        self.assertEqual(sorted(store.index), ["a", "b", "d"])
+        store.close()
+
+    def test_interrupted_compaction(self):
+        store = self.open()
+        for name in "abc":
+            store.add(name)
+        store.update("a", "completion", 50)
+        store.close()
+        # killed after rotating the log but before the snapshot was written:
+        # the old log is still there, and newer records went into a new log
+        os.rename(self.basename + ".log", self.basename + ".log.old")
+        f = open(self.basename + ".log", "wb")
+        f.write(json.dumps({'seq': 5, 'op': 'add', 'task': ["d", "", 1, 0]}) + "\n")
+        f.close()
+
+        store = self.open()
+        try:
+            self.assertEqual([task.name for task in store.order], ["d", "a", "b", "c"])
+            self.assertEqual(store.get("a").completion, 50)
+            self.assertFalse(os.path.exists(self.basename + ".log.old"))
+        finally:
+            store.close()
+
+    def test_interrupted_compaction_with_snapshot(self):
+        # killed after the snapshot was written but before the old log was removed
+        store = self.open(compact_every=3)
+        for name in "abcd":
+            store.add(name)
+        store.close()
+        self.assertTrue(os.path.exists(self.basename + ".snapshot"))
+        f = open(self.basename + ".log.old", "wb")
+        f.write(json.dumps({'seq': 1, 'op': 'add', 'task': ["a", "", 5, 0]}) + "\n")
+        f.close()
+
+        store = self.open()
+        try:
+            self.assertEqual([task.name for task in store.order], ["a", "b", "c", "d"])
+        finally:
+            store.close()
+
+    def test_torn_batch(self):
+        store = self.open()
+        store.add("a")
+        store.close()
+        record = json.dumps({'seq': 2, 'op': 'batch', 'records': [
+            {'op': 'add', 'task': ["b", "", 5, 0]}, {'op': 'set', 'name': "a", 'field': "completion", 'value': 10}]})
+
+        # the whole batch or none of it
+        for written, names, completion in ((record[:-1], ["a"], 0), (record + "\n", ["a", "b"], 10)):
+            shutil.copy(self.basename + ".log", self.basename + ".log.before")
+            f = open(self.basename + ".log", "ab")
+            f.write(written)
+            f.close()
+            store = self.open()
+            try:
+                self.assertEqual(sorted(store.index), names)
+                self.assertEqual(store.get("a").completion, completion)
+            finally:
+                store.close()
+            shutil.copy(self.basename + ".log.before", self.basename + ".log")
+
+if __name__ == '__main__':
+    unittest.main()
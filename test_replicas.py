@@ -0,0 +1,292 @@
+""" Tests for replicas (server.py --replica-of), with a primary and its replicas running locally.
+
+    The replicas must end up with the primary's table, pass the writes of their clients
+    on to the primary, give every response with an id back to the client that sent it
+    and no one else (even while they're catching up), and get the whole table again when
+    they see a version gap.
+
+    Usage: python -m unittest test_replicas """
+
+import Queue
+import os
+import random
+import select
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from socketclient import Client
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# seconds to wait for anything
+TIMEOUT = 5
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(("localhost", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+class DroppingProxy(object):
+    """ Passes a connection on to the primary, dropping the first line from the primary that
+        contains the given text, the way a replica that lost a change would see it """
+
+    def __init__(self, port, text):
+        self.text = text
+        self.dropped = False
+        self.listener = socket.socket()
+        self.listener.bind(("localhost", 0))
+        self.listener.listen(1)
+        self.port = self.listener.getsockname()[1]
+        self.primary = port
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def run(self):
+        downstream, _ = self.listener.accept()
+        upstream = socket.create_connection(("localhost", self.primary))
+        buffered = ""
+        while True:
+            ready, _, _ = select.select([downstream, upstream], [], [])
+            if downstream in ready:
+                chunk = downstream.recv(65536)
+                if not chunk:
+                    break
+                upstream.sendall(chunk)
+            if upstream in ready:
+                chunk = upstream.recv(65536)
+                if not chunk:
+                    break
+                lines = (buffered + chunk).split("\n")
+                buffered = lines.pop()
+                if not self.dropped:
+                    for i, line in enumerate(lines):
+                        if self.text in line:
+                            del lines[i]
+                            self.dropped = True
+                            break
+                downstream.sendall("".join(line + "\n" for line in lines))
+        downstream.close()
+        upstream.close()
+
+class ReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.processes = []
+        self.clients = []
+        self.primary = self.spawn()
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for process in self.processes:
+            if process.poll() is None:
+                process.kill()
+            process.wait()
+        shutil.rmtree(self.directory)
+
+    def spawn(self, *args):
+        """ Run server.py on a free port, returns the port once it is listening """
+
+        port = free_port()
+        devnull = open(os.devnull, "w")
+        process = subprocess.Popen([sys.executable, os.path.join(HERE, "server.py"), "localhost", str(port)] +
+                                   list(args), cwd=self.directory, stdout=devnull, stderr=devnull)
+        process.port = port
+        self.processes.append(process)
+        deadline = time.time() + TIMEOUT
+        while time.time() < deadline:
+            try:
+                socket.create_connection(("localhost", port)).close()
+                return port
+            except socket.error:
+                time.sleep(0.05)
+        self.fail("server.py %s didn't start" % " ".join(args))
+
+    def replica(self, port=None):
+        return self.spawn("--replica-of", "localhost:%d" % (port or self.primary))
+
+    def connect(self, port, name):
+        """ A delta client, with everything that isn't a response to its requests in client.messages """
+
+        client = Client("localhost", port)
+        client.connect()
+        self.clients.append(client)
+        client.send({'command': "connect " + name, 'client_id': name, 'protocol': 'delta'})
+        response = client.receive()
+        self.assertEqual(response['type'], 'connect')
+        client.name = name
+        client.start()
+        return client
+
+    def call(self, client, command, **kwargs):
+        kwargs.update(command=command, client_id=client.name)
+        return client.call(kwargs, TIMEOUT)
+
+    def table(self, client):
+        response = self.call(client, "resync")
+        return response['data'], response['version'], response['epoch']
+
+    def caught_up(self, replica, primary):
+        """ Wait until the replica has the version the primary has, returns both tables """
+
+        expected = self.table(primary)
+        deadline = time.time() + TIMEOUT
+        while True:
+            copy = self.table(replica)
+            if copy[1] >= expected[1] or time.time() > deadline:
+                return copy, expected
+            time.sleep(0.05)
+
+    def messages(self, client, seconds=0.3):
+        """ What else the client got within a while """
+
+        found = []
+        deadline = time.time() + seconds
+        while True:
+            try:
+                found.append(client.next_message(max(0, deadline - time.time())))
+            except Queue.Empty:
+                return found
+
+    def fill(self, client, n=200):
+        random.seed(n)
+        self.call(client, "batch", commands=["addTask Task %d" % i for i in xrange(n)])
+        self.call(client, "batch", commands=["prioritize Task %d %d" % (i, random.randint(0, 9)) for i in xrange(n)] +
+                                            ["complete Task %d %d" % (i, random.randint(0, 100)) for i in xrange(n)])
+
+    def test_copy(self):
+        primary = self.connect(self.primary, "p")
+        self.fill(primary)
+        replicas = [self.connect(self.replica(), "r%d" % i) for i in xrange(2)]
+        for replica in replicas:
+            copy, expected = self.caught_up(replica, primary)
+            self.assertEqual(copy, expected)
+            self.assertEqual(len(copy[0]), 200)
+
+        # and they keep up
+        self.call(primary, "addTask Late")
+        self.call(primary, "prioritize Task 7 0")
+        for replica in replicas:
+            copy, expected = self.caught_up(replica, primary)
+            self.assertEqual(copy, expected)
+
+    def test_writes_through_replica(self):
+        primary = self.connect(self.primary, "p")
+        self.fill(primary, 50)
+        port = self.replica()
+        writer, other = self.connect(port, "w"), self.connect(port, "o")
+        self.caught_up(writer, primary)
+        self.messages(primary)
+
+        for command in ("addTask Written", "accept Written", "prioritize Written 0", "complete Written 40"):
+            response = self.call(writer, command)
+            self.assertEqual(response['type'], command.split()[0])
+            self.assertEqual(response['client_id'], "w")
+        response = self.call(writer, "batch", commands=["complete Task %d 100" % i for i in xrange(10)])
+        self.assertEqual(response['type'], 'batch')
+
+        copy, expected = self.caught_up(writer, primary)
+        self.assertEqual(copy, expected)
+        self.assertTrue(["Written", "w", "0", "40"] in expected[0])
+        # everyone else hears about every one of them, on the replica and on the primary
+        for client in (other, primary):
+            heard = [m['type'] for m in self.messages(client) if m['client_id'] == "w"]
+            self.assertEqual(heard, ['addTask', 'accept', 'prioritize', 'complete', 'batch'])
+
+    def test_id_routing(self):
+        primary = self.connect(self.primary, "p")
+        self.fill(primary, 20)
+        port = self.replica()
+        first, second = self.connect(port, "a"), self.connect(port, "b")
+        self.caught_up(first, primary)
+        for client in (first, second, primary):
+            self.messages(client)
+
+        # responses go back with the id of the request, to the client that sent it
+        futures = first.pipeline([{'command': "complete Task %d %d" % (i, i), 'client_id': "a"} for i in xrange(10)])
+        futures.append(second.request({'command': "complete Task 10 10", 'client_id': "b"}))
+        futures.append(first.request({'command': "prioritize Missing 1", 'client_id': "a"}))
+        responses = [future.result(TIMEOUT) for future in futures]
+        self.assertEqual([r['type'] for r in responses], ['complete'] * 11 + ['error'])
+        self.assertEqual([r['client_id'] for r in responses], ["a"] * 10 + ["b", "a"])
+        self.assertEqual([r['update'].split("'")[1] for r in responses[:11]], ["Task %d" % i for i in xrange(11)])
+
+        # the broadcasts of changes have no id, and errors only go to the client that made them
+        for client, changes in ((first, 1), (second, 10), (primary, 11)):
+            heard = self.messages(client)
+            self.assertFalse([m for m in heard if 'id' in m])
+            self.assertFalse([m for m in heard if m['type'] == 'error'])
+            self.assertEqual(len(heard), changes)
+
+        # any id comes back as it was sent, and a batch with some bad commands has their errors
+        # in its response
+        second.send({'command': "batch", 'client_id': "b", 'id': ["mine", 1],
+                     'commands': ["complete Task 1 99", "accept Missing"]})
+        heard = self.messages(second)
+        self.assertEqual([(m['type'], m['id']) for m in heard], [('batch', ["mine", 1])])
+        self.assertEqual(len(heard[0]['errors']), 1)
+        self.assertFalse([m for m in self.messages(first) if 'id' in m or m['type'] == 'error'])
+
+    def test_resync_after_gap(self):
+        primary = self.connect(self.primary, "p")
+        self.fill(primary, 50)
+        proxy = DroppingProxy(self.primary, "Dropped")
+        client = self.connect(self.replica(proxy.port), "c")
+        self.caught_up(client, primary)
+
+        self.call(primary, "addTask Dropped")
+        time.sleep(0.3)
+        self.assertTrue(proxy.dropped)
+        copy, expected = self.table(client), self.table(primary)
+        self.assertNotEqual(copy, expected)
+
+        # the next change doesn't follow on from the replica's version, so it gets the whole table again
+        self.call(primary, "addTask After")
+        copy, expected = self.caught_up(client, primary)
+        self.assertEqual(copy, expected)
+        self.assertTrue('resync' in [m['type'] for m in self.messages(client)])
+
+        self.call(primary, "complete Dropped 10")
+        copy, expected = self.caught_up(client, primary)
+        self.assertEqual(copy, expected)
+
+    def test_writes_while_catching_up(self):
+        primary = self.connect(self.primary, "p")
+        self.fill(primary, 20)
+        proxy = DroppingProxy(self.primary, "Dropped")
+        writer = self.connect(self.replica(proxy.port), "w")
+        self.caught_up(writer, primary)
+
+        self.call(primary, "addTask Dropped")
+        time.sleep(0.3)
+        # the answer to a write that comes after the gap can't be passed on as a change,
+        # but the writer still gets one response, with the id of its request
+        response = self.call(writer, "complete Task 1 50")
+        self.assertEqual(response['type'], 'error')
+        self.assertTrue("'Task 1'" in response['update'])
+        copy, expected = self.caught_up(writer, primary)
+        self.assertEqual(copy, expected)
+        self.assertEqual([row[3] for row in copy[0] if row[0] == "Task 1"], ["50"])
+
+    def test_primary_goes_away(self):
+        port = self.replica()
+        replica = [process for process in self.processes if process.port == port][0]
+        self.processes[0].send_signal(signal.SIGINT)
+        deadline = time.time() + TIMEOUT
+        while replica.poll() is None and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotEqual(replica.poll(), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,155 @@
+class StoreRows(object):
+    """ The task table of a TaskStore as a sequence of rows, without building all of them """
+
+    def __init__(self, store):
+        self.store = store
+
+    def __len__(self):
+        return len(self.store)
+
+    def __getitem__(self, position):
+        return self.store.at(position).row()
+
+    def __iter__(self):
+        for task in self.store.order:
+            yield task.row()
+
+    def count(self, completer, completion):
+        """ Count the tasks accepted by completer with a completion in range, using the store's indexes """
+
+        return self.store.count(completer, None, completion)
+
+    def select(self, completer, completion, offset, limit):
+        """ The rows of those tasks, from offset on, using the store's indexes """
+
+        return [task.row() for task in self.store.query(completer, None, completion, 'priority', offset, limit)[0]]
+
+def _affects(change, start, end):
+    """ Return whether a change to the whole table changes rows start to end (not including end) """
+
+    if change['op'] == 'set':
+        return start <= change['index'] < end
+    if change['op'] == 'insert':
+        # everything after an insert moves down one
+        return change['index'] < end
+    # a move above (or below) the rows leaves them where they were
+    low, high = sorted((change['from'], change['to']))
+    return low < end and high >= start
+
+class Viewport(object):
+    """ The rows a subscribed client is looking at: 'limit' rows from 'offset' in
+        priority order, optionally only those accepted by one completer and/or
+        with a completion between two values (inclusive).
+
+        The viewport remembers what the client has, so when the table changes
+        it can tell what the client needs to hear about it. Tables are sequences
+        of rows, like the whole table clients get:
+
+        [["Item 1", "Completer", "5", "12"], ["Item 2", "", "2", "0"]] """
+
+    def __init__(self, offset=0, limit=50, completer=None, completion=None):
+        self.offset = int(offset)
+        self.limit = int(limit)
+        if self.offset < 0 or self.limit < 0:
+            raise ValueError("offset and limit can't be negative")
+        if completer is not None and not isinstance(completer, basestring):
+            raise ValueError("completer must be a name")
+        self.completer = completer
+        self.completion = None
+        if completion is not None:
+            low, high = completion
+            self.completion = (int(low), int(high))
+        # the rows the client has, and how many rows there are in the (filtered) table
+        self.rows = []
+        self.total = 0
+
+    def filtered(self):
+        return self.completer is not None or self.completion is not None
+
+    def same_filter(self, other):
+        return (self.completer, self.completion) == (other.completer, other.completion)
+
+    def matches(self, row):
+        """ Return whether a row passes the filter """
+
+        if self.completer is not None and row[1] != self.completer:
+            return False
+        if self.completion is not None and not self.completion[0] <= int(row[3]) <= self.completion[1]:
+            return False
+        return True
+
+    def count(self, table):
+        """ Count the rows that pass the filter (this looks at every row, if there is a filter
+            and the table isn't a store's) """
+
+        if self.filtered() and isinstance(table, StoreRows):
+            self.total = table.count(self.completer, self.completion)
+        elif self.filtered():
+            self.total = sum(1 for row in table if self.matches(row))
+        else:
+            self.total = len(table)
+
+    def fetch(self, table):
+        """ Get the rows in the viewport from the table """
+
+        if not self.filtered():
+            self.total = len(table)
+            self.rows = [table[i] for i in xrange(self.offset, min(self.offset + self.limit, self.total))]
+            return
+
+        if isinstance(table, StoreRows):
+            self.rows = table.select(self.completer, self.completion, self.offset, self.limit)
+            return
+        rows = []
+        skip = self.offset
+        if self.limit:
+            for row in table:
+                if not self.matches(row):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                rows.append(row)
+                if len(rows) == self.limit:
+                    break
+        self.rows = rows
+
+    def window(self):
+        """ The whole viewport, as it is sent to the client """
+
+        return {'offset': self.offset, 'total': self.total, 'rows': self.rows}
+
+    def change(self, table, delta, touched):
+        """ The table has changed: 'delta' is the change to the whole table and 'touched' has
+            (old row, new row) for every task that changed (old is None for new tasks).
+            Returns what the client needs to hear: nothing, a 'delta' of the cells that
+            changed in the rows it has (with indexes into the viewport), or the whole
+            viewport again if rows came or went. A new 'total' is included if it changed """
+
+        total = self.total
+        if self.filtered():
+            relevant = False
+            for old, new in touched:
+                before = old is not None and self.matches(old)
+                after = self.matches(new)
+                self.total += after - before
+                relevant = relevant or before or after
+        else:
+            end = self.offset + self.limit
+            relevant = any(_affects(c, self.offset, end) for c in delta)
+            self.total = len(table)
+
+        result = {}
+        if relevant:
+            old = self.rows
+            self.fetch(table)
+            if [row[0] for row in old] != [row[0] for row in self.rows]:
+                return self.window()
+            delta = [{'op': 'set', 'index': i, 'field': field, 'value': row[field]}
+                     for i, (before, row) in enumerate(zip(old, self.rows))
+                     for field in xrange(1, len(row)) if before[field] != row[field]]
+            if delta:
+                result['delta'] = delta
+        if self.total != total:
+            result['total'] = self.total
+        return result or None
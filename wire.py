@@ -0,0 +1,203 @@
+""" The binary wire format.
+
+    Clients that send 'format': 'binary' with their connect request (which is
+    itself a normal JSON line) get every message after it as a frame: a 4 byte
+    big-endian length, then the message encoded with msgpack. Everything they
+    send after the connect request has to be framed the same way.
+
+    The msgpack module is used when it is installed; otherwise the same encoding
+    is done here in Python, which handles everything the protocol uses (None,
+    booleans, numbers, strings, lists and dicts). Strings always come back as unicode,
+    like they do from json.loads """
+
+import struct
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# The format names clients can ask for
+FORMATS = ('json', 'binary')
+
+# The frame header: the length of the message that follows
+HEADER = struct.Struct(">I")
+
+# the type bytes of strings of up to 31 bytes, which have their length in them
+_FIXSTR = [chr(0xa0 | n) for n in xrange(32)]
+
+def _pack(obj, out):
+    t = type(obj)
+    if t is unicode:
+        obj = obj.encode('utf-8')
+        t = str
+    if t is str:
+        n = len(obj)
+        if n < 32:
+            out.append(_FIXSTR[n])
+        elif n < 0x100:
+            out.append("\xd9" + chr(n))
+        elif n < 0x10000:
+            out.append(struct.pack(">BH", 0xda, n))
+        else:
+            out.append(struct.pack(">BI", 0xdb, n))
+        out.append(obj)
+    elif t is list or t is tuple:
+        n = len(obj)
+        if n < 16:
+            out.append(chr(0x90 | n))
+        elif n < 0x10000:
+            out.append(struct.pack(">BH", 0xdc, n))
+        else:
+            out.append(struct.pack(">BI", 0xdd, n))
+        for item in obj:
+            # short strings (most of the cells of a table) are done here, rather than by another call
+            t = type(item)
+            if t is unicode:
+                item = item.encode('utf-8')
+                t = str
+            if t is str and len(item) < 32:
+                out.append(_FIXSTR[len(item)])
+                out.append(item)
+            else:
+                _pack(item, out)
+    elif t is dict:
+        n = len(obj)
+        if n < 16:
+            out.append(chr(0x80 | n))
+        elif n < 0x10000:
+            out.append(struct.pack(">BH", 0xde, n))
+        else:
+            out.append(struct.pack(">BI", 0xdf, n))
+        for key, value in obj.iteritems():
+            _pack(key, out)
+            _pack(value, out)
+    elif obj is None:
+        out.append("\xc0")
+    elif obj is True:
+        out.append("\xc3")
+    elif obj is False:
+        out.append("\xc2")
+    elif t is int or t is long:
+        if 0 <= obj < 0x80:
+            out.append(chr(obj))
+        elif -32 <= obj < 0:
+            out.append(chr(obj & 0xff))
+        elif -(1 << 63) <= obj < (1 << 63):
+            out.append(struct.pack(">Bq", 0xd3, obj))
+        elif 0 <= obj < (1 << 64):
+            out.append(struct.pack(">BQ", 0xcf, obj))
+        else:
+            raise TypeError("%d is too big to encode" % obj)
+    elif t is float:
+        out.append(struct.pack(">Bd", 0xcb, obj))
+    else:
+        raise TypeError("can't encode %r" % (obj,))
+
+# type byte -> (struct format, size) of fixed size values
+_FIXED = {0xcc: (">B", 1), 0xcd: (">H", 2), 0xce: (">I", 4), 0xcf: (">Q", 8),
+          0xd0: (">b", 1), 0xd1: (">h", 2), 0xd2: (">i", 4), 0xd3: (">q", 8),
+          0xca: (">f", 4), 0xcb: (">d", 8)}
+# type byte -> (struct format, size) of the length of strings, lists and dicts, and which it is
+_LENGTHS = {0xd9: (">B", 1, 'str'), 0xda: (">H", 2, 'str'), 0xdb: (">I", 4, 'str'),
+            0xc4: (">B", 1, 'bin'), 0xc5: (">H", 2, 'bin'), 0xc6: (">I", 4, 'bin'),
+            0xdc: (">H", 2, 'list'), 0xdd: (">I", 4, 'list'), 0xde: (">H", 2, 'dict'), 0xdf: (">I", 4, 'dict')}
+_CONSTANTS = {0xc0: None, 0xc2: False, 0xc3: True}
+
+def _unpack(data, pos):
+    b = ord(data[pos])
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    if b >= 0xe0:
+        return b - 0x100, pos
+
+    if 0xa0 <= b <= 0xbf:
+        kind, n = 'str', b & 0x1f
+    elif 0x90 <= b <= 0x9f:
+        kind, n = 'list', b & 0x0f
+    elif 0x80 <= b <= 0x8f:
+        kind, n = 'dict', b & 0x0f
+    elif b in _CONSTANTS:
+        return _CONSTANTS[b], pos
+    elif b in _FIXED:
+        fmt, size = _FIXED[b]
+        return struct.unpack_from(fmt, data, pos)[0], pos + size
+    elif b in _LENGTHS:
+        fmt, size, kind = _LENGTHS[b]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += size
+    else:
+        raise ValueError("unknown type byte 0x%02x" % b)
+
+    if kind == 'str' or kind == 'bin':
+        end = pos + n
+        if end > len(data):
+            raise ValueError("truncated message")
+        if kind == 'bin':
+            return data[pos:end], end
+        return data[pos:end].decode('utf-8'), end
+    if kind == 'list':
+        items = []
+        for i in xrange(n):
+            # short strings (most of the cells of a table) are done here, rather than by another call
+            b = ord(data[pos])
+            if 0xa0 <= b <= 0xbf:
+                end = pos + 1 + (b & 0x1f)
+                if end > len(data):
+                    raise ValueError("truncated message")
+                items.append(data[pos + 1:end].decode('utf-8'))
+                pos = end
+            else:
+                item, pos = _unpack(data, pos)
+                items.append(item)
+        return items, pos
+    obj = {}
+    for i in xrange(n):
+        key, pos = _unpack(data, pos)
+        obj[key], pos = _unpack(data, pos)
+    return obj, pos
+
+def packb(obj):
+    """ Encode a message """
+
+    if msgpack:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = []
+    _pack(obj, out)
+    return "".join(out)
+
+def unpackb(data):
+    """ Decode a message. Raises ValueError if it isn't a valid one """
+
+    if msgpack:
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception, e:
+            raise ValueError(str(e))
+    try:
+        obj, pos = _unpack(data, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, RuntimeError, TypeError), e:
+        # (RuntimeError is too deep nesting, TypeError an unhashable dict key)
+        raise ValueError(str(e))
+    if pos != len(data):
+        raise ValueError("extra data after the message")
+    return obj
+
+def frame(obj):
+    """ Encode a message as a frame """
+
+    payload = packb(obj)
+    return HEADER.pack(len(payload)) + payload
+
+def read_frame(f):
+    """ Read a frame from a file, returns the decoded message, or None at end of file """
+
+    header = f.read(HEADER.size)
+    if len(header) < HEADER.size:
+        return None
+    length = HEADER.unpack(header)[0]
+    payload = f.read(length)
+    if len(payload) < length:
+        return None
+    return unpackb(payload)